@@ -29,6 +29,16 @@ def add_model_config_args(parser):
     group = parser.add_argument_group('model', 'model configuration')
 
     group.add_argument('--transformer-xl', action='store_true', help='use transformer-xl for training')
+    group.add_argument('--performer', action='store_true',
+                       help='use the FAVOR+ linear attention, whose memory is linear in the sequence length')
+    group.add_argument('--performer-num-features', type=int, default=256,
+                       help='number of random features of the performer attention')
+    group.add_argument('--attention-backend', type=str, default='auto', choices=['auto', 'sdpa', 'chunked', 'naive'],
+                       help='implementation of the softmax attention, auto uses scaled_dot_product_attention '
+                            'when torch provides it and the query-chunked attention otherwise')
+    group.add_argument('--prune-queries', action='store_true',
+                       help='compute the last transformer layer only for the positions that are read, '
+                            'e.g. the pooled token of classification or the target tokens of the lm loss')
     group.add_argument('--pretrained-bert', action='store_true',
                        help='use a pretrained bert-large-uncased model instead'
                             'of initializing from scratch. See '
@@ -90,6 +100,10 @@ def add_fp16_config_args(parser):
                        help='embedding token types in fp32')
     group.add_argument('--fp32-allreduce', action='store_true',
                        help='all-reduce in fp32')
+    group.add_argument('--flat-master', action='store_true',
+                       help='keep the fp16 parameters and the fp32 master parameters of the fp16 optimizer '
+                            'in flat buffers, so that its copies and checks are one op per param group. The '
+                            'parameters without a gradient are found with backward hooks and are not updated')
     group.add_argument('--hysteresis', type=int, default=2,
                        help='hysteresis for dynamic loss scaling')
     group.add_argument('--loss-scale', type=float, default=None,
@@ -133,6 +147,10 @@ def add_training_args(parser):
     group.add_argument('--label-smoothing', type=float, default=0.0)
     group.add_argument('--log-interval', type=int, default=100,
                        help='report interval')
+    group.add_argument('--sync-free', action='store_true',
+                       help='with --fp16, do not read the loss of every micro-batch on the host to skip nan '
+                            'losses, the overflow check of the loss scaler skips their steps and the loss is only '
+                            'read at the log interval')
     group.add_argument('--summary-dir', type=str, default="", help="The directory to store the summary")
     group.add_argument('--seed', type=int, default=1234, help='random seed')
     # Batch producer arguments
@@ -168,6 +186,11 @@ def add_training_args(parser):
                        help='Do not save current optimizer.')
     group.add_argument('--no-save-rng', action='store_true',
                        help='Do not save current rng state.')
+    group.add_argument('--async-save', action='store_true',
+                       help='copy the checkpoint to CPU memory and write it in a background thread, '
+                            'the tracker file points to it once all the ranks have written their files')
+    group.add_argument('--async-save-max-in-flight', type=int, default=1,
+                       help='maximum number of checkpoints being written in the background')
     group.add_argument('--load', type=str, default=None,
                        help='Path to a directory containing a model checkpoint.')
     group.add_argument('--no-load-optim', action='store_true',
@@ -191,6 +214,11 @@ def add_training_args(parser):
                        choices=['nccl', 'gloo'])
     group.add_argument('--DDP-impl', default='torch', choices=['local', 'torch', 'none'],
                        help='which DistributedDataParallel implementation to use.')
+    group.add_argument('--overlap-allreduce', action='store_true',
+                       help='with the local DDP, all-reduce every gradient bucket during the backward pass '
+                            'as soon as its gradients are ready')
+    group.add_argument('--bucket-cap-mb', type=float, default=25,
+                       help='maximum size of a gradient bucket of the local DDP in MB')
 
     group.add_argument('--local_rank', type=int, default=None,
                        help='local rank passed from distributed launcher')
@@ -241,6 +269,9 @@ def add_evaluation_args(parser):
                             'evaluation. Defaults to '
                             'math.ceil(`--eval-seq-length`*.15/10)*10')
     group.add_argument('--overlapping-eval', type=int, default=32)
+    group.add_argument('--quantize-int8', action='store_true',
+                       help='quantize the weights of the linear layers and the word embeddings to int8 '
+                            'with per-channel scales for inference')
 
     return parser
 
@@ -259,6 +290,29 @@ def add_text_generate_args(parser):
     group.add_argument("--min-tgt-length", type=int, default=0)
     group.add_argument("--select-topk", action='store_true')
     group.add_argument("--blank-maskratio", type=float, default=0.1)
+    group.add_argument("--input-source", type=str, default=None,
+                       help="File with one prompt per line to generate with the continuous-batching engine. "
+                            "Prompts are read interactively if not set")
+    group.add_argument("--num-return-sequences", type=int, default=1,
+                       help="Number of samples generated for every prompt from one encoding of the context")
+    group.add_argument("--kv-cache", action='store_true',
+                       help="Cache the projected keys and values of previous tokens during incremental decoding")
+    group.add_argument("--draft-load", type=str, default=None,
+                       help="Checkpoint of a smaller GLM with the same tokenizer used as the draft model "
+                            "of speculative decoding")
+    group.add_argument("--draft-num-layers", type=int, default=None,
+                       help="Number of layers of the draft model, the same as the target model if not set")
+    group.add_argument("--draft-hidden-size", type=int, default=None,
+                       help="Hidden size of the draft model, the same as the target model if not set")
+    group.add_argument("--draft-num-attention-heads", type=int, default=None,
+                       help="Number of attention heads of the draft model, the same as the target model if not set")
+    group.add_argument("--num-draft-tokens", type=int, default=4,
+                       help="Number of tokens proposed by the draft model at every step of speculative decoding")
+    group.add_argument("--score", action='store_true',
+                       help="Score the lines 'context<TAB>target' of --input-source instead of generating, "
+                            "used by cpu_inference.py")
+    group.add_argument("--num-threads", type=int, default=None,
+                       help="Number of intra-op threads of cpu_inference.py, the torch default if not set")
     return parser
 
 
@@ -370,6 +424,9 @@ def add_finetune_config_args(parser):
     group.add_argument('--pattern-id', type=int, default=0)
     group.add_argument('--fast-decode', action='store_true',
                        help="Fast decode for multi-token cloze. Can only be used without checkpoint activation.")
+    group.add_argument('--share-context', action='store_true',
+                       help="Encode the context shared by the choices of multi-token cloze once, with all the "
+                            "choices packed in the same sequence")
     group.add_argument('--few-superglue', action='store_true')
     group.add_argument('--eval-valid', action='store_true', help="Whether evaluate on the valid set")
     group.add_argument('--validation-metric', type=str, default=None)
@@ -451,6 +508,11 @@ def get_args():
         args.fp32_embedding = False
         args.fp32_tokentypes = False
         args.fp32_layernorm = False
+    # Without fp16, the nan check of the loss is the only guard against a non-finite step.
+    if args.sync_free and not args.fp16:
+        if args.rank == 0:
+            print('WARNING: --sync-free needs --fp16, the loss is checked on the host')
+        args.sync_free = False
 
     if hasattr(args, "deepspeed") and args.deepspeed and args.deepspeed_config is not None:
         with open(args.deepspeed_config) as file:
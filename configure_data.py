@@ -138,15 +138,17 @@ def prepare_tokenizer(args):
         print_rank_0('> padded vocab (size: {}) with {} dummy '
                      'tokens (new size: {})'.format(before, after - before, after))
         print_rank_0('> found end-of-document token: {}'.format(eod_token))
-        token_counts = torch.cuda.LongTensor([after, eod_token])
+        token_counts = [after, eod_token]
     else:
-        token_counts = torch.cuda.LongTensor([0, 0])
-    # Broadcast num tokens.
-    torch.distributed.broadcast(token_counts,
-                                mpu.get_model_parallel_src_rank(),
-                                group=mpu.get_model_parallel_group())
-    num_tokens = token_counts[0].item()
-    eod_token = token_counts[1].item()
+        token_counts = [0, 0]
+    if mpu.get_model_parallel_world_size() > 1:
+        # Broadcast num tokens.
+        token_counts = torch.cuda.LongTensor(token_counts)
+        torch.distributed.broadcast(token_counts,
+                                    mpu.get_model_parallel_src_rank(),
+                                    group=mpu.get_model_parallel_group())
+        token_counts = token_counts.tolist()
+    num_tokens, eod_token = token_counts
     args.vocab_size, args.eod_token = num_tokens, eod_token
     return tokenizer
 
@@ -0,0 +1,140 @@
+"""Single-process inference on CPU, without torch.distributed or CUDA.
+
+The checkpoint must be merged to model parallel size 1 first (see change_mp.py).
+With --input-source the prompts of the file are generated, or scored with --score,
+otherwise the seq2seq task given by --task and --data-dir is evaluated."""
+
+import os
+import json
+import random
+import time
+from datetime import datetime
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import mpu
+from arguments import get_args
+from configure_data import prepare_tokenizer
+from generate_samples import generate_samples_from_file
+from model import select_output_positions
+from train_utils import get_model, quantize_model
+from utils import load_checkpoint, print_rank_0
+
+
+def initialize_cpu(args):
+    """Replace the distributed and CUDA setup of the other entry points."""
+    assert args.model_parallel_size == 1, 'Merge the checkpoint to model parallel size 1 with change_mp.py'
+    args.cuda, args.fp16, args.deepspeed = False, False, False
+    args.world_size, args.rank, args.model_parallel_size = 1, 0, 1
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    mpu.initialize_single_process()
+    if args.seed is not None and args.seed > 0:
+        random.seed(args.seed)
+        np.random.seed(args.seed)
+        torch.manual_seed(args.seed)
+
+
+def setup_model(args):
+    model = get_model(args, model_type="generation")
+    args.load = args.load_pretrained if args.load_pretrained is not None else args.load
+    args.no_load_optim = True
+    load_checkpoint(model, None, None, args, no_deepspeed=True, no_load_rng=True)
+    if args.quantize_int8:
+        quantize_model(model)
+    model.eval()
+    return model
+
+
+def build_score_sample(tokenizer, context, target, args):
+    """Tokens, position ids and loss mask of a target span filled in the mask of the context,
+    the context is closed with [gMASK] if it has no mask token."""
+    mask_ids = [tokenizer.get_command(command).Id for command in ['MASK', 'sMASK', 'gMASK']]
+    context_tokens = [tokenizer.get_command('ENC').Id] + tokenizer.EncodeAsIds(context).tokenization
+    if not any(token in mask_ids for token in context_tokens):
+        context_tokens.append(tokenizer.get_command('gMASK').Id)
+    if context_tokens[-1] != tokenizer.get_command('gMASK').Id:
+        context_tokens.append(tokenizer.get_command('eos').Id)
+    mask_position = next(i for i, token in enumerate(context_tokens) if token in mask_ids)
+    target_tokens = tokenizer.EncodeAsIds(target).tokenization
+    tokens = context_tokens + [tokenizer.get_command('sop').Id] + target_tokens[:-1]
+    position_ids = list(range(len(context_tokens))) + [mask_position] * len(target_tokens)
+    block_position_ids = [0] * len(context_tokens) + list(range(1, len(target_tokens) + 1))
+    targets = [0] * len(context_tokens) + target_tokens
+    loss_mask = [0] * len(context_tokens) + [1] * len(target_tokens)
+    if len(tokens) > args.seq_length:
+        raise ValueError(f"Sample of length {len(tokens)} is longer than the sequence length {args.seq_length}")
+    return tokens, [position_ids, block_position_ids], targets, loss_mask, len(context_tokens)
+
+
+def score_batch(model, samples, pad_id):
+    """Log-likelihood of the targets of a batch of samples of build_score_sample."""
+    length = max(len(sample[0]) for sample in samples)
+
+    def pad(sequence, value=0):
+        return sequence + [value] * (length - len(sequence))
+
+    tokens = torch.tensor([pad(sample[0], pad_id) for sample in samples])
+    position_ids = torch.tensor([[pad(ids) for ids in sample[1]] for sample in samples])
+    targets = torch.tensor([pad(sample[2]) for sample in samples])
+    loss_mask = torch.tensor([pad(sample[3]) for sample in samples])
+    sep = torch.tensor([sample[4] for sample in samples])
+    output_positions = select_output_positions(loss_mask)
+    logits, *_ = model(tokens, position_ids, sep, output_positions=output_positions)
+    log_probs = F.log_softmax(logits.float(), dim=-1)
+    targets, loss_mask = targets.gather(1, output_positions), loss_mask.gather(1, output_positions)
+    log_probs = log_probs.gather(2, targets.unsqueeze(-1)).squeeze(-1)
+    return (log_probs * loss_mask).sum(dim=1).tolist(), loss_mask.sum(dim=1).tolist()
+
+
+def score_samples_from_file(model, tokenizer, args):
+    """Write the log-likelihood of the target of every line 'context<TAB>target' of args.input_source."""
+    with open(args.input_source) as file:
+        lines = [line.rstrip('\n').split('\t') for line in file if line.strip()]
+    output_path = "./samples"
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    output_path = os.path.join(output_path, f"score-{datetime.now().strftime('%m-%d-%H-%M')}.jsonl")
+    pad_id = tokenizer.get_command('pad').Id
+    start_time = time.time()
+    with torch.no_grad(), open(output_path, "w") as output:
+        for start in range(0, len(lines), args.batch_size):
+            batch = lines[start: start + args.batch_size]
+            samples = [build_score_sample(tokenizer, context, target, args) for context, target in batch]
+            scores, lengths = score_batch(model, samples, pad_id)
+            for (context, target), score, length in zip(batch, scores, lengths):
+                output.write(json.dumps({"context": context, "target": target, "log_prob": score,
+                                         "num_tokens": length}) + "\n")
+    print_rank_0(f"Scored {len(lines)} samples in {time.time() - start_time:.2f}s, saved to {output_path}")
+
+
+def evaluate_task(model, tokenizer, args):
+    """Evaluate the seq2seq task of args.task on its test (or --eval-valid dev) set."""
+    from tasks.seq2seq.finetune import metrics_func_provider
+    metrics_func = metrics_func_provider(args, tokenizer, is_test=True)
+    with torch.no_grad():
+        metrics_func(model, epoch=-1, output_predictions=False)
+
+
+def main():
+    start_time = time.time()
+    args = get_args()
+    if args.input_source is not None and not args.score:
+        args.mem_length = args.seq_length + args.mem_length - 1
+    initialize_cpu(args)
+    tokenizer = prepare_tokenizer(args)
+    model = setup_model(args)
+    print_rank_0(f"Started in {time.time() - start_time:.2f}s with {torch.get_num_threads()} threads")
+    if args.input_source is not None:
+        if args.score:
+            score_samples_from_file(model, tokenizer, args)
+        else:
+            generate_samples_from_file(model, tokenizer, args, torch.device('cpu'), args.batch_size)
+    else:
+        evaluate_task(model, tokenizer, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -20,8 +20,8 @@ from configure_data import prepare_tokenizer
 
 from utils import print_rank_0
 from utils import Timers
-from train_utils import setup_model_and_optimizer, train_step, load_pretrained
-from utils import load_checkpoint, save_checkpoint
+from train_utils import setup_model_and_optimizer, train_step, load_pretrained, quantize_model
+from utils import load_checkpoint, save_checkpoint, wait_checkpoints
 from pretrain_glm import report_iteration_metrics
 from pretrain_glm import evaluate_and_print_results
 from pretrain_glm import initialize_distributed
@@ -275,6 +275,8 @@ def _train(model, optimizer, lr_scheduler, forward_step,
                             output.write(json.dumps(score_dict) + "\n")
                         with open(os.path.join(args.save, "best_checkpointed_iteration.txt"), "w") as output:
                             output.write(str(best_iteration))
+    # the best checkpoint is loaded after training
+    wait_checkpoints(args)
     torch.distributed.barrier()
     return best_iteration
 
@@ -394,6 +396,9 @@ def finetune(args, train_valid_datasets_provider, model_kwargs, forward_step=fin
                 optimizer.refresh_fp32_params()
             else:
                 optimizer._model_params_to_master_params()
+    if args.quantize_int8:
+        assert args.epochs == 0, 'Int8 quantization is only for inference'
+        quantize_model(model)
     torch.distributed.barrier()
     timers('pretrained checkpoint').stop()
     args.iteration = 0
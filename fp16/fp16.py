@@ -116,6 +116,7 @@ class FP16_Optimizer(object):
         dynamic_loss_scale (bool, optional, default=False):  Use dynamic loss scaling.  If True, this will override any ``static_loss_scale`` option.
         dynamic_loss_args (dict, optional, default=None):  Dict of kwargs that will be forwarded to the internal :class:`DynamicLossScaler` instance's constructor.  Keys of this dict must match kwargs accepted by :class:`DynamicLossScaler`'s constructor.  If ``dynamic_loss_args`` is unspecified, :class:`DynamicLossScaler`'s defaults will be used.
         verbose (bool, optional, default=True):  By default, FP16_Optimizer's constructor prints out the parameters and parameter groups it is ingesting, as a sanity check.  If this becomes annoying (e.g. for large models), it can be disabled by passing ``verbose=False``.  ``verbose=False`` will not disable printing when the loss scale is readjusted during dynamic loss scaling.
+        flat_master (bool, optional, default=False):  Keep the fp16 parameters, their gradients, the fp32 master parameters and the master gradients of every param group in four contiguous buffers, of which the individual tensors are views.  The gradient copy, the unscaling, the overflow check and the parameter copy-back are then one vectorized op per group.  The :attr:`state_dict` layout is unchanged.  The gradients of the flattened parameters are never ``None``, a hook on their gradient accumulators records which ones get a gradient, and the master parameters of the others get no gradient, so that the optimizer skips them as without ``flat_master``.
 
     ``init_optimizer`` is expected to have been constructed in the ordinary way.  
     It is recommended (although not required) that the newly constructed :class:`FP16_Optimizer` instance be 
@@ -182,7 +183,8 @@ class FP16_Optimizer(object):
                  static_loss_scale=1.0,
                  dynamic_loss_scale=False,
                  dynamic_loss_args=None,
-                 verbose=False):
+                 verbose=False,
+                 flat_master=False):
         if not torch.cuda.is_available:
             raise SystemError("Cannot use fp16 without CUDA.")
 
@@ -203,9 +205,9 @@ class FP16_Optimizer(object):
             fp32_from_fp16_params_this_group = []
             for i, param in enumerate(param_group['params']):
                 if param.requires_grad:
-                    if param.type() == 'torch.cuda.HalfTensor':
-                        self.maybe_print("FP16_Optimizer received torch.cuda.HalfTensor with {}"
-                                         .format(param.size()))
+                    if param.dtype == torch.half:
+                        self.maybe_print("FP16_Optimizer received {} with {}"
+                                         .format(param.type(), param.size()))
                         fp16_params_this_group.append(param)
                         master_param = param.detach().clone().float()
                         master_param.requires_grad = True
@@ -217,20 +219,24 @@ class FP16_Optimizer(object):
                         # We still need to recast per-param state tensors, if any, to FP32.
                         if param in self.optimizer.state:
                             self.optimizer.state[master_param] = self.optimizer.state.pop(param)
-                    elif param.type() == 'torch.cuda.FloatTensor':
-                        self.maybe_print("FP16_Optimizer received torch.cuda.FloatTensor with {}"
-                                         .format(param.size()))
+                    elif param.dtype == torch.float:
+                        self.maybe_print("FP16_Optimizer received {} with {}"
+                                         .format(param.type(), param.size()))
                         fp32_params_this_group.append(param)
                         param_group['params'][i] = param
                     else:
                         raise TypeError("Wrapped parameters must be either "
-                                        "torch.cuda.FloatTensor or torch.cuda.HalfTensor. "
+                                        "FloatTensor or HalfTensor. "
                                         "Received {}".format(param.type()))
 
             self.fp16_groups.append(fp16_params_this_group)
             self.fp32_from_fp16_groups.append(fp32_from_fp16_params_this_group)
             self.fp32_from_fp32_groups.append(fp32_params_this_group)
 
+        self.flat_master = flat_master
+        if flat_master:
+            self._flatten_groups()
+
         # Leverage state_dict() and load_state_dict() to recast preexisting per-param state tensors
         self.optimizer.load_state_dict(self.optimizer.state_dict())
         # alternative way to cast per-param state tensors:
@@ -251,6 +257,64 @@ class FP16_Optimizer(object):
 
         self.clip_grad_norm = clip_grad_norm
 
+    def _flatten_groups(self):
+        """Move the fp16 params and their fp32 masters of every group into flat buffers and
+        make the params, the masters and their gradients views of these buffers."""
+        self.fp16_flat_groups, self.fp32_flat_groups = [], []
+        self.fp16_flat_grads, self.fp32_flat_grads = [], []
+        # (params, views of their gradients in the flat buffer) of every group
+        self.flat_grad_views = []
+        for fp16_group, fp32_from_fp16_group in zip(self.fp16_groups, self.fp32_from_fp16_groups):
+            if not fp16_group:
+                for flat_buffers in (self.fp16_flat_groups, self.fp32_flat_groups,
+                                     self.fp16_flat_grads, self.fp32_flat_grads):
+                    flat_buffers.append(None)
+                continue
+            fp16_flat = _flatten_dense_tensors([param.data for param in fp16_group])
+            fp32_flat = _flatten_dense_tensors([master.data for master in fp32_from_fp16_group])
+            for param, view in zip(fp16_group, _unflatten_dense_tensors(fp16_flat, fp16_group)):
+                param.data = view
+            # The masters keep their identity, which the param groups and the optimizer state refer to.
+            for master, view in zip(fp32_from_fp16_group, _unflatten_dense_tensors(fp32_flat, fp32_from_fp16_group)):
+                master.data = view
+            self.fp16_flat_groups.append(fp16_flat)
+            self.fp32_flat_groups.append(fp32_flat)
+            self.fp16_flat_grads.append(torch.zeros_like(fp16_flat))
+            self.fp32_flat_grads.append(torch.zeros_like(fp32_flat))
+            for params, flat_grad in ((fp16_group, self.fp16_flat_grads[-1]),
+                                      (fp32_from_fp16_group, self.fp32_flat_grads[-1])):
+                self.flat_grad_views.append((params, _unflatten_dense_tensors(flat_grad, params)))
+        self._attach_flat_grads()
+        # The fp16 params that got a gradient since the last zero_grad. The gradients of the others are
+        # zero in the flat buffers, their masters get no gradient so that the optimizer skips them.
+        self.params_with_grad = set()
+        self.grad_accs = []
+        for fp16_group in self.fp16_groups:
+            for param in fp16_group:
+                # The hook of the AccumulateGrad node runs after the gradient is accumulated in param.grad.
+                grad_acc = param.expand_as(param).grad_fn.next_functions[0][0]
+                grad_acc.register_hook(self._make_grad_hook(param))
+                self.grad_accs.append(grad_acc)
+
+    def _make_grad_hook(self, param):
+        def grad_hook(*unused):
+            self.params_with_grad.add(param)
+
+        return grad_hook
+
+    def _attach_flat_grads(self):
+        """Point the gradients of the flattened params and masters to the flat gradient buffers.
+        A gradient that was replaced, e.g. set to None, is copied into the buffer first."""
+        for params, views in self.flat_grad_views:
+            for param, view in zip(params, views):
+                if param.grad is not None and param.grad.data_ptr() == view.data_ptr():
+                    continue
+                if param.grad is not None:
+                    view.copy_(param.grad.data)
+                else:
+                    view.zero_()
+                param.grad = view
+
     def maybe_print(self, msg):
         if self.verbose:
             print(msg)
@@ -265,6 +329,21 @@ class FP16_Optimizer(object):
         """
         Zero fp32 and fp16 parameter grads.
         """
+        if self.flat_master:
+            # The flat gradient buffers are zeroed and stay in place.
+            self._attach_flat_grads()
+            for flat_grad in self.fp16_flat_grads + self.fp32_flat_grads:
+                if flat_grad is not None:
+                    flat_grad.zero_()
+            self.params_with_grad.clear()
+            for fp32_group in self.fp32_from_fp32_groups:
+                for param in fp32_group:
+                    if set_grads_to_None:
+                        param.grad = None
+                    elif param.grad is not None:
+                        param.grad.detach_()
+                        param.grad.zero_()
+            return
         # In principle, only the .grad attributes of the model params need to be zeroed,
         # because gradients are copied into the FP32 master params.  However, we zero
         # all gradients owned by the optimizer, just to be safe:
@@ -288,6 +367,12 @@ class FP16_Optimizer(object):
                         param.grad.zero_()
 
     def _check_overflow(self):
+        if self.flat_master:
+            grads = [flat_grad for flat_grad in self.fp16_flat_grads if flat_grad is not None]
+            grads += [param.grad.data for group in self.fp32_from_fp32_groups for param in group
+                      if param.grad is not None]
+            self.overflow = self.loss_scaler.has_grads_overflow(grads)
+            return
         params = []
         for group in self.fp16_groups:
             for param in group:
@@ -301,21 +386,44 @@ class FP16_Optimizer(object):
         self.loss_scaler.update_scale(has_overflow)
 
     def _master_params_to_model_params(self):
+        if self.flat_master:
+            for fp16_flat, fp32_flat in zip(self.fp16_flat_groups, self.fp32_flat_groups):
+                if fp16_flat is not None:
+                    fp16_flat.copy_(fp32_flat)
+            return
         for fp16_group, fp32_from_fp16_group in zip(self.fp16_groups, self.fp32_from_fp16_groups):
             master_params_to_model_params(fp16_group, fp32_from_fp16_group)
 
     def _model_params_to_master_params(self):
+        if self.flat_master:
+            for fp16_flat, fp32_flat in zip(self.fp16_flat_groups, self.fp32_flat_groups):
+                if fp16_flat is not None:
+                    fp32_flat.copy_(fp16_flat)
+            return
         for fp16_group, fp32_from_fp16_group in zip(self.fp16_groups, self.fp32_from_fp16_groups):
             master_params_to_model_params(fp32_from_fp16_group, fp16_group)
 
     # To consider:  Integrate distributed with this wrapper by registering a hook on each variable 
     # that does the overflow check, gradient copy + downscale, and fp32 allreduce in a different stream.
     def _model_grads_to_master_grads(self):
+        if self.flat_master:
+            for fp16_flat_grad, fp32_flat_grad in zip(self.fp16_flat_grads, self.fp32_flat_grads):
+                if fp16_flat_grad is not None:
+                    fp32_flat_grad.copy_(fp16_flat_grad)
+            return
         for fp16_group, fp32_from_fp16_group in zip(self.fp16_groups, self.fp32_from_fp16_groups):
             model_grads_to_master_grads(fp16_group, fp32_from_fp16_group)
 
     def _downscale_master(self):
-        if self.loss_scale != 1.0:
+        if self.loss_scale != 1.0 and self.flat_master:
+            for fp32_flat_grad in self.fp32_flat_grads:
+                if fp32_flat_grad is not None:
+                    fp32_flat_grad.mul_(1. / self.loss_scale)
+            for group in self.fp32_from_fp32_groups:
+                for param in group:
+                    if param.grad is not None:
+                        param.grad.data.mul_(1. / self.loss_scale)
+        elif self.loss_scale != 1.0:
             for group in self.optimizer.param_groups:
                 for param in group['params']:
                     if param.grad is not None:
@@ -572,11 +680,19 @@ class FP16_Optimizer(object):
         updated by the optimizer.  :attr:`update_master_grads` only needs to be called if
         ``fp16_optimizer_obj.backward`` was called with ``update_master_grads=False``.
         """
+        if self.flat_master:
+            # the model gradients may have been replaced since the last step, e.g. by module.zero_grad()
+            self._attach_flat_grads()
         if self.dynamic_loss_scale:
             self._check_overflow()
             if self.overflow: return
         self._model_grads_to_master_grads()
         self._downscale_master()
+        if self.flat_master:
+            for fp16_group, fp32_from_fp16_group in zip(self.fp16_groups, self.fp32_from_fp16_groups):
+                for param, master in zip(fp16_group, fp32_from_fp16_group):
+                    if param not in self.params_with_grad:
+                        master.grad = None
 
     def inspect_master_grad_data(self):
         """
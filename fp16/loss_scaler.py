@@ -42,6 +42,10 @@ class LossScaler:
     def has_overflow(self, params):
         return False
 
+    # `grads` is a list of gradient tensors
+    def has_grads_overflow(self, grads, device=None):
+        return False
+
     # `x` is a torch.Tensor
     def _has_inf_or_nan(x):
         return False
@@ -105,23 +109,41 @@ class DynamicLossScaler:
 
     # `params` is a list / generator of torch.Variable
     def has_overflow_serial(self, params):
-        for p in params:
-            if p.grad is not None and DynamicLossScaler._has_inf_or_nan(p.grad.data):
-                return True
-
-        return False
+        return bool(DynamicLossScaler._overflow_flag(params).item())
 
     def has_overflow(self, params):
-        overflow = self.has_overflow_serial(params)
+        params = list(params)
+        return self.has_grads_overflow([p.grad.data for p in params if p.grad is not None],
+                                       device=params[0].device if params else None)
+
+    # `grads` is a list of gradient tensors, e.g. the flat gradient buffers of FP16_Optimizer
+    def has_grads_overflow(self, grads, device=None):
         # Since each model parallel GPU carries only part of the model,
         # make sure overflow flag is synced across all the model parallel GPUs
-        overflow_gpu = torch.cuda.ByteTensor([overflow])
+        overflow_gpu = DynamicLossScaler._grads_overflow_flag(grads, device=device)
         torch.distributed.all_reduce(overflow_gpu,
                                      op=torch.distributed.ReduceOp.MAX,
                                      group=mpu.get_model_parallel_group())
+        # The only host synchronization of the overflow check.
         overflow = overflow_gpu[0].item()
         return bool(overflow)
 
+    # `params` is a list / generator of torch.Variable
+    def _overflow_flag(params):
+        """One-element uint8 tensor on the device of the gradients, 1 if any gradient has an inf or nan.
+        The sums of all the gradients are checked together, instead of reading every sum on the host."""
+        params = list(params)
+        return DynamicLossScaler._grads_overflow_flag([p.grad.data for p in params if p.grad is not None],
+                                                      device=params[0].device if params else None)
+
+    # `grads` is a list of gradient tensors, `device` is used if there are none (default CPU)
+    def _grads_overflow_flag(grads, device=None):
+        if not grads:
+            return torch.zeros(1, dtype=torch.uint8, device=device)
+        # the sum is accumulated in fp32 without a fp32 copy of the gradient
+        sums = torch.stack([grad.sum(dtype=torch.float32) for grad in grads])
+        return (~torch.isfinite(sums).all()).to(torch.uint8).view(1)
+
 
     # `x` is a torch.Tensor
     def _has_inf_or_nan(x):
@@ -16,6 +16,7 @@
 """Sample Generate GPT2"""
 
 import os
+import json
 import torch
 import torch.nn.functional as F
 import time
@@ -26,11 +27,13 @@ from pretrain_glm import set_random_seed
 from pretrain_glm import get_masks_and_position_ids
 from utils import load_checkpoint
 from configure_data import prepare_tokenizer
-from generation_utils import BeamSearchScorer
+from generation_utils import TensorBeamSearchScorer
+from generation_engine import GenerationEngine
 import mpu
 
-from train_utils import get_model
-from generation_utils import top_k_logits
+from train_utils import get_model, quantize_model
+from generation_utils import sample_logits
+from speculative_decoding import SpeculativeSampler, setup_draft_model
 
 
 def setup_model(args):
@@ -53,6 +56,8 @@ def setup_model(args):
         args.load = args.load_pretrained
         _ = load_checkpoint(
             model, None, None, args, no_load_rng=True)
+    if args.quantize_int8:
+        quantize_model(model)
     # if args.deepspeed:
     #     model = model.module
 
@@ -84,7 +89,8 @@ def get_batch(context_tokens, device, args):
     return tokens, attention_mask, position_ids
 
 
-def sample_sequence(model, tokenizer, context_tokens, context_length, args, device, mems=None, end_tokens=None):
+def sample_sequence(model, tokenizer, context_tokens, context_length, args, device, mems=None, end_tokens=None,
+                    kv_cache=None):
     if not args.block_lm:
         context_tokens, attention_mask, position_ids = get_batch(context_tokens, device, args)
         tokens = torch.empty((args.num_beams, 0), device=context_tokens.device, dtype=torch.long)
@@ -96,7 +102,7 @@ def sample_sequence(model, tokenizer, context_tokens, context_length, args, devi
     if end_tokens is None:
         end_tokens = [args.eod_token]
     if args.num_beams > 1:
-        beam_scorer = BeamSearchScorer(
+        beam_scorer = TensorBeamSearchScorer(
             batch_size=1,
             max_length=args.out_seq_length,
             num_beams=args.num_beams,
@@ -108,7 +114,10 @@ def sample_sequence(model, tokenizer, context_tokens, context_length, args, devi
     last_beam_num = 1
     while counter < args.out_seq_length:
         if counter == 0 and not args.block_lm:
-            next_token_logits, *mems = model(context_tokens, position_ids, attention_mask, *mems)
+            if kv_cache is not None:
+                next_token_logits, *mems = model(context_tokens, position_ids, attention_mask, kv_cache=kv_cache)
+            else:
+                next_token_logits, *mems = model(context_tokens, position_ids, attention_mask, *mems)
         else:
             if args.block_lm:
                 if args.no_block_position:
@@ -123,7 +132,10 @@ def sample_sequence(model, tokenizer, context_tokens, context_length, args, devi
                 attention_mask = context_tokens.new_ones(last_beam_num, 1, 1, args.mem_length + 1,
                                                          device=context_tokens.device, dtype=torch.float)
             last_token = tokens[:, -1:]
-            next_token_logits, *mems = model(last_token, position_ids, attention_mask, *mems)
+            if kv_cache is not None:
+                next_token_logits, *mems = model(last_token, position_ids, attention_mask, kv_cache=kv_cache)
+            else:
+                next_token_logits, *mems = model(last_token, position_ids, attention_mask, *mems)
         next_token_logits = next_token_logits[:, -1]
         if args.num_beams > 1:
             next_token_scores = F.log_softmax(next_token_logits, dim=-1)
@@ -155,14 +167,14 @@ def sample_sequence(model, tokenizer, context_tokens, context_length, args, devi
             beam_next_tokens = beam_next_tokens.unsqueeze(-1)
             tokens = torch.cat([tokens[beam_idx, :], beam_next_tokens], dim=-1)
             mems = [mem[beam_idx] for mem in mems] if mems else None
+            if kv_cache is not None:
+                kv_cache.reorder(beam_idx)
             if beam_scorer.is_done:
                 break
             last_beam_num = args.num_beams
         else:
-            next_token_logits /= args.temperature
-            next_token_logits = top_k_logits(next_token_logits, top_k=args.top_k, top_p=args.top_p)
-            log_probs = F.softmax(next_token_logits, dim=-1)
-            prev = torch.multinomial(log_probs, num_samples=1)[0]
+            prev = sample_logits(next_token_logits, temperature=args.temperature, top_k=args.top_k,
+                                 top_p=args.top_p)[0]
             is_end = prev.item() in end_tokens
             if is_end:
                 break
@@ -182,6 +194,33 @@ def sample_sequence(model, tokenizer, context_tokens, context_length, args, devi
     return torch.cat((context_tokens, tokens), dim=1), mems
 
 
+def speculative_sample_sequence(sampler, tokenizer, context_tokens, position, args, end_tokens):
+    """Fill one blank with speculative sampling. The memories of both models are kept by the sampler."""
+    tokens = context_tokens.new_full((1, 1), tokenizer.get_command('sop').Id)
+
+    def get_inputs(start, length):
+        positions = torch.arange(start, start + length, device=context_tokens.device)
+        if args.no_block_position:
+            position_ids = (position + positions).unsqueeze(0)
+        else:
+            position_ids = torch.stack((torch.full_like(positions, position), positions + 1), dim=0).unsqueeze(0)
+        return position_ids, context_tokens.new_zeros([1])
+
+    while tokens.size(1) - 1 < args.out_seq_length:
+        new_tokens = sampler.step(tokens, get_inputs)[0].tolist()
+        num_tokens = min(len(new_tokens), args.out_seq_length - tokens.size(1) + 1)
+        is_end = False
+        for i, token in enumerate(new_tokens[:num_tokens]):
+            if token in end_tokens:
+                num_tokens, is_end = i, True
+                break
+        sampler.rewind(num_tokens)
+        tokens = torch.cat((tokens, tokens.new_tensor([new_tokens[:num_tokens]])), dim=1)
+        if is_end:
+            break
+    return torch.cat((context_tokens, tokens), dim=1), sampler.mems
+
+
 def read_context(tokenizer, args, output):
     terminate_runs, skip_run = 0, 0
     if mpu.get_model_parallel_rank() == 0:
@@ -236,7 +275,7 @@ def read_context(tokenizer, args, output):
     return terminate_runs, raw_text, context_tokens_tensor, context_length
 
 
-def generate_samples(model, tokenizer, args, device):
+def generate_samples(model, tokenizer, args, device, draft_model=None):
     model.eval()
     output_path = "./samples"
     if not os.path.exists(output_path):
@@ -250,6 +289,23 @@ def generate_samples(model, tokenizer, args, device):
             if terminate_runs == 1:
                 return
             start_time = time.time()
+            if args.num_return_sequences > 1:
+                # the samples share one forward pass over the context
+                engine = GenerationEngine(model, tokenizer, args, device, max_batch_size=args.num_return_sequences)
+                engine.add_request(raw_text, num_return_sequences=args.num_return_sequences,
+                                   context_tokens=context_tokens_tensor.tolist())
+                results = []
+                while engine.has_unfinished_requests():
+                    results += engine.step()
+                if mpu.get_model_parallel_rank() == 0:
+                    os.system('clear')
+                    print("\nTaken time {:.2f}\n".format(time.time() - start_time), flush=True)
+                    print("\nContext:", raw_text, flush=True)
+                    for result in sorted(results, key=lambda result: result.index):
+                        print(f"\nGLM [{result.index}]:", result.text, flush=True)
+                        output.write(result.text + "\n")
+                torch.distributed.barrier(group=mpu.get_model_parallel_group())
+                continue
             if args.block_lm:
                 mems = []
                 tokens, attention_mask, position_ids = get_batch(context_tokens_tensor, device, args)
@@ -263,16 +319,49 @@ def generate_samples(model, tokenizer, args, device):
                 if args.no_block_position:
                     for mask_position in mask_positions:
                         position_ids[0, mask_position + 1:] += args.out_seq_length
-                _, *mems = model(tokens, position_ids, attention_mask, *mems)
+                # The cache only holds the active beams, so the best hypothesis of a blank can not be
+                # carried over to the next blank with beam search.
+                # the logits of the context are not used, only one position is projected to the vocabulary
+                no_logits = tokens.new_zeros((1, 1))
+                kv_cache, draft_kv_cache = None, None
+                if args.kv_cache and (args.num_beams == 1 or len(mask_positions) == 1):
+                    max_length = context_length + len(mask_positions) * (args.out_seq_length + 1)
+                    if draft_model is not None:
+                        # room for the draft tokens that are verified and then discarded
+                        max_length += args.num_draft_tokens + 1
+                        draft_kv_cache = mpu.KeyValueCache(args.draft_num_layers or args.num_layers, max_length)
+                        draft_model(tokens, position_ids, attention_mask, kv_cache=draft_kv_cache,
+                                    output_positions=no_logits)
+                    kv_cache = mpu.KeyValueCache(args.num_layers, max_length)
+                    model(tokens, position_ids, attention_mask, kv_cache=kv_cache, output_positions=no_logits)
+                else:
+                    _, *mems = model(tokens, position_ids, attention_mask, *mems, output_positions=no_logits)
+                sampler = None
+                if draft_model is not None:
+                    draft_mems = []
+                    if draft_kv_cache is None:
+                        _, *draft_mems = draft_model(tokens, position_ids, attention_mask, output_positions=no_logits)
+                    sampler = SpeculativeSampler(model, draft_model, args.num_draft_tokens,
+                                                 temperature=args.temperature, top_k=args.top_k, top_p=args.top_p)
+                    sampler.start(mems, draft_mems, kv_cache=kv_cache, draft_kv_cache=draft_kv_cache)
                 for mask_position in mask_positions:
                     if args.no_block_position:
                         position = position_ids[0, mask_position].item()
                     else:
                         position = mask_position
-                    tokens, mems = sample_sequence(model, tokenizer, tokens, position,
-                                                   args, device, mems=mems, end_tokens=end_tokens)
+                    if sampler is not None:
+                        tokens, mems = speculative_sample_sequence(sampler, tokenizer, tokens, position, args,
+                                                                   end_tokens)
+                    else:
+                        tokens, mems = sample_sequence(model, tokenizer, tokens, position,
+                                                       args, device, mems=mems, end_tokens=end_tokens,
+                                                       kv_cache=kv_cache)
             else:
-                tokens, _ = sample_sequence(model, tokenizer, context_tokens_tensor, context_length, args, device)
+                kv_cache = None
+                if args.kv_cache:
+                    kv_cache = mpu.KeyValueCache(args.num_layers, context_length + args.out_seq_length)
+                tokens, _ = sample_sequence(model, tokenizer, context_tokens_tensor, context_length, args, device,
+                                            kv_cache=kv_cache)
             output_tokens_list = tokens.view(-1).contiguous()
             if mpu.get_model_parallel_rank() == 0:
                 os.system('clear')
@@ -286,6 +375,32 @@ def generate_samples(model, tokenizer, args, device):
             torch.distributed.barrier(group=mpu.get_model_parallel_group())
 
 
+def generate_samples_from_file(model, tokenizer, args, device, max_batch_size):
+    """Generate all the prompts in `args.input_source` with the continuous-batching engine."""
+    model.eval()
+    with open(args.input_source) as file:
+        prompts = [line.strip() for line in file if line.strip()]
+    output_path = "./samples"
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    output_path = os.path.join(output_path, f"sample-{datetime.now().strftime('%m-%d-%H-%M')}.jsonl")
+    engine = GenerationEngine(model, tokenizer, args, device, max_batch_size=max_batch_size)
+    start_time = time.time()
+    num_samples = len(prompts) * args.num_return_sequences
+    with open(output_path, "w") as output:
+        for i, result in enumerate(engine.generate(prompts, num_return_sequences=args.num_return_sequences)):
+            if mpu.get_model_parallel_rank() == 0:
+                output.write(json.dumps({"id": result.uid, "index": result.index, "context": result.context,
+                                         "text": result.text, "blanks": result.blanks}) + "\n")
+                output.flush()
+                if (i + 1) % args.log_interval == 0:
+                    print(f"Generated {i + 1} / {num_samples} samples in {time.time() - start_time:.2f}s",
+                          flush=True)
+    if mpu.get_model_parallel_rank() == 0:
+        print(f"Generated {num_samples} samples in {time.time() - start_time:.2f}s, saved to {output_path}",
+              flush=True)
+
+
 def main():
     """Main training program."""
 
@@ -309,12 +424,21 @@ def main():
 
     # Model, optimizer, and learning rate.
     model = setup_model(args)
+    draft_model = None
+    if args.draft_load is not None:
+        assert args.block_lm and args.num_beams == 1, 'Speculative decoding requires a block_lm model and sampling.'
+        draft_model = setup_draft_model(args)
 
+    # the engine decodes up to batch-size prompts at once
+    max_batch_size = args.batch_size
     # setting default batch size to 1
     args.batch_size = 1
 
     # generate samples
-    generate_samples(model, tokenizer, args, torch.cuda.current_device())
+    if args.input_source is not None:
+        generate_samples_from_file(model, tokenizer, args, torch.cuda.current_device(), max_batch_size)
+    else:
+        generate_samples(model, tokenizer, args, torch.cuda.current_device(), draft_model=draft_model)
 
 
 if __name__ == "__main__":
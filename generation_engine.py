@@ -0,0 +1,263 @@
+"""Continuous-batching generation engine for GLM."""
+
+from collections import deque
+
+import torch
+import torch.nn.functional as F
+
+from generation_utils import sample_logits
+
+
+class GenerationResult(object):
+    def __init__(self, uid, context, text, blanks, index=0):
+        self.uid = uid
+        self.context = context
+        self.text = text
+        self.blanks = blanks
+        # index of the sample among the num_return_sequences samples of the prompt
+        self.index = index
+
+
+class _Sequence(object):
+    """Decoding state of a single prompt."""
+
+    def __init__(self, uid, raw_text, context_tokens, mask_positions, generation_positions, index=0):
+        self.uid = uid
+        self.index = index
+        self.raw_text = raw_text
+        self.context_tokens = context_tokens
+        # positions of the blanks in the context, used as the block position of the generated tokens
+        self.mask_positions = mask_positions
+        # (rough) absolute positions of the blanks when block positions are not used
+        self.generation_positions = generation_positions
+        self.current_blank = 0
+        self.blanks = [[] for _ in mask_positions]
+        self.next_token = None
+
+    @property
+    def context_length(self):
+        return len(self.context_tokens)
+
+
+class GenerationEngine(object):
+    """Request-level generation engine on top of GLMModel.
+
+    Prompts are queued with `add_request` and decoded in a running batch
+    of at most `max_batch_size` sequences. A sequence leaves the batch as
+    soon as all its blanks are filled and the next queued prompt is
+    admitted in its place, so the batch does not wait for the slowest
+    sequence. Prompts may contain several [MASK]/[sMASK]/[gMASK] blanks;
+    a prompt without any mask is generated left to right by appending a
+    generation mask as in `generate_samples.read_context`.
+
+    The memories of the running sequences are kept right-aligned in
+    [b, m, h] tensors and the attention mask hides the padding on the
+    left, so sequences with different context lengths share one forward
+    pass per step. With num_return_sequences > 1 the samples of a prompt
+    share one forward pass over the context and start from the same
+    memory. The engine does not use torch.distributed itself and runs in a
+    single process on any device the model is on. Only greedy decoding and
+    sampling are supported.
+    """
+
+    def __init__(self, model, tokenizer, args, device, max_batch_size=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.args = args
+        self.device = device
+        self.max_batch_size = max_batch_size if max_batch_size is not None else args.batch_size
+        assert args.block_lm, 'The generation engine requires a blank-infilling (block_lm) model.'
+        assert args.num_beams == 1, 'The generation engine does not support beam search.'
+        mask_tokens = ['MASK', 'sMASK', 'gMASK'] if args.task_mask else ['MASK']
+        self.mask_tokens = [tokenizer.get_command(token).Id for token in mask_tokens]
+        self.start_token = tokenizer.get_command('sop').Id
+        self.end_tokens = [tokenizer.get_command('eop').Id, args.eod_token]
+        self.pad_token = tokenizer.get_command('pad').Id
+
+        self.queue = deque()
+        self.running = []
+        self.mems = []
+        self.mem_lengths = None
+        self._next_uid = 0
+
+    def encode(self, raw_text):
+        generation_mask = '[gMASK]' if self.args.task_mask else '[MASK]'
+        if 'MASK]' not in raw_text:
+            raw_text += ' ' + generation_mask
+        context_tokens = self.tokenizer.EncodeAsIds(raw_text).tokenization
+        context_tokens = [self.tokenizer.get_command('ENC').Id] + context_tokens
+        if not raw_text.endswith('[gMASK]'):
+            context_tokens = context_tokens + [self.tokenizer.get_command('eos').Id]
+        return context_tokens
+
+    def add_request(self, raw_text, uid=None, num_return_sequences=1, context_tokens=None):
+        """Queue `num_return_sequences` samples of a prompt and return its uid.
+        `context_tokens` can be given instead of encoding `raw_text`."""
+        if uid is None:
+            uid = self._next_uid
+            self._next_uid += 1
+        if context_tokens is None:
+            context_tokens = self.encode(raw_text)
+        if len(context_tokens) >= self.args.seq_length:
+            raise ValueError(f"Context length {len(context_tokens)} of request {uid} exceeds the window length")
+        mask_positions = [i for i, token in enumerate(context_tokens) if token in self.mask_tokens]
+        generation_positions = list(mask_positions)
+        if self.args.no_block_position:
+            # every blank shifts the positions after it by out_seq_length
+            generation_positions = [position + i * self.args.out_seq_length for i, position in
+                                    enumerate(mask_positions)]
+        for index in range(num_return_sequences):
+            self.queue.append(_Sequence(uid, raw_text, context_tokens, mask_positions, generation_positions,
+                                        index=index))
+        return uid
+
+    def has_unfinished_requests(self):
+        return len(self.queue) > 0 or len(self.running) > 0
+
+    def generate(self, prompts, num_return_sequences=1):
+        """Generate all the prompts and yield the results in the order they finish."""
+        for prompt in prompts:
+            self.add_request(prompt, num_return_sequences=num_return_sequences)
+        while self.has_unfinished_requests():
+            for result in self.step():
+                yield result
+
+    def _context_position_ids(self, sequence):
+        position_ids = torch.arange(sequence.context_length, dtype=torch.long)
+        if self.args.no_block_position:
+            for mask_position in sequence.mask_positions:
+                position_ids[mask_position + 1:] += self.args.out_seq_length
+            return position_ids
+        return torch.stack((position_ids, torch.zeros_like(position_ids)), dim=0)
+
+    def _admit(self):
+        """Run the contexts of queued prompts and add them to the running batch."""
+        num_admitted = min(self.max_batch_size - len(self.running), len(self.queue))
+        if num_admitted <= 0:
+            return
+        sequences = [self.queue.popleft() for _ in range(num_admitted)]
+        # The samples of a prompt share its context token list and are encoded once.
+        context_rows, contexts, rows = {}, [], []
+        for sequence in sequences:
+            key = id(sequence.context_tokens)
+            if key not in context_rows:
+                context_rows[key] = len(contexts)
+                contexts.append(sequence)
+            rows.append(context_rows[key])
+        max_length = max(sequence.context_length for sequence in contexts)
+        tokens = torch.full((len(contexts), max_length), self.pad_token, dtype=torch.long)
+        position_ids = []
+        for i, sequence in enumerate(contexts):
+            tokens[i, :sequence.context_length] = torch.tensor(sequence.context_tokens, dtype=torch.long)
+            sequence_position_ids = self._context_position_ids(sequence)
+            sequence_position_ids = F.pad(sequence_position_ids, (0, max_length - sequence.context_length))
+            position_ids.append(sequence_position_ids)
+        tokens = tokens.to(self.device)
+        position_ids = torch.stack(position_ids, dim=0).to(self.device)
+        context_lengths = torch.tensor([sequence.context_length for sequence in contexts], dtype=torch.long,
+                                       device=self.device)
+        # The contexts are padded on the right and fully bidirectional, so the padding is never attended to.
+        # the logits of the context are not used
+        _, *mems = self.model(tokens, position_ids, context_lengths, return_memory=True,
+                              output_positions=tokens.new_zeros((len(contexts), 1)))
+
+        # Move the valid part of the new memories to the right, with one row per sample.
+        rows = torch.tensor(rows, dtype=torch.long, device=self.device)
+        context_lengths = context_lengths[rows]
+        new_length = max(max_length, self.mems[0].size(1) if self.mems else 0)
+        columns = torch.arange(new_length, device=self.device).unsqueeze(0)
+        columns = (columns - (new_length - context_lengths.unsqueeze(1))).clamp(min=0)
+        new_mems = []
+        for i, mem in enumerate(mems):
+            mem = mem[rows.unsqueeze(1), columns]
+            if self.mems:
+                old_mem = self.mems[i]
+                if old_mem.size(1) < new_length:
+                    old_mem = F.pad(old_mem, (0, 0, new_length - old_mem.size(1), 0))
+                mem = torch.cat((old_mem, mem), dim=0)
+            new_mems.append(mem)
+        self.mems = new_mems
+        if self.mem_lengths is None:
+            self.mem_lengths = context_lengths
+        else:
+            self.mem_lengths = torch.cat((self.mem_lengths, context_lengths), dim=0)
+        for sequence in sequences:
+            sequence.next_token = self.start_token
+        self.running += sequences
+
+    def _step_position_ids(self):
+        if self.args.no_block_position:
+            position_ids = [sequence.generation_positions[sequence.current_blank] + len(
+                sequence.blanks[sequence.current_blank]) for sequence in self.running]
+            return torch.tensor(position_ids, dtype=torch.long, device=self.device).unsqueeze(1)
+        position_ids = [[sequence.mask_positions[sequence.current_blank],
+                         len(sequence.blanks[sequence.current_blank]) + 1] for sequence in self.running]
+        return torch.tensor(position_ids, dtype=torch.long, device=self.device).unsqueeze(2)
+
+    def _sample(self, logits):
+        args = self.args
+        return sample_logits(logits, temperature=args.temperature, top_k=args.top_k, top_p=args.top_p).squeeze(1)
+
+    def _finish(self, sequence):
+        blanks = [self.tokenizer.DecodeIds(blank) for blank in sequence.blanks]
+        output_tokens = []
+        current_blank = 0
+        for token in sequence.context_tokens[1:]:
+            if token in self.mask_tokens:
+                output_tokens += sequence.blanks[current_blank]
+                current_blank += 1
+            else:
+                output_tokens.append(token)
+        if sequence.context_tokens[-1] not in self.mask_tokens:
+            # remove eos
+            output_tokens = output_tokens[:-1]
+        text = self.tokenizer.DecodeIds(output_tokens)
+        return GenerationResult(sequence.uid, sequence.raw_text, text, blanks, index=sequence.index)
+
+    def step(self):
+        """Admit queued prompts, decode one token for every running sequence and
+        return the results of the sequences that finished."""
+        with torch.no_grad():
+            return self._step()
+
+    def _step(self):
+        self._admit()
+        if not self.running:
+            return []
+        batch_size, memory_length = len(self.running), self.mems[0].size(1)
+        tokens = torch.tensor([sequence.next_token for sequence in self.running], dtype=torch.long,
+                              device=self.device).unsqueeze(1)
+        position_ids = self._step_position_ids()
+        # the memory of each sequence starts at memory_length - mem_lengths
+        columns = torch.arange(memory_length + 1, device=self.device).unsqueeze(0)
+        attention_mask = (columns >= (memory_length - self.mem_lengths).unsqueeze(1))
+        attention_mask = attention_mask.view(batch_size, 1, 1, memory_length + 1).float()
+        logits, *mems = self.model(tokens, position_ids, attention_mask, *self.mems, return_memory=True)
+        self.mems = mems
+        self.mem_lengths = self.mem_lengths + 1
+        next_tokens = self._sample(logits[:, -1].float()).tolist()
+
+        finished, keep = [], []
+        for i, (sequence, token) in enumerate(zip(self.running, next_tokens)):
+            blank = sequence.blanks[sequence.current_blank]
+            if token not in self.end_tokens:
+                blank.append(token)
+                sequence.next_token = token
+            if token in self.end_tokens or len(blank) >= self.args.out_seq_length:
+                sequence.current_blank += 1
+                sequence.next_token = self.start_token
+                if sequence.current_blank == len(sequence.blanks):
+                    finished.append(self._finish(sequence))
+                    continue
+            keep.append(i)
+        if len(keep) < batch_size:
+            self.running = [self.running[i] for i in keep]
+            if keep:
+                keep = torch.tensor(keep, dtype=torch.long, device=self.device)
+                self.mem_lengths = self.mem_lengths[keep]
+                # drop the padding columns that no remaining sequence uses
+                start = memory_length + 1 - self.mem_lengths.max().item()
+                self.mems = [mem[keep, start:] for mem in self.mems]
+            else:
+                self.mems, self.mem_lengths = [], None
+        return finished
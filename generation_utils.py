@@ -18,6 +18,7 @@ from collections import UserDict
 from typing import Optional, Tuple, List, Iterable
 
 import torch
+import torch.nn.functional as F
 
 PROCESS_INPUTS_DOCSTRING = r"""
     Args:
@@ -81,34 +82,55 @@ FINALIZE_INPUTS_DOCSTRING = r"""
 """
 
 
-def top_k_logits(logits, top_k=0, top_p=0.0, filter_value=-float('Inf')):
+def top_k_logits(logits, top_k=0, top_p=0.0, filter_value=-float('Inf'), num_candidates=256):
     # This function has been mostly taken from huggingface conversational ai code at
     # https://medium.com/huggingface/how-to-build-a-state-of-the-art-conversational-ai-with-transfer-learning-2d818ac26313
+    # The filtering is applied to every row of `logits` [..., vocab_size] independently.
 
     if top_k > 0:
+        top_k = min(top_k, logits.size(-1))
         # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
+        sorted_logits, sorted_indices = torch.topk(logits, top_k)
+        indices_to_remove = logits < sorted_logits[..., -1, None]
+        logits.masked_fill_(indices_to_remove, filter_value)
 
     if top_p > 0.0:
-        # convert to 1D
-        logits = logits.view(logits.size()[1]).contiguous()
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+        if top_k > 0:
+            # the top-k tokens are already sorted and are the only ones left
+            cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+        else:
+            # Avoid sorting the whole vocabulary: the nucleus is usually within the top candidates.
+            num_candidates = min(num_candidates, logits.size(-1))
+            sorted_logits, sorted_indices = torch.topk(logits, num_candidates)
+            normalizer = torch.logsumexp(logits, dim=-1, keepdim=True)
+            cumulative_probs = torch.cumsum(torch.exp(sorted_logits - normalizer), dim=-1)
+            if num_candidates < logits.size(-1) and (cumulative_probs[..., -1] <= top_p).any():
+                sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+                cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
 
         # Remove tokens with cumulative probability above the threshold
         sorted_indices_to_remove = cumulative_probs > top_p
         # Shift the indices to the right to keep also the first token above the threshold
         sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
         sorted_indices_to_remove[..., 0] = 0
-        indices_to_remove = sorted_indices[sorted_indices_to_remove]
-        logits[indices_to_remove] = filter_value
-        # going back to 2D
-        logits = logits.view(1, -1).contiguous()
+        # Tokens outside the sorted candidates are removed as well
+        indices_to_keep = torch.zeros_like(logits, dtype=torch.bool)
+        indices_to_keep.scatter_(-1, sorted_indices, ~sorted_indices_to_remove)
+        logits.masked_fill_(~indices_to_keep, filter_value)
 
     return logits
 
 
+def sample_logits(logits, temperature=1.0, top_k=0, top_p=0.0, num_samples=1):
+    """Sample `num_samples` tokens from every row of `logits` [batch_size * num_beams, vocab_size]
+    after temperature scaling and top-k / top-p filtering."""
+    if temperature != 1.0:
+        logits = logits / temperature
+    logits = top_k_logits(logits, top_k=top_k, top_p=top_p)
+    probs = F.softmax(logits, dim=-1)
+    return torch.multinomial(probs, num_samples=num_samples)
+
+
 class BeamScorer(ABC):
     """
     Abstract base class for all beam scorers that are used for :meth:`~transformers.PretrainedModel.beam_search` and
@@ -253,7 +275,7 @@ class BeamSearchScorer(BeamScorer):
                     beam_hyp.add(
                         input_ids[batch_beam_idx].clone(),
                         next_score.item(),
-                        mems=[mem[[next_index.item()]] for mem in mems] if mems else None
+                        mems=[mem[[batch_beam_idx.item()]] for mem in mems] if mems else None
                     )
                 else:
                     # add next predicted token since it is not eos_token
@@ -389,6 +411,250 @@ class BeamHypotheses:
             return ret
 
 
+class TensorBeamSearchScorer(BeamScorer):
+    r"""
+    Vectorized version of :class:`BeamSearchScorer`. EOS detection, hypothesis insertion, done-tracking and the
+    selection of the next beams are computed with batched tensor ops, so that a decoding step does not read single
+    candidates back to the host. :class:`BeamSearchScorer` is kept as the reference implementation; both return the
+    same results except for the order of hypotheses with exactly equal scores.
+
+    Args:
+        batch_size (:obj:`int`):
+            Batch Size of :obj:`input_ids` for which beam search decoding is run in parallel.
+        max_length (:obj:`int`):
+            The maximum length of the sequence to be generated.
+        num_beams (:obj:`int`):
+            Number of beams for beam search.
+        device (:obj:`torch.device`):
+            Defines the device type (*e.g.*, :obj:`"cpu"` or :obj:`"cuda"`) on which this instance of
+            :obj:`TensorBeamSearchScorer` will be allocated.
+        length_penalty (:obj:`float`, `optional`, defaults to 1.0):
+            Exponential penalty to the length.
+        do_early_stopping (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Whether to stop the beam search when at least ``num_beams`` sentences are finished per batch or not.
+        num_beam_hyps_to_keep (:obj:`int`, `optional`, defaults to 1):
+            The number of beam hypotheses that shall be returned upon calling
+            :meth:`~TensorBeamSearchScorer.finalize`.
+    """
+
+    def __init__(
+            self,
+            batch_size: int,
+            max_length: int,
+            num_beams: int,
+            device: torch.device,
+            length_penalty: Optional[float] = 1.0,
+            do_early_stopping: Optional[bool] = False,
+            num_beam_hyps_to_keep: Optional[int] = 1,
+    ):
+        self.max_length = max_length
+        self.num_beams = num_beams
+        self.device = device
+        self.length_penalty = length_penalty
+        self.do_early_stopping = do_early_stopping
+        self.num_beam_hyps_to_keep = num_beam_hyps_to_keep
+
+        self._beam_hyps = TensorBeamHypotheses(
+            batch_size=batch_size,
+            num_beams=self.num_beams,
+            length_penalty=self.length_penalty,
+            early_stopping=self.do_early_stopping,
+            device=self.device
+        )
+        self._done = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+
+    @property
+    def is_done(self) -> bool:
+        """Whether all the batch items are finished. This reads the flags on the host, :attr:`done` does not."""
+        return bool(self._done.all())
+
+    @property
+    def done(self) -> torch.BoolTensor:
+        """Whether each batch item is finished, as a :obj:`torch.BoolTensor` of shape :obj:`(batch_size,)`."""
+        return self._done
+
+    def process(
+            self,
+            input_ids: torch.LongTensor,
+            next_scores: torch.FloatTensor,
+            next_tokens: torch.LongTensor,
+            next_indices: torch.LongTensor,
+            pad_token_id: Optional[int] = None,
+            eos_token_id: Optional[int] = None,
+            mems=None
+    ) -> Tuple[torch.Tensor]:
+        cur_len = input_ids.shape[-1]
+        batch_size = self._done.size(0)
+        assert batch_size == (input_ids.shape[0] // self.num_beams)
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        device = next_scores.device
+        num_candidates = next_tokens.size(1)
+        batch_beam_indices = next_indices + torch.arange(batch_size, device=device).unsqueeze(1) * self.num_beams
+        if eos_token_id is not None:
+            eos_tokens = torch.tensor(eos_token_id, dtype=next_tokens.dtype, device=device)
+            is_eos = (next_tokens.unsqueeze(-1) == eos_tokens).any(dim=-1)
+        else:
+            is_eos = torch.zeros_like(next_tokens, dtype=torch.bool)
+        done = self._done.unsqueeze(1)
+
+        if ((~is_eos).sum(dim=1) < self.num_beams).masked_fill(self._done, False).any():
+            raise ValueError(
+                f"At most {self.num_beams} tokens in {next_tokens} can be equal to `eos_token_id: {eos_token_id}`. Make sure {next_tokens} are corrected."
+            )
+        # The first num_beams candidates that are not eos continue as the next beams.
+        candidate_rank = torch.arange(num_candidates, device=device)
+        beam_order = (candidate_rank + is_eos.long() * num_candidates).argsort(dim=1)[:, :self.num_beams]
+        next_beam_scores = next_scores.gather(1, beam_order).masked_fill(done, 0)
+        next_beam_tokens = next_tokens.gather(1, beam_order)
+        if pad_token_id is not None:
+            next_beam_tokens = next_beam_tokens.masked_fill(done, pad_token_id)
+        next_beam_indices = batch_beam_indices.gather(1, beam_order).masked_fill(done, 0)
+
+        # eos candidates within the top num_beams finish a hypothesis.
+        hyp_indices = batch_beam_indices[:, :self.num_beams]
+        add_mask = is_eos[:, :self.num_beams] & ~done
+        self._beam_hyps.add(input_ids[hyp_indices], next_scores[:, :self.num_beams], add_mask,
+                            mems=mems, mem_indices=hyp_indices)
+
+        # Check if we are done so that we can save a pad step if all(done)
+        self._done = self._done | self._beam_hyps.is_done(next_scores.max(dim=1)[0], cur_len)
+
+        return UserDict(
+            {
+                "next_beam_scores": next_beam_scores.view(-1),
+                "next_beam_tokens": next_beam_tokens.view(-1),
+                "next_beam_indices": next_beam_indices.view(-1),
+            }
+        )
+
+    def finalize(
+            self,
+            input_ids: torch.LongTensor,
+            final_beam_scores: torch.FloatTensor,
+            final_beam_tokens: torch.LongTensor,
+            final_beam_indices: torch.LongTensor,
+            pad_token_id: Optional[int] = None,
+            eos_token_id: Optional[int] = None,
+            mems=None
+    ) -> Tuple[torch.LongTensor, List[torch.Tensor]]:
+        batch_size = self._done.size(0)
+        num_keep = self.num_beam_hyps_to_keep
+
+        # finalize all open beam hypotheses and add to generated hypotheses
+        mem_indices = torch.arange(batch_size * self.num_beams, device=input_ids.device).view(batch_size, -1)
+        add_mask = (~self._done).unsqueeze(1).expand(-1, self.num_beams)
+        self._beam_hyps.add(input_ids[mem_indices], final_beam_scores.view(batch_size, self.num_beams), add_mask,
+                            mems=mems, mem_indices=mem_indices)
+
+        # the hypotheses are kept sorted, so the best ones come first
+        scores = self._beam_hyps.scores[:, :num_keep].reshape(-1)
+        sent_lengths = self._beam_hyps.lengths[:, :num_keep].reshape(-1)
+        sent_max_len = sent_lengths.max().item()
+        decoded = self._beam_hyps.tokens[:, :num_keep, :sent_max_len].reshape(batch_size * num_keep, sent_max_len)
+        # shorter batches are padded if needed
+        if sent_lengths.min().item() != sent_max_len:
+            assert pad_token_id is not None, "`pad_token_id` has to be defined"
+            if isinstance(eos_token_id, (list, tuple)):
+                eos_token_id = eos_token_id[0]
+            positions = torch.arange(sent_max_len, device=decoded.device).unsqueeze(0)
+            decoded = decoded.masked_fill(positions > sent_lengths.unsqueeze(1), pad_token_id)
+            decoded = decoded.masked_fill(positions == sent_lengths.unsqueeze(1), eos_token_id)
+
+        mems = None
+        if self._beam_hyps.mems is not None:
+            mem_lengths = self._beam_hyps.mem_lengths[:, :num_keep]
+            mem_length = mem_lengths.max().item()
+            assert mem_lengths.min().item() == mem_length, "The kept hypotheses have memories of different lengths"
+            mems = [mem[:, :num_keep, :mem_length].flatten(0, 1) for mem in self._beam_hyps.mems]
+        return decoded, mems, scores
+
+
+class TensorBeamHypotheses:
+    def __init__(self, batch_size: int, num_beams: int, length_penalty: float, early_stopping: bool, device=None):
+        """
+        Initialize the n-best lists of hypotheses of a batch. The lists are kept in tensors of size
+        [batch_size, num_beams] sorted by score.
+        """
+        self.length_penalty = length_penalty
+        self.early_stopping = early_stopping
+        self.num_beams = num_beams
+        self.scores = torch.full((batch_size, num_beams), -float('inf'), dtype=torch.float, device=device)
+        self.valid = torch.zeros((batch_size, num_beams), dtype=torch.bool, device=device)
+        self.lengths = torch.zeros((batch_size, num_beams), dtype=torch.long, device=device)
+        self.tokens = None
+        self.mems = None
+        self.mem_lengths = None
+
+    def _reserve(self, hyps: torch.LongTensor):
+        batch_size, _, hyp_length = hyps.size()
+        if self.tokens is None:
+            self.tokens = hyps.new_zeros((batch_size, self.num_beams, hyp_length))
+        elif self.tokens.size(-1) < hyp_length:
+            capacity = max(hyp_length, 2 * self.tokens.size(-1))
+            tokens = self.tokens.new_zeros((batch_size, self.num_beams, capacity))
+            tokens[:, :, :self.tokens.size(-1)] = self.tokens
+            self.tokens = tokens
+
+    def add(self, hyps: torch.LongTensor, sum_logprobs: torch.FloatTensor, add_mask: torch.BoolTensor, mems=None,
+            mem_indices=None):
+        """
+        Add the new hypotheses [batch_size, n, length] where `add_mask` is set, keeping the best num_beams of
+        each list.
+        """
+        batch_size, num_new, hyp_length = hyps.size()
+        self._reserve(hyps)
+        scores = sum_logprobs.float() / (max(hyp_length, 1) ** self.length_penalty)
+        all_scores = torch.cat((self.scores, scores), dim=1)
+        all_valid = torch.cat((self.valid, add_mask), dim=1)
+        # Empty slots come last, ties keep the hypothesis that was added first.
+        key = all_scores.clamp(min=torch.finfo(all_scores.dtype).min).masked_fill(~all_valid, -float('inf'))
+        order = torch.sort(key, dim=1, descending=True, stable=True)[1][:, :self.num_beams]
+
+        new_tokens = self.tokens.new_zeros((batch_size, num_new, self.tokens.size(-1)))
+        new_tokens[:, :, :hyp_length] = hyps
+        all_tokens = torch.cat((self.tokens, new_tokens), dim=1)
+        all_lengths = torch.cat((self.lengths, self.lengths.new_full((batch_size, num_new), hyp_length)), dim=1)
+        self.scores = all_scores.gather(1, order)
+        self.valid = all_valid.gather(1, order)
+        self.lengths = all_lengths.gather(1, order)
+        self.tokens = all_tokens.gather(1, order.unsqueeze(-1).expand(-1, -1, all_tokens.size(-1)))
+        if mems:
+            self._add_mems(mems, mem_indices, order)
+
+    def _add_mems(self, mems, mem_indices: torch.LongTensor, order: torch.LongTensor):
+        """Keep the memories [batch_size, num_beams, capacity, ...] of the hypotheses in `order`. The memories
+        grow at every step, the ones of older hypotheses are padded and their lengths are kept."""
+        batch_size, num_new = mem_indices.size()
+        mem_length = mems[0].size(1)
+        new_mems = [mem[mem_indices] for mem in mems]
+        if self.mems is None:
+            self.mems = [mem.new_zeros((batch_size, self.num_beams, mem_length) + mem.size()[2:]) for mem in mems]
+            self.mem_lengths = mem_indices.new_zeros((batch_size, self.num_beams))
+        capacity = self.mems[0].size(2)
+        if capacity < mem_length:
+            capacity = max(mem_length, 2 * capacity)
+            self.mems = [F.pad(mem, (0, 0) * (mem.dim() - 3) + (0, capacity - mem.size(2))) for mem in self.mems]
+        if mem_length < capacity:
+            new_mems = [F.pad(mem, (0, 0) * (mem.dim() - 3) + (0, capacity - mem_length)) for mem in new_mems]
+        batch_index = torch.arange(batch_size, device=order.device).unsqueeze(1)
+        self.mems = [torch.cat((mem, new_mem), dim=1)[batch_index, order] for mem, new_mem in zip(self.mems, new_mems)]
+        all_lengths = torch.cat((self.mem_lengths, self.mem_lengths.new_full((batch_size, num_new), mem_length)), dim=1)
+        self.mem_lengths = all_lengths.gather(1, order)
+
+    def is_done(self, best_sum_logprobs: torch.FloatTensor, cur_len: int) -> torch.BoolTensor:
+        """
+        If there are enough hypotheses and that none of the hypotheses being generated can become better than the worst
+        one in the heap, then we are done with this sentence.
+        """
+        is_full = self.valid.all(dim=1)
+        if self.early_stopping:
+            return is_full
+        worst_score = self.scores.masked_fill(~self.valid, float('inf')).min(dim=1)[0]
+        cur_score = best_sum_logprobs.float() / cur_len ** self.length_penalty
+        return is_full & (worst_score >= cur_score)
+
+
 class LogitsProcessor(ABC):
     """Abstract base class for all logit processors that can be applied during generation."""
 
@@ -398,6 +664,15 @@ class LogitsProcessor(ABC):
             f"{self.__class__} is an abstract class. Only classes inheriting this class can be called."
         )
 
+    def reorder(self, beam_idx: torch.LongTensor):
+        """Reorder the state of a stateful processor after beam search reshuffled the hypotheses."""
+        pass
+
+    def truncate(self, length: int):
+        """Drop the state of a stateful processor after the first :obj:`length` tokens, e.g. when speculative
+        decoding rejects the draft tokens it was called on."""
+        pass
+
 
 class LogitsProcessorList(list):
     """
@@ -412,6 +687,14 @@ class LogitsProcessorList(list):
             scores = processor(input_ids, scores)
         return scores
 
+    def reorder(self, beam_idx: torch.LongTensor):
+        for processor in self:
+            processor.reorder(beam_idx)
+
+    def truncate(self, length: int):
+        for processor in self:
+            processor.truncate(length)
+
 
 class MinLengthLogitsProcessor(LogitsProcessor):
     r"""
@@ -489,3 +772,73 @@ class NoRepeatNGramLogitsProcessor(LogitsProcessor):
 
         banned_tokens = [_get_generated_ngrams(hypo_idx) for hypo_idx in range(num_hypos)]
         return banned_tokens
+
+
+class IncrementalNoRepeatNGramLogitsProcessor(NoRepeatNGramLogitsProcessor):
+    r"""
+    Stateful version of :class:`NoRepeatNGramLogitsProcessor`. The n-grams of every hypothesis are kept in a tensor
+    and only the newest n-gram is added at each step, instead of rebuilding the n-gram dictionaries of all hypotheses
+    on the host. The banned tokens are found with one comparison against the stored n-grams and applied with a single
+    scatter.
+
+    When beam search reshuffles the hypotheses, :meth:`reorder` has to be called with the beam indices. When the last
+    tokens are replaced, e.g. the rejected draft tokens of speculative decoding, :meth:`truncate` has to be called with
+    the length of the kept prefix. The state is reset when the processor is called on a shorter sequence, i.e. at the
+    start of a new batch.
+
+    Args:
+        ngram_size (:obj:`int`):
+            All ngrams of size :obj:`ngram_size` can only occur once.
+    """
+
+    def __init__(self, ngram_size: int):
+        super().__init__(ngram_size)
+        self.reset()
+
+    def reset(self):
+        self._ngrams = None
+        self._num_ngrams = 0
+        self._cur_len = 0
+
+    def reorder(self, beam_idx: torch.LongTensor):
+        if self._ngrams is not None:
+            self._ngrams = self._ngrams[beam_idx]
+
+    def truncate(self, length: int):
+        # the n-grams are stored in the order of their last token
+        self._num_ngrams = min(self._num_ngrams, max(length - self.ngram_size + 1, 0))
+        self._cur_len = min(self._cur_len, length)
+
+    def _add_ngrams(self, input_ids: torch.LongTensor):
+        cur_len = input_ids.shape[-1]
+        ends = range(max(self._cur_len + 1, self.ngram_size), cur_len + 1)
+        if len(ends) == 0:
+            return
+        new_ngrams = torch.stack([input_ids[:, end - self.ngram_size:end] for end in ends], dim=1)
+        num_ngrams = self._num_ngrams + len(ends)
+        if self._ngrams is None:
+            self._ngrams = input_ids.new_empty((input_ids.size(0), max(num_ngrams, 16), self.ngram_size))
+        elif self._ngrams.size(1) < num_ngrams:
+            ngrams = self._ngrams.new_empty(
+                (self._ngrams.size(0), max(num_ngrams, 2 * self._ngrams.size(1)), self.ngram_size))
+            ngrams[:, :self._num_ngrams] = self._ngrams[:, :self._num_ngrams]
+            self._ngrams = ngrams
+        self._ngrams[:, self._num_ngrams:num_ngrams] = new_ngrams
+        self._num_ngrams = num_ngrams
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        cur_len = input_ids.shape[-1]
+        if cur_len < self._cur_len or (self._ngrams is not None and self._ngrams.size(0) != input_ids.size(0)):
+            self.reset()
+        self._add_ngrams(input_ids)
+        self._cur_len = cur_len
+        if cur_len + 1 < self.ngram_size or self._num_ngrams == 0:
+            return scores
+        ngrams = self._ngrams[:, :self._num_ngrams]
+        prefix = input_ids[:, cur_len + 1 - self.ngram_size:]
+        is_banned = (ngrams[:, :, :-1] == prefix.unsqueeze(1)).all(dim=-1)
+        # -inf is added to the banned tokens and 0 to the others
+        penalty = torch.zeros(is_banned.size(), dtype=scores.dtype, device=scores.device)
+        penalty.masked_fill_(is_banned, -float("inf"))
+        scores.scatter_add_(1, ngrams[:, :, -1], penalty)
+        return scores
@@ -0,0 +1,173 @@
+"""Memory-mapped checkpoint format.
+
+A `.tensors` file next to `mp_rank_XX_model_states.pt` holds the same checkpoint as
+  magic (8 bytes) | header length (8 bytes, little endian) | json header | data
+where the data are the raw bytes of the tensors of the model state dict, aligned to
+ALIGNMENT bytes, followed by the other sections (optimizer, lr scheduler, rng states),
+each pickled on its own. Loading maps the file and creates tensors on the mapped
+pages, so the model copies its parameters straight from the page cache, and a section
+is only unpickled when it is read.
+
+Convert the existing checkpoints with
+```shell
+python mmap_checkpoint.py CHECKPOINT_PATH
+```
+where `CHECKPOINT_PATH` is a `mp_rank_XX_model_states.pt` file, a checkpoint directory
+with the files of all model parallel ranks, or a save directory with a tracker file.
+"""
+import io
+import json
+import mmap
+import os
+import struct
+import sys
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import torch
+
+MAGIC = b'GLMMMAP1'
+ALIGNMENT = 64
+MODULE_KEY = 'module'
+
+
+def get_mmap_checkpoint_name(checkpoint_name):
+    return os.path.splitext(checkpoint_name)[0] + '.tensors'
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _tensor_bytes(tensor):
+    tensor = tensor.detach().cpu().contiguous().reshape(-1)
+    return tensor.view(torch.uint8).numpy()
+
+
+def save_mmap_checkpoint(sd, filename):
+    """Write the checkpoint dict `sd` in the memory-mapped format, atomically."""
+    tensors = OrderedDict((key, value) for key, value in sd[MODULE_KEY].items() if torch.is_tensor(value))
+    other_module_items = {key: value for key, value in sd[MODULE_KEY].items() if not torch.is_tensor(value)}
+    assert not other_module_items, f'Only tensors are supported in the module state dict, got {other_module_items}'
+    metadata, sections = {}, OrderedDict()
+    for key, value in sd.items():
+        if key == MODULE_KEY:
+            continue
+        if isinstance(value, (int, float, str)):
+            metadata[key] = value
+        else:
+            buffer = io.BytesIO()
+            torch.save(value, buffer)
+            sections[key] = buffer.getvalue()
+    header, offset = {'tensors': OrderedDict(), 'sections': OrderedDict(), 'metadata': metadata}, 0
+    for key, tensor in tensors.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        header['tensors'][key] = {'dtype': str(tensor.dtype).split('.')[-1], 'shape': list(tensor.size()),
+                                  'offset': offset, 'nbytes': nbytes}
+        offset = _align(offset + nbytes)
+    for key, blob in sections.items():
+        header['sections'][key] = {'offset': offset, 'nbytes': len(blob)}
+        offset = _align(offset + len(blob))
+    header = json.dumps(header).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header))
+    temp_name = filename + '.tmp'
+    with open(temp_name, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for value in list(tensors.values()) + list(sections.values()):
+            f.write(b'\0' * (data_start + _align(f.tell() - data_start) - f.tell()))
+            f.write(_tensor_bytes(value) if torch.is_tensor(value) else value)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_name, filename)
+
+
+class MmapCheckpoint(Mapping):
+    """Read-only view of a checkpoint in the memory-mapped format with the keys of the
+    pickled checkpoint dict. sd['module'] is a dict of tensors backed by the mapped file,
+    the other sections are unpickled when they are read for the first time."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            assert f.read(len(MAGIC)) == MAGIC, f'{filename} is not a memory-mapped checkpoint'
+            header_length = struct.unpack('<Q', f.read(8))[0]
+            self.header = json.loads(f.read(header_length).decode('utf-8'))
+            self.data_start = _align(len(MAGIC) + 8 + header_length)
+            # Copy-on-write pages are writable for torch.frombuffer, the file is never modified.
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.loaded = {}
+
+    def _module_state_dict(self):
+        state_dict = OrderedDict()
+        for key, info in self.header['tensors'].items():
+            dtype = getattr(torch, info['dtype'])
+            if info['nbytes'] == 0:
+                state_dict[key] = torch.empty(info['shape'], dtype=dtype)
+                continue
+            element_size = torch.empty((), dtype=dtype).element_size()
+            tensor = torch.frombuffer(self.buffer, dtype=dtype, offset=self.data_start + info['offset'],
+                                      count=info['nbytes'] // element_size)
+            state_dict[key] = tensor.view(info['shape'])
+        return state_dict
+
+    def __getitem__(self, key):
+        if key not in self.loaded:
+            if key == MODULE_KEY:
+                self.loaded[key] = self._module_state_dict()
+            elif key in self.header['metadata']:
+                return self.header['metadata'][key]
+            elif key in self.header['sections']:
+                info = self.header['sections'][key]
+                start = self.data_start + info['offset']
+                self.loaded[key] = torch.load(io.BytesIO(self.buffer[start: start + info['nbytes']]),
+                                              map_location='cpu')
+            else:
+                raise KeyError(key)
+        return self.loaded[key]
+
+    def __iter__(self):
+        yield MODULE_KEY
+        yield from self.header['metadata']
+        yield from self.header['sections']
+
+    def __len__(self):
+        return 1 + len(self.header['metadata']) + len(self.header['sections'])
+
+
+def load_checkpoint_file(checkpoint_name):
+    """Load `checkpoint_name`, from its memory-mapped version if it was converted
+    and the pickled file was not written again since."""
+    mmap_name = get_mmap_checkpoint_name(checkpoint_name)
+    if os.path.exists(mmap_name) and (not os.path.exists(checkpoint_name) or
+                                      os.path.getmtime(mmap_name) >= os.path.getmtime(checkpoint_name)):
+        return MmapCheckpoint(mmap_name)
+    return torch.load(checkpoint_name, map_location='cpu')
+
+
+def convert_checkpoint(checkpoint_name):
+    sd = torch.load(checkpoint_name, map_location='cpu')
+    mmap_name = get_mmap_checkpoint_name(checkpoint_name)
+    save_mmap_checkpoint(sd, mmap_name)
+    print(f'converted {checkpoint_name} to {mmap_name}')
+
+
+def main():
+    checkpoint_path = sys.argv[1]
+    if os.path.isdir(checkpoint_path):
+        tracker_filename = os.path.join(checkpoint_path, 'latest_checkpointed_iteration.txt')
+        if os.path.exists(tracker_filename):
+            with open(tracker_filename) as f:
+                checkpoint_path = os.path.join(checkpoint_path, f.read().strip())
+        filenames = sorted(filename for filename in os.listdir(checkpoint_path)
+                           if filename.startswith('mp_rank_') and filename.endswith('_model_states.pt'))
+        checkpoint_names = [os.path.join(checkpoint_path, filename) for filename in filenames]
+    else:
+        checkpoint_names = [checkpoint_path]
+    for checkpoint_name in checkpoint_names:
+        convert_checkpoint(checkpoint_name)
+
+
+if __name__ == '__main__':
+    main()
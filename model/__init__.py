@@ -14,6 +14,7 @@
 # limitations under the License.
 
 from .distributed import PyTorchDistributedDataParallel, DistributedDataParallel
-from .modeling_glm import GLMModel, glm_get_params_for_weight_decay_optimization
+from .modeling_glm import GLMModel, EncoderDecoder, glm_get_params_for_weight_decay_optimization, \
+    select_output_positions
 from .downstream import GLMForMultiTokenCloze, GLMForMultiTokenClozeFast, GLMForSingleTokenCloze, \
     GLMForSequenceClassification
@@ -17,7 +17,6 @@ import torch
 from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 import torch.distributed as dist
 from torch.nn.modules import Module
-from torch.autograd import Variable
 from torch.nn.parallel.distributed import DistributedDataParallel as DDP
 
 import mpu
@@ -36,58 +35,117 @@ class PyTorchDistributedDataParallel(DDP):
 
 
 class DistributedDataParallel(Module):
-
-    def __init__(self, module):
+    """Data parallel wrapper that all-reduces the gradients over the data parallel group in
+    buckets of at most `bucket_cap_mb` MB of one dtype, in the reverse order of the parameters,
+    which is about the order in which the backward pass produces the gradients.
+
+    With `overlap_allreduce`, a hook on the gradient accumulator of every parameter launches
+    the asynchronous all-reduce of a bucket as soon as all its gradients are ready, so that the
+    communication overlaps the rest of the backward pass. The gradients are then divided by the
+    data parallel world size before the reduction, in fp32 if `fp32_allreduce`, and
+    allreduce_params only launches the remaining buckets and waits for all of them.
+    """
+
+    def __init__(self, module, overlap_allreduce=False, bucket_cap_mb=25, fp32_allreduce=False):
         super(DistributedDataParallel, self).__init__()
-        self.warn_on_half = True if dist._backend == dist.dist_backend.GLOO else False
-
         self.module = module
         self.data_parallel_group = mpu.get_data_parallel_group()
+        self.warn_on_half = dist.get_backend(self.data_parallel_group) == dist.Backend.GLOO
+        self.overlap_allreduce = overlap_allreduce
+        self.fp32_allreduce = fp32_allreduce
+        self.needs_reduction = False
         src_rank = mpu.get_model_parallel_rank()
         for p in self.module.parameters():
             if torch.is_tensor(p):
                 dist.broadcast(p, src_rank, group=self.data_parallel_group)
 
+        # Buckets of parameters of the same type in reverse order.
+        self.buckets = []
+        bucket_cap, open_buckets = bucket_cap_mb * 1024 * 1024, {}
+        for param in reversed([param for param in self.module.parameters() if param.requires_grad]):
+            tp = param.data.type()
+            if tp not in open_buckets:
+                open_buckets[tp] = ([], [0])
+                self.buckets.append(open_buckets[tp][0])
+            bucket, size = open_buckets[tp]
+            bucket.append(param)
+            size[0] += param.numel() * param.element_size()
+            if size[0] >= bucket_cap:
+                del open_buckets[tp]
+        self.bucket_of_param = {param: i for i, bucket in enumerate(self.buckets) for param in bucket}
+        self._reset_buckets()
+
         def allreduce_params(reduce_after=True, no_scale=False, fp32_allreduce=False):
-            if (self.needs_reduction):
+            """Reduce the gradients of the last backward pass. The arguments only apply
+            without overlap_allreduce, where the buckets are reduced at this call."""
+            if self.needs_reduction:
                 self.needs_reduction = False
-                buckets = {}
-                for name, param in self.module.named_parameters():
-                    if param.requires_grad and param.grad is not None:
-                        tp = (param.data.type())
-                        if tp not in buckets:
-                            buckets[tp] = []
-                        buckets[tp].append(param)
                 if self.warn_on_half:
-                    if torch.cuda.HalfTensor in buckets:
+                    if any(bucket[0].data.type() == 'torch.cuda.HalfTensor' for bucket in self.buckets):
                         print("WARNING: gloo dist backend for half parameters may be extremely slow." +
                               " It is recommended to use the NCCL backend in this case.")
                         self.warn_on_half = False
-                for tp in buckets:
-                    bucket = buckets[tp]
-                    grads = [param.grad.data for param in bucket]
-                    coalesced = _flatten_dense_tensors(grads)
-                    if fp32_allreduce:
-                        coalesced = coalesced.float()
-                    if not no_scale and not reduce_after:
-                        coalesced /= dist.get_world_size(group=self.data_parallel_group)
-                    dist.all_reduce(coalesced, group=self.data_parallel_group)
-                    torch.cuda.synchronize()
-                    if not no_scale and reduce_after:
-                        coalesced /= dist.get_world_size(group=self.data_parallel_group)
-                    for buf, synced in zip(grads, _unflatten_dense_tensors(coalesced, grads)):
-                        buf.copy_(synced)
-
-        self.hook_handles = []
-        self.hooks = []
-        for param in list(self.module.parameters()):
-            def allreduce_hook(*unused):
-                Variable._execution_engine.queue_callback(allreduce_params)
-        #    handle = param.register_hook(allreduce_hook)
-        # self.hooks.append(allreduce_hook)
-        # self.hook_handles.append(handle)
+                if not self.overlap_allreduce:
+                    reduce_before = not no_scale and not reduce_after
+                    for i in range(len(self.buckets)):
+                        self._launch_bucket(i, fp32_allreduce=fp32_allreduce, scale=reduce_before)
+                    self._wait_buckets(scale=not no_scale and reduce_after)
+                else:
+                    # buckets with parameters that got no gradient in the backward pass are still pending
+                    for i in range(len(self.buckets)):
+                        if not self.launched[i]:
+                            self._launch_bucket(i, fp32_allreduce=self.fp32_allreduce, scale=True)
+                    self._wait_buckets(scale=False)
+                self._reset_buckets()
+
+        self.grad_accs = []
+        if self.overlap_allreduce:
+            for param in self.bucket_of_param:
+                # The hook of the AccumulateGrad node runs after the gradient is accumulated in param.grad.
+                grad_acc = param.expand_as(param).grad_fn.next_functions[0][0]
+                grad_acc.register_hook(self._make_hook(param))
+                self.grad_accs.append(grad_acc)
         self.allreduce_params = allreduce_params
 
+    def _reset_buckets(self):
+        self.ready = [set() for _ in self.buckets]
+        self.launched = [False] * len(self.buckets)
+        self.pending = []
+
+    def _make_hook(self, param):
+        bucket_id = self.bucket_of_param[param]
+
+        def allreduce_hook(*unused):
+            if not self.needs_reduction or self.launched[bucket_id]:
+                return
+            # a parameter used several times in the graph may call the hook more than once
+            self.ready[bucket_id].add(param)
+            if len(self.ready[bucket_id]) == len(self.buckets[bucket_id]):
+                self._launch_bucket(bucket_id, fp32_allreduce=self.fp32_allreduce, scale=True)
+
+        return allreduce_hook
+
+    def _launch_bucket(self, bucket_id, fp32_allreduce=False, scale=False):
+        self.launched[bucket_id] = True
+        grads = [param.grad.data for param in self.buckets[bucket_id] if param.grad is not None]
+        if not grads:
+            return
+        coalesced = _flatten_dense_tensors(grads)
+        if fp32_allreduce:
+            coalesced = coalesced.float()
+        if scale:
+            coalesced /= dist.get_world_size(group=self.data_parallel_group)
+        work = dist.all_reduce(coalesced, group=self.data_parallel_group, async_op=True)
+        self.pending.append((work, coalesced, grads))
+
+    def _wait_buckets(self, scale=False):
+        for work, coalesced, grads in self.pending:
+            work.wait()
+            if scale:
+                coalesced /= dist.get_world_size(group=self.data_parallel_group)
+            for buf, synced in zip(grads, _unflatten_dense_tensors(coalesced, grads)):
+                buf.copy_(synced)
+
     def forward(self, *inputs, **kwargs):
         self.needs_reduction = True
         return self.module(*inputs, **kwargs)
@@ -2,15 +2,16 @@
 
 import torch
 import torch.nn
-from .modeling_glm import GLMModel
+from .modeling_glm import GLMModel, select_output_positions
 
 
 class GLMForMultiTokenCloze(torch.nn.Module):
-    def __init__(self, language_model: GLMModel, take_softmax=True, length_penalty=0.0):
+    def __init__(self, language_model: GLMModel, take_softmax=True, length_penalty=0.0, share_context=False):
         super(GLMForMultiTokenCloze, self).__init__()
         self.model = language_model
         self.take_softmax = take_softmax
         self.length_penalty = length_penalty
+        self.share_context = share_context
 
     def state_dict(self, destination=None, prefix='', keep_vars=False):
         # [h.remove() for h in self.hook_handles]
@@ -23,11 +24,19 @@ class GLMForMultiTokenCloze(torch.nn.Module):
     def named_parameters(self, prefix: str = '', recurse: bool = True):
         return self.model.named_parameters(prefix=prefix, recurse=recurse)
 
-    def forward(self, input_ids, position_ids, attention_mask, target_ids=None, logit_mask=None, prompt_pos=None):
+    def forward(self, input_ids, position_ids, attention_mask, target_ids=None, logit_mask=None, prompt_pos=None,
+                output_positions=None):
         if target_ids == None:
-            return self.model(input_ids, position_ids, attention_mask)
+            return self.model(input_ids, position_ids, attention_mask, output_positions=output_positions)
         num_choices = None
         if len(input_ids.shape) == 3:
+            if self.share_context:
+                packed_inputs = self.pack_choices(input_ids, position_ids, attention_mask, target_ids, logit_mask)
+                if packed_inputs is not None:
+                    if prompt_pos is not None:
+                        # the prompt is in the shared context
+                        prompt_pos = prompt_pos[:, 0]
+                    return self.packed_forward(*packed_inputs, logit_mask, prompt_pos=prompt_pos)
             batch_size, num_choices = input_ids.shape[:2]
             input_ids = input_ids.reshape(-1, input_ids.size(-1))
             attention_mask = attention_mask.reshape(-1, *attention_mask.size()[2:])
@@ -36,9 +45,14 @@ class GLMForMultiTokenCloze(torch.nn.Module):
             logit_mask = logit_mask.reshape(-1, logit_mask.size(-1))
             if prompt_pos is not None:
                 prompt_pos = prompt_pos.reshape(-1, prompt_pos.size(-1))
-        outputs, *mems = self.model(input_ids, position_ids, attention_mask, prompt_pos=prompt_pos)
+        # only the logits of the target positions are computed
+        output_positions = select_output_positions(logit_mask)
+        outputs, *mems = self.model(input_ids, position_ids, attention_mask, prompt_pos=prompt_pos,
+                                    output_positions=output_positions)
         if self.take_softmax:
             outputs = torch.nn.functional.log_softmax(outputs, dim=-1)
+        target_ids = target_ids.gather(1, output_positions)
+        logit_mask = logit_mask.gather(1, output_positions)
         # select the target logits
         batch_ids = torch.arange(target_ids.size(0), dtype=torch.long, device=target_ids.device)
         batch_ids = batch_ids.unsqueeze(1).expand_as(target_ids)
@@ -52,6 +66,71 @@ class GLMForMultiTokenCloze(torch.nn.Module):
             logits = logits.view(-1, num_choices)
         return (logits, *mems)
 
+    @staticmethod
+    def pack_choices(input_ids, position_ids, attention_mask, target_ids, logit_mask):
+        """Pack the choices of every sample into a single sequence [context | span 1 | span 2 | ...],
+        so that the shared context is encoded only once. Every span attends to the context and
+        causally to itself, which is the attention of the unpacked inputs.
+        Returns None if the choices of a sample do not share the context, or if the packed
+        attention would cost more than the unpacked one."""
+        if attention_mask.dim() != 2:
+            return None
+        batch_size, num_choices, seq_length = input_ids.size()
+        device = input_ids.device
+        sep = attention_mask[:, :1].unsqueeze(-1)
+        columns = torch.arange(seq_length, device=device)
+        is_context = columns < sep
+        is_span = logit_mask != 0
+        span_lengths = is_span.long().sum(dim=-1)
+        # the targets of every choice must directly follow the context
+        spans_after_context = is_span == (~is_context & (columns < sep + span_lengths.unsqueeze(-1)))
+        same_context = (input_ids == input_ids[:, :1]) | ~is_context
+        shareable = (attention_mask == sep.squeeze(-1)).all() & spans_after_context.all() & same_context.all()
+        packed_lengths = sep.view(-1) + span_lengths.sum(dim=1)
+        shareable, packed_length = torch.stack((shareable.long(), packed_lengths.max())).tolist()
+        if not shareable or packed_length ** 2 > num_choices * seq_length ** 2:
+            return None
+        # the index of every input token in the packed sequence, the others go to the extra last column
+        offsets = sep.squeeze(-1) + span_lengths.cumsum(dim=1) - span_lengths
+        index = torch.where(is_span, offsets.unsqueeze(-1) + columns - sep, columns.expand_as(input_ids))
+        choice_ids = torch.arange(num_choices, device=device).view(1, -1, 1).expand_as(input_ids)
+        index = torch.where(is_span | (is_context & (choice_ids == 0)), index, index.new_full((), packed_length))
+        index = index.view(batch_size, -1)
+
+        def pack(tensor, value=0):
+            packed = tensor.new_full((batch_size, packed_length + 1), value)
+            packed.scatter_(1, index, tensor.reshape(batch_size, -1))
+            return packed[:, :-1]
+
+        packed_ids, packed_targets, packed_mask = pack(input_ids), pack(target_ids), pack(logit_mask)
+        packed_choices = pack(torch.where(is_span, choice_ids, choice_ids.new_full((), -1)), value=-1)
+        if position_ids.dim() == 4:
+            packed_positions = torch.stack([pack(position_ids[:, :, i]) for i in range(position_ids.size(2))], dim=1)
+        else:
+            packed_positions = pack(position_ids)
+        ids = torch.arange(packed_length, device=device)
+        visible = (ids < sep).expand(-1, packed_length, -1)
+        same_span = (packed_choices.unsqueeze(2) == packed_choices.unsqueeze(1)) & (packed_choices.unsqueeze(2) >= 0)
+        packed_attention_mask = (visible | (same_span & (ids.view(-1, 1) >= ids))).unsqueeze(1).long()
+        return packed_ids, packed_positions, packed_attention_mask, packed_targets, packed_mask, packed_choices
+
+    def packed_forward(self, input_ids, position_ids, attention_mask, target_ids, logit_mask, choice_ids,
+                       choice_logit_mask, prompt_pos=None):
+        """Score the packed choices of pack_choices, choice_logit_mask is the [b, c, s] unpacked logit mask."""
+        output_positions = select_output_positions(logit_mask)
+        outputs, *mems = self.model(input_ids, position_ids, attention_mask, prompt_pos=prompt_pos,
+                                    output_positions=output_positions)
+        if self.take_softmax:
+            outputs = torch.nn.functional.log_softmax(outputs, dim=-1)
+        target_ids = target_ids.gather(1, output_positions)
+        logit_mask = logit_mask.gather(1, output_positions)
+        choice_ids = choice_ids.gather(1, output_positions).clamp(min=0)
+        token_logits = outputs.gather(2, target_ids.unsqueeze(-1)).squeeze(-1) * logit_mask
+        logits = token_logits.new_zeros(choice_logit_mask.size()[:2]).scatter_add_(1, choice_ids, token_logits)
+        if self.length_penalty > 0.0:
+            logits = logits / choice_logit_mask.sum(dim=-1) ** self.length_penalty
+        return (logits, *mems)
+
 
 class GLMForMultiTokenClozeFast(torch.nn.Module):
     def __init__(self, language_model, take_softmax=True, length_penalty=0.0):
@@ -128,13 +207,16 @@ class GLMForSingleTokenCloze(torch.nn.Module):
     def named_parameters(self, prefix: str = '', recurse: bool = True):
         return self.model.named_parameters(prefix=prefix, recurse=recurse)
 
-    def forward(self, input_ids, position_ids, attention_mask, target_ids=None, logit_mask=None, prompt_pos=None):
+    def forward(self, input_ids, position_ids, attention_mask, target_ids=None, logit_mask=None, prompt_pos=None,
+                output_positions=None):
         if target_ids is None:
-            return self.model(input_ids, position_ids, attention_mask)
+            return self.model(input_ids, position_ids, attention_mask, output_positions=output_positions)
         assert len(input_ids.shape) == 2
-        outputs, *mems = self.model(input_ids, position_ids, attention_mask, prompt_pos=prompt_pos)
+        # only the logits at the separation position are computed
+        outputs, *mems = self.model(input_ids, position_ids, attention_mask, prompt_pos=prompt_pos,
+                                    output_positions=attention_mask.unsqueeze(1))
         batch_ids = torch.arange(outputs.size(0), dtype=attention_mask.dtype, device=attention_mask.device)
-        target_logits = outputs[batch_ids, attention_mask]
+        target_logits = outputs[:, 0]
         if self.take_softmax:
             target_prob = torch.nn.functional.log_softmax(target_logits, dim=-1)
         else:
@@ -164,17 +246,18 @@ class GLMForSequenceClassification(torch.nn.Module):
             input_ids = input_ids.reshape(-1, input_ids.size(-1))
             attention_mask = attention_mask.reshape(-1, *attention_mask.size()[2:])
             position_ids = position_ids.reshape(-1, *position_ids.size()[2:])
-        outputs, *mems = self.model(input_ids, position_ids, attention_mask)
+        # Only the pooled position is computed in the last layer if the language model prunes its queries.
         if self.pool_token == 'start':
-            output = outputs[
-                torch.arange(outputs.size(0), dtype=attention_mask.dtype, device=attention_mask.device), attention_mask]
+            pool_positions = attention_mask
         elif self.pool_token == 'pad':
-            output = outputs[torch.arange(outputs.size(0), dtype=attention_mask.dtype,
-                                          device=attention_mask.device), attention_mask - 1]
+            pool_positions = attention_mask - 1
         elif self.pool_token == 'cls':
-            output = outputs[:, 0]
+            pool_positions = torch.zeros(input_ids.size(0), dtype=torch.long, device=input_ids.device)
         else:
             raise NotImplementedError
+        outputs, *mems = self.model(input_ids, position_ids, attention_mask,
+                                    output_positions=pool_positions.long().view(-1, 1))
+        output = outputs[:, 0]
         output = torch.tanh(self.pool_layer(output))
         multichoice_output = self.multichoice_dropout(output)
         logits = self.multichoice_head(multichoice_output)
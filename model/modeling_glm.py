@@ -63,6 +63,10 @@ class GLMModel(torch.nn.Module):
                  spell_length=None,
                  spell_func='lstm',
                  attention_scale=1.0,
+                 performer=False,
+                 performer_num_features=256,
+                 attention_backend='auto',
+                 prune_queries=False,
                  ):
 
         super(GLMModel, self).__init__()
@@ -90,7 +94,11 @@ class GLMModel(torch.nn.Module):
                                                        checkpoint_num_layers,
                                                        attention_scale=attention_scale,
                                                        relative_encoding=relative_encoding,
-                                                       block_position_encoding=block_position_encoding)
+                                                       block_position_encoding=block_position_encoding,
+                                                       performer=performer,
+                                                       performer_num_features=performer_num_features,
+                                                       attention_backend=attention_backend,
+                                                       prune_queries=prune_queries)
         if spell_length is not None:
             self.prompt_spell = PromptSpell(spell_length, self.hidden_size, spell_func)
 
@@ -104,20 +112,34 @@ class GLMModel(torch.nn.Module):
                 self.transformer.layers[i].requires_grad_(True)
         print_rank_0(log_str)
 
+    def quantize_int8(self):
+        """Quantize the weights of the parallel linear layers and of the word
+        embeddings, which are also the output layer, to int8 for inference."""
+        num_bytes = 0
+        for module in self.modules():
+            if isinstance(module, (mpu.ColumnParallelLinear, mpu.RowParallelLinear, mpu.VocabParallelEmbedding)):
+                num_bytes += module.weight.numel() * module.weight.element_size()
+                mpu.quantize_int8_(module)
+                num_bytes -= module.weight.numel() + module.weight_scale.numel() * module.weight_scale.element_size()
+        print_rank_0(f"Quantize the weights to int8, saved {num_bytes / 2 ** 20:.1f} MB per partition")
+
     def forward(self, input_ids, position_ids, attention_mask, *mems, return_memory=False, detach_memory=True,
-                prompt_pos=None):
+                prompt_pos=None, kv_cache=None, output_positions=None):
         # Embeddings.
         batch_size = input_ids.size(0)
         words_embeddings = self.word_embeddings(input_ids)
         embeddings = words_embeddings
         if prompt_pos is not None:
-            embeddings = embeddings.clone()
+            if torch.is_grad_enabled():
+                embeddings = embeddings.clone()
             prompt_embeds = self.prompt_spell()
             batch_index = torch.arange(batch_size, device=input_ids.device).unsqueeze(1)
             embeddings[batch_index, prompt_pos] = prompt_embeds
         # Transformer.
         transformer_output = self.transformer(embeddings, position_ids, attention_mask, mems,
-                                              return_memory=return_memory, detach_memory=detach_memory)
+                                              return_memory=return_memory, detach_memory=detach_memory,
+                                              kv_cache=kv_cache, output_positions=output_positions)
+        # Only the outputs at output_positions [b, k] are projected to the vocabulary.
         logits, hidden_layers = transformer_output
         outputs = hidden_layers
 
@@ -125,7 +147,11 @@ class GLMModel(torch.nn.Module):
             # Parallel logits.
             logits_parallel = mpu.copy_to_model_parallel_region(
                 logits)
-            logits_parallel = F.linear(logits_parallel, self.word_embeddings.weight)
+            if self.word_embeddings.weight.dtype == torch.int8:
+                logits_parallel = mpu.int8_linear(logits_parallel, self.word_embeddings.weight,
+                                                  self.word_embeddings.weight_scale)
+            else:
+                logits_parallel = F.linear(logits_parallel, self.word_embeddings.weight)
 
             if self.parallel_output:
                 return (logits_parallel, *outputs)
@@ -135,6 +161,18 @@ class GLMModel(torch.nn.Module):
             return (logits, *outputs)
 
 
+def select_output_positions(mask):
+    """Return the indices [b, k] of the nonzero entries of every row of
+    `mask` [b, s] in increasing order, where k is the largest number of
+    nonzero entries of a row. The shorter rows are padded with indices of
+    zero entries, so that gathering `mask` with the result keeps the zeros."""
+    seq_length = mask.size(1)
+    is_zero = (mask == 0).long()
+    num_positions = max(seq_length - is_zero.sum(dim=1).min().item(), 1)
+    key = is_zero * seq_length + torch.arange(seq_length, device=mask.device)
+    return key.topk(num_positions, dim=1, largest=False, sorted=True)[1]
+
+
 class EncoderDecoder(torch.nn.Module):
     """Seq2Seq Transformer Model
     The output of the forward method are the logits (parallel or serial depending on the `parallel_output` flag).
@@ -196,7 +234,11 @@ class EncoderDecoder(torch.nn.Module):
 
         # Transformer.
         encoder_output, _ = self.encoder(source_embeddings, source_position_ids, source_mask)
-        decoder_output, _ = self.decoder(target_embeddings, target_position_ids, target_mask)
+        decoder_output, _ = self.decoder(target_embeddings, target_position_ids, target_mask,
+                                         encoder_states=encoder_output)
+        return self._output(decoder_output)
+
+    def _output(self, decoder_output):
         if self.output_predict:
             # Parallel logits.
             output_parallel = mpu.copy_to_model_parallel_region(decoder_output)
@@ -209,6 +251,24 @@ class EncoderDecoder(torch.nn.Module):
         else:
             return (decoder_output,)
 
+    def encode(self, source_ids, source_position_ids, source_mask, max_length):
+        """Encode the source for incremental decoding.
+        Returns the encoder output and a key/value cache of up to `max_length`
+        target tokens, which is passed to every decode_step."""
+        source_embeddings = self.word_embeddings(source_ids)
+        encoder_output, _ = self.encoder(source_embeddings, source_position_ids, source_mask)
+        return encoder_output, mpu.KeyValueCache(len(self.decoder.layers), max_length)
+
+    def decode_step(self, target_ids, target_position_ids, target_mask, kv_cache, encoder_output=None):
+        """Run the decoder on the new target tokens [b, s] after the ones in kv_cache.
+        The cross-attention keys and values of the encoder output are computed
+        at the first step and kept in kv_cache, so encoder_output is only needed
+        then. Reorder kv_cache to expand or reshuffle the beams."""
+        target_embeddings = self.word_embeddings(target_ids)
+        decoder_output, _ = self.decoder(target_embeddings, target_position_ids, target_mask,
+                                         encoder_states=encoder_output, kv_cache=kv_cache)
+        return self._output(decoder_output)
+
 
 def glm_get_params_for_weight_decay_optimization(module):
     weight_decay_params = {'params': []}
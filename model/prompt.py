@@ -25,6 +25,9 @@ class PromptSpell(torch.nn.Module):
                                                 torch.nn.Linear(self.hidden_size, self.hidden_size))
         elif self.spell_func != "none":
             raise NotImplementedError("Prompt function " + self.spell_func)
+        # The prompt embeddings computed in eval mode and the parameter versions they were computed from.
+        self._cached_embeds = None
+        self._cached_key = None
 
     def init_embedding(self, word_embeddings=None, task_tokens=None):
         num_words = 5000
@@ -41,7 +44,25 @@ class PromptSpell(torch.nn.Module):
                     target_embedding = word_embedding * ratio + task_embedding * (1 - ratio)
                 self.spell_embeddings.weight.data[i] = target_embedding
 
+    def train(self, mode=True):
+        self._cached_embeds, self._cached_key = None, None
+        return super(PromptSpell, self).train(mode)
+
+    def _parameters_key(self):
+        # Optimizer steps and checkpoint loading bump the version counters,
+        # moving or casting the module changes the storage.
+        return tuple((param.data_ptr(), param._version) for param in self.parameters())
+
     def forward(self):
+        if self.training or torch.is_grad_enabled():
+            return self._spell()
+        # The parameters are constant in inference, the embeddings are computed once.
+        key = self._parameters_key()
+        if self._cached_embeds is None or self._cached_key != key:
+            self._cached_embeds, self._cached_key = self._spell(), key
+        return self._cached_embeds
+
+    def _spell(self):
         prompt_embeds = self.spell_embeddings.weight.unsqueeze(0)
         if self.spell_func == "lstm":
             prompt_embeds = self.lstm_head(prompt_embeds)[0]
@@ -30,6 +30,8 @@ from .initialize import get_model_parallel_rank
 from .initialize import get_model_parallel_src_rank
 from .initialize import get_model_parallel_world_size
 from .initialize import initialize_model_parallel
+from .initialize import initialize_single_process
+from .initialize import is_single_process
 from .initialize import model_parallel_is_initialized
 
 from .layers import ColumnParallelLinear
@@ -42,10 +44,14 @@ from .mappings import gather_from_model_parallel_region
 from .mappings import reduce_from_model_parallel_region
 from .mappings import scatter_to_model_parallel_region
 
+from .quantization import int8_linear
+from .quantization import quantize_int8_
+
 from .random import checkpoint
 from .random import partition_activations_in_checkpoint
 from .random import get_cuda_rng_tracker
 from .random import model_parallel_cuda_manual_seed
 
 from .transformer import GPT2ParallelTransformer
+from .transformer import KeyValueCache
 from .transformer import LayerNorm
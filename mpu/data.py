@@ -18,6 +18,7 @@ import torch
 from .initialize import get_model_parallel_group
 from .initialize import get_model_parallel_rank
 from .initialize import get_model_parallel_src_rank
+from .initialize import is_single_process
 
 
 _MAX_DATA_DIM = 5
@@ -83,6 +84,11 @@ def broadcast_data(keys, data, datatype):
         datatype: torch data type of all tensors in data associated
                   with keys.
     """
+    if is_single_process():
+        # Nothing to broadcast, the data stays on the cpu.
+        _check_data_types(keys, data, datatype)
+        return {key: data[key] for key in keys}
+
     # Build (key, size) and (key, number of elements) dictionaries along
     # with the total number of elements on all ranks.
     key_size, key_numel, total_numel = _build_key_size_numel_dictionaries(keys,
@@ -40,35 +40,38 @@ def clip_grad_norm(parameters, max_norm, norm_type=2):
             infinity norm.
 
     Returns:
-        Total norm of the parameters (viewed as a single vector).
+        Total norm of the parameters (viewed as a single vector), as a
+        one-element tensor. The norm and the clipping stay on the device,
+        so that no host synchronization is needed.
     """
     if isinstance(parameters, torch.Tensor):
         parameters = [parameters]
     parameters = list(filter(lambda p: p.grad is not None, parameters))
+    if not parameters:
+        return torch.zeros(1)
     max_norm = float(max_norm)
     norm_type = float(norm_type)
+    device = parameters[0].grad.device
     if norm_type == inf:
-        total_norm = max(p.grad.data.abs().max() for p in parameters)
-        total_norm_cuda = torch.cuda.FloatTensor([float(total_norm)])
+        total_norm = torch.stack([p.grad.data.abs().max().float() for p in parameters]).max().view(1)
         # Take max across all GPUs.
-        torch.distributed.all_reduce(total_norm_cuda,
+        torch.distributed.all_reduce(total_norm,
                                      op=torch.distributed.ReduceOp.MAX,
                                      group=get_model_parallel_group())
-        total_norm = total_norm_cuda[0].item()
     else:
-        total_norm = 0
-        for p in parameters:
-            if p.model_parallel or (get_model_parallel_rank() == 0):
-                param_norm = p.grad.data.norm(norm_type)
-                total_norm += param_norm.item() ** norm_type
+        param_norms = [p.grad.data.norm(norm_type).float() for p in parameters
+                       if p.model_parallel or (get_model_parallel_rank() == 0)]
+        if param_norms:
+            total_norm = torch.stack(param_norms).pow(norm_type).sum().view(1)
+        else:
+            total_norm = torch.zeros(1, device=device)
         # Sum across all model parallel GPUs.
-        total_norm_cuda = torch.cuda.FloatTensor([float(total_norm)])
-        torch.distributed.all_reduce(total_norm_cuda,
+        torch.distributed.all_reduce(total_norm,
                                      op=torch.distributed.ReduceOp.SUM,
                                      group=get_model_parallel_group())
-        total_norm = total_norm_cuda[0].item() ** (1. / norm_type)
-    clip_coef = max_norm / (total_norm + 1e-6)
-    if clip_coef < 1:
-        for p in parameters:
-            p.grad.data.mul_(clip_coef)
+        total_norm = total_norm.pow(1. / norm_type)
+    # The gradients are scaled by min(clip_coef, 1) instead of checking clip_coef on the host.
+    clip_coef = (max_norm / (total_norm + 1e-6)).clamp(max=1.0)
+    for p in parameters:
+        p.grad.data.mul_(clip_coef.to(p.grad.dtype))
     return total_norm
@@ -25,6 +25,8 @@ from .utils import ensure_divisibility
 _MODEL_PARALLEL_GROUP = None
 # Data parallel group that the current rank belongs to.
 _DATA_PARALLEL_GROUP = None
+# Whether the model runs in a single process without torch.distributed.
+_SINGLE_PROCESS = False
 
 
 def initialize_model_parallel(model_parallel_size_):
@@ -78,8 +80,23 @@ def initialize_model_parallel(model_parallel_size_):
             _MODEL_PARALLEL_GROUP = group
 
 
+def initialize_single_process():
+    """Run in a single process without torch.distributed, e.g. for inference on
+    CPU. The model and data parallel sizes are 1 and the groups are None, so
+    all the model parallel communications are skipped."""
+    global _SINGLE_PROCESS
+    _SINGLE_PROCESS = True
+
+
+def is_single_process():
+    """Check if the model runs in a single process without torch.distributed."""
+    return _SINGLE_PROCESS
+
+
 def model_parallel_is_initialized():
     """Check if model and data parallel groups are initialized."""
+    if _SINGLE_PROCESS:
+        return True
     if _MODEL_PARALLEL_GROUP is None or _DATA_PARALLEL_GROUP is None:
         return False
     return True
@@ -87,6 +104,8 @@ def model_parallel_is_initialized():
 
 def get_model_parallel_group():
     """Get the model parallel group the caller rank belongs to."""
+    if _SINGLE_PROCESS:
+        return None
     assert _MODEL_PARALLEL_GROUP is not None, \
         'model parallel group is not initialized'
     return _MODEL_PARALLEL_GROUP
@@ -94,6 +113,8 @@ def get_model_parallel_group():
 
 def get_data_parallel_group():
     """Get the data parallel group the caller rank belongs to."""
+    if _SINGLE_PROCESS:
+        return None
     assert _DATA_PARALLEL_GROUP is not None, \
         'data parallel group is not initialized'
     return _DATA_PARALLEL_GROUP
@@ -101,17 +122,23 @@ def get_data_parallel_group():
 
 def get_model_parallel_world_size():
     """Return world size for the model parallel group."""
+    if _SINGLE_PROCESS:
+        return 1
     return torch.distributed.get_world_size(group=get_model_parallel_group())
 
 
 def get_model_parallel_rank():
     """Return my rank for the model parallel group."""
+    if _SINGLE_PROCESS:
+        return 0
     return torch.distributed.get_rank(group=get_model_parallel_group())
 
 
 def get_model_parallel_src_rank():
     """Calculate the global rank corresponding to a local rank zeor
     in the model parallel group."""
+    if _SINGLE_PROCESS:
+        return 0
     global_rank = torch.distributed.get_rank()
     local_world_size = get_model_parallel_world_size()
     return (global_rank // local_world_size) * local_world_size
@@ -119,11 +146,15 @@ def get_model_parallel_src_rank():
 
 def get_data_parallel_world_size():
     """Return world size for the data parallel group."""
+    if _SINGLE_PROCESS:
+        return 1
     return torch.distributed.get_world_size(group=get_data_parallel_group())
 
 
 def get_data_parallel_rank():
     """Return my rank for the data parallel group."""
+    if _SINGLE_PROCESS:
+        return 0
     return torch.distributed.get_rank(group=get_data_parallel_group())
 
 
@@ -133,3 +164,5 @@ def destroy_model_parallel():
     _MODEL_PARALLEL_GROUP = None
     global _DATA_PARALLEL_GROUP
     _DATA_PARALLEL_GROUP = None
+    global _SINGLE_PROCESS
+    _SINGLE_PROCESS = False
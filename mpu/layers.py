@@ -29,6 +29,8 @@ from .mappings import copy_to_model_parallel_region
 from .mappings import gather_from_model_parallel_region
 from .mappings import reduce_from_model_parallel_region
 from .mappings import scatter_to_model_parallel_region
+from .quantization import int8_embedding
+from .quantization import int8_linear
 from .utils import divide
 from .utils import VocabUtility
 
@@ -116,10 +118,13 @@ class VocabParallelEmbedding(torch.nn.Module):
         masked_input = input_.clone() - self.vocab_start_index
         masked_input[input_mask] = 0
         # Get the embeddings.
-        output_parallel = F.embedding(masked_input, self.weight,
-                                      self.padding_idx, self.max_norm,
-                                      self.norm_type, self.scale_grad_by_freq,
-                                      self.sparse)
+        if self.weight.dtype == torch.int8:
+            output_parallel = int8_embedding(masked_input, self.weight, self.weight_scale)
+        else:
+            output_parallel = F.embedding(masked_input, self.weight,
+                                          self.padding_idx, self.max_norm,
+                                          self.norm_type, self.scale_grad_by_freq,
+                                          self.sparse)
         # Mask the output embedding.
         output_parallel[input_mask, :] = 0.0
         # Reduce across all the model parallel GPUs.
@@ -234,7 +239,10 @@ class ColumnParallelLinear(torch.nn.Module):
         # Set up backprop all-reduce.
         input_parallel = copy_to_model_parallel_region(input_)
         # Matrix multiply.
-        output_parallel = F.linear(input_parallel, self.weight, self.bias)
+        if self.weight.dtype == torch.int8:
+            output_parallel = int8_linear(input_parallel, self.weight, self.weight_scale, self.bias)
+        else:
+            output_parallel = F.linear(input_parallel, self.weight, self.bias)
         if self.gather_output:
             # All-gather across the partitions.
             output = gather_from_model_parallel_region(output_parallel)
@@ -310,7 +318,10 @@ class RowParallelLinear(torch.nn.Module):
         else:
             input_parallel = scatter_to_model_parallel_region(input_)
         # Matrix multiply.
-        output_parallel = F.linear(input_parallel, self.weight)
+        if self.weight.dtype == torch.int8:
+            output_parallel = int8_linear(input_parallel, self.weight, self.weight_scale)
+        else:
+            output_parallel = F.linear(input_parallel, self.weight)
         # All-reduce across all the partitions.
         output_ = reduce_from_model_parallel_region(output_parallel)
         if self.bias is not None:
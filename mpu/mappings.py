@@ -16,6 +16,7 @@
 import torch
 
 from .initialize import get_model_parallel_group
+from .initialize import get_model_parallel_world_size
 from .utils import split_tensor_along_last_dim
 
 
@@ -24,7 +25,7 @@ def _reduce(input_):
     group = get_model_parallel_group()
 
     # Bypass the function if we are using only 1 GPU.
-    if torch.distributed.get_world_size(group=group) == 1:
+    if get_model_parallel_world_size() == 1:
         return input_
 
     # All-reduce.
@@ -39,7 +40,7 @@ def _split(input_):
     group = get_model_parallel_group()
 
     # Bypass the function if we are using only 1 GPU.
-    if torch.distributed.get_world_size(group=group) == 1:
+    if get_model_parallel_world_size() == 1:
         return input_
 
     # Split along last dimension.
@@ -58,7 +59,7 @@ def _gather(input_):
     group = get_model_parallel_group()
 
     # Bypass the function if we are using only 1 GPU.
-    if torch.distributed.get_world_size(group=group) == 1:
+    if get_model_parallel_world_size() == 1:
         return input_
 
     # Size and dimension.
@@ -0,0 +1,44 @@
+# coding=utf-8
+
+"""Weight-only int8 quantization of the model parallel layers for inference."""
+
+import torch
+import torch.nn.functional as F
+
+
+def quantize_weight(weight):
+    """Symmetric int8 quantization of the rows of a 2D weight, which are the
+    output channels of F.linear and the entries of an embedding.
+    Returns the int8 weight and the fp32 scale of every row."""
+    weight = weight.detach().float()
+    scale = weight.abs().max(dim=1)[0].clamp(min=1e-8) / 127.0
+    weight_int8 = torch.round(weight / scale.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+    return weight_int8, scale
+
+
+def quantize_int8_(module):
+    """Replace the `weight` parameter of a module by an int8 `weight` buffer and
+    a `weight_scale` buffer in the dtype of the original weight. Every model
+    parallel partition quantizes the rows of its own weight, so the
+    partitioning is kept as is."""
+    weight_int8, scale = quantize_weight(module.weight)
+    scale = scale.to(module.weight.dtype)
+    del module.weight
+    module.register_buffer('weight', weight_int8)
+    module.register_buffer('weight_scale', scale)
+
+
+def int8_linear(input_, weight, weight_scale, bias=None):
+    """F.linear with an int8 weight. The weight is dequantized on the fly and
+    the per-row scale is applied to the output columns instead of the weight."""
+    output = F.linear(input_, weight.to(input_.dtype)) * weight_scale.to(input_.dtype)
+    if bias is not None:
+        output = output + bias
+    return output
+
+
+def int8_embedding(input_, weight, weight_scale):
+    """F.embedding with an int8 weight. The output has the dtype of the scale,
+    which is the dtype of the original weight."""
+    output = F.embedding(input_, weight).to(weight_scale.dtype)
+    return output * F.embedding(input_, weight_scale.unsqueeze(1))
@@ -169,6 +169,10 @@ class CudaRNGStatesTracker:
     def fork(self, name=_MODEL_PARALLEL_RNG_TRACKER_NAME):
         """Fork the cuda rng state, perform operations, and exit with
         the original state."""
+        if not torch.cuda.is_available():
+            # Running on cpu, there is no cuda rng state to fork.
+            yield
+            return
         # Check if we have added the state
         if name not in self.states_:
             raise Exception('cuda rng state {} is not added'.format(name))
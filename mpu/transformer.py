@@ -54,6 +54,88 @@ class PositionalEmbedding(torch.nn.Module):
             return pos_emb[None, :, :]
 
 
+class KeyValueCache(object):
+    """Preallocated key/value buffers for incremental decoding.
+
+    The hidden states kept as memory are projected to keys and values
+    again by every layer at every step. Instead, this cache stores the
+    projected keys and values of each self-attention layer in a buffer
+    of size [b, np, max_length, hn], so that a decoding step only
+    projects the new tokens. For the decoder layers of an encoder-decoder,
+    the cache also keeps the cross-attention keys and values of the encoder
+    output, which are projected once per source.
+    Arguments:
+        num_layers: number of transformer layers.
+        max_length: maximum number of positions (context and generated
+                    tokens) that can be cached.
+    """
+
+    def __init__(self, num_layers, max_length):
+        self.num_layers = num_layers
+        self.max_length = max_length
+        self.length = 0
+        self.keys = [None] * num_layers
+        self.values = [None] * num_layers
+        self.cross_keys = [None] * num_layers
+        self.cross_values = [None] * num_layers
+
+    def update(self, layer_id, key_layer, value_layer):
+        """Write the keys and values [b, np, s, hn] of the new tokens of a
+        layer and return the keys and values of all the cached positions."""
+        start, end = self.length, self.length + key_layer.size(2)
+        if end > self.max_length:
+            raise ValueError(f"Key/value cache overflow: {end} positions > max length {self.max_length}")
+        if self.keys[layer_id] is None:
+            buffer_size = key_layer.size()[:2] + (self.max_length, key_layer.size(3))
+            self.keys[layer_id] = key_layer.new_empty(buffer_size)
+            self.values[layer_id] = value_layer.new_empty(buffer_size)
+        keys, values = self.keys[layer_id], self.values[layer_id]
+        keys[:, :, start:end] = key_layer
+        values[:, :, start:end] = value_layer
+        return keys[:, :, :end], values[:, :, :end]
+
+    def get_cross(self, layer_id):
+        """Return the cross-attention keys and values of a layer, or None if not cached yet."""
+        if self.cross_keys[layer_id] is None:
+            return None
+        return self.cross_keys[layer_id], self.cross_values[layer_id]
+
+    def set_cross(self, layer_id, key_layer, value_layer):
+        """Keep the cross-attention keys and values [b, np, s_enc, hn] of a layer."""
+        self.cross_keys[layer_id] = key_layer
+        self.cross_values[layer_id] = value_layer
+
+    def advance(self, length):
+        """Commit the positions written by the last forward pass."""
+        self.length += length
+
+    def truncate(self, length):
+        """Discard the cached positions after `length`, e.g. the draft tokens
+        rejected by speculative decoding."""
+        assert length <= self.length
+        self.length = length
+
+    def reorder(self, beam_idx):
+        """Select the batch rows in `beam_idx`, e.g. when beam search has
+        reshuffled the hypotheses or to expand the context to num_beams."""
+        for i in range(self.num_layers):
+            if self.keys[i] is not None:
+                self.keys[i] = self._select(self.keys[i], beam_idx)
+                self.values[i] = self._select(self.values[i], beam_idx)
+            if self.cross_keys[i] is not None:
+                self.cross_keys[i] = self.cross_keys[i][beam_idx]
+                self.cross_values[i] = self.cross_values[i][beam_idx]
+
+    def _select(self, buffer, index):
+        if index.numel() != buffer.size(0):
+            new_buffer = buffer.new_empty((index.numel(),) + buffer.size()[1:])
+        else:
+            new_buffer = buffer
+        # Only the valid prefix is gathered, the rest of the buffer is reused.
+        new_buffer[:, :, :self.length] = buffer[index, :, :self.length]
+        return new_buffer
+
+
 class ParallelCrossAttention(torch.nn.Module):
     """Parallel cross-attention layer for Transformer"""
 
@@ -105,19 +187,25 @@ class ParallelCrossAttention(torch.nn.Module):
         tensor = tensor.view(*new_tensor_shape)
         return tensor.permute(0, 2, 1, 3)
 
-    def forward(self, hidden_states, encoder_states, cross_mask):
+    def forward(self, hidden_states, encoder_states, cross_mask, kv_cache=None, layer_id=None):
         # hidden_states: [b, s, h]
         # ltor_mask: [1, 1, s, s]
 
         # Attention heads. [b, s, hp]
         mixed_query_layer = self.query(hidden_states)
-        mixed_x_layer = self.key_value(encoder_states)
-        (mixed_key_layer, mixed_value_layer) = split_tensor_along_last_dim(mixed_x_layer, 2)
-
         # Reshape and transpose [b, np, s, hn]
         query_layer = self._transpose_for_scores(mixed_query_layer)
-        key_layer = self._transpose_for_scores(mixed_key_layer)
-        value_layer = self._transpose_for_scores(mixed_value_layer)
+        cached = kv_cache.get_cross(layer_id) if kv_cache is not None else None
+        if cached is not None:
+            # The encoder output does not change during decoding.
+            key_layer, value_layer = cached
+        else:
+            mixed_x_layer = self.key_value(encoder_states)
+            (mixed_key_layer, mixed_value_layer) = split_tensor_along_last_dim(mixed_x_layer, 2)
+            key_layer = self._transpose_for_scores(mixed_key_layer)
+            value_layer = self._transpose_for_scores(mixed_value_layer)
+            if kv_cache is not None:
+                kv_cache.set_cross(layer_id, key_layer, value_layer)
         # Raw attention scores. [b, np, s, s]
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(
@@ -137,6 +225,9 @@ class ParallelCrossAttention(torch.nn.Module):
         # Context layer.
         # [b, np, s, hn]
         context_layer = torch.matmul(attention_probs, value_layer)
+        return self._output(context_layer)
+
+    def _output(self, context_layer):
         # [b, s, np, hn]
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + \
@@ -151,6 +242,174 @@ class ParallelCrossAttention(torch.nn.Module):
         return output
 
 
+def orthogonal_random_features(num_features, dim):
+    """Draw the [num_features, dim] projection of FAVOR+ (Choromanski et al., 2020): blocks of
+    orthogonal rows, with the norms of gaussian vectors so that every row is marginally gaussian."""
+    blocks = []
+    for _ in range(math.ceil(num_features / dim)):
+        q, _ = torch.linalg.qr(torch.randn(dim, dim))
+        blocks.append(q.t())
+    projection = torch.cat(blocks)[:num_features]
+    norms = torch.randn(num_features, dim).norm(dim=1, keepdim=True)
+    return projection * norms
+
+
+def favor_features(x, projection, is_query):
+    """Positive random features phi(x) with E[phi(q) phi(k)] = exp(q k / sqrt(hn)).
+    x: [b, np, s, hn], projection: [m, hn], returns [b, np, s, m] in fp32."""
+    x = x.float() * x.size(-1) ** -0.25
+    projected = torch.matmul(x, projection.t().float())
+    squared_norm = x.pow(2).sum(dim=-1, keepdim=True) / 2
+    # the stabilizer cancels out in the normalization: it is per query row, but shared by all the keys
+    if is_query:
+        stabilizer = projected.max(dim=-1, keepdim=True)[0]
+    else:
+        stabilizer = projected.max(dim=-1, keepdim=True)[0].max(dim=-2, keepdim=True)[0]
+    return (torch.exp(projected - squared_norm - stabilizer.detach()) + 1e-6) / math.sqrt(projection.size(0))
+
+
+def favor_attention(query_features, key_features, value_layer, sep, chunk_size=128):
+    """Linear attention with GLM's mask: every position attends to the keys before `sep`, and
+    the positions after `sep` also causally attend to each other.
+    The keys before `sep` are summed into a [m, hn] state, the causal part is computed chunk by
+    chunk with a [chunk_size, chunk_size] score matrix, so the memory is linear in s.
+        query_features, key_features: [b, np, s, m]
+        value_layer: [b, np, s, hn]
+        sep: int or [b] tensor
+    """
+    batch_size, seq_length = value_layer.size(0), value_layer.size(2)
+    value_layer = value_layer.float()
+    ids = torch.arange(seq_length, device=value_layer.device)
+    if isinstance(sep, int):
+        is_prefix = (ids < sep).view(1, 1, -1, 1)
+    else:
+        is_prefix = (ids < sep.view(-1, 1)).view(batch_size, 1, -1, 1)
+    is_prefix = is_prefix.type_as(key_features)
+    prefix_keys = key_features * is_prefix
+    key_features = key_features - prefix_keys
+    # [b, np, m, hn] and [b, np, m]
+    kv_state = torch.matmul(prefix_keys.transpose(-1, -2), value_layer)
+    k_state = prefix_keys.sum(dim=2)
+    outputs = []
+    for start in range(0, seq_length, chunk_size):
+        end = min(start + chunk_size, seq_length)
+        q, k, v = query_features[:, :, start:end], key_features[:, :, start:end], value_layer[:, :, start:end]
+        scores = torch.matmul(q, k.transpose(-1, -2)).tril()
+        numerator = torch.matmul(q, kv_state) + torch.matmul(scores, v)
+        denominator = torch.matmul(q, k_state.unsqueeze(-1)).squeeze(-1) + scores.sum(dim=-1)
+        outputs.append(numerator / denominator.unsqueeze(-1))
+        kv_state = kv_state + torch.matmul(k.transpose(-1, -2), v)
+        k_state = k_state + k.sum(dim=2)
+    return torch.cat(outputs, dim=2)
+
+
+_causal_masks = {}
+
+
+def causal_mask(query_length, memory_length=0, dtype=torch.bool, device=None):
+    """[1, 1, q, m + q] mask where every query sees the memory and the previous queries.
+    It is a view of a lower triangular matrix cached per (dtype, device), which only
+    grows when a longer sequence comes, so no mask is allocated in the steady state."""
+    key_length = memory_length + query_length
+    cache_key = (dtype, device if device is not None else torch.device('cpu'))
+    mask = _causal_masks.get(cache_key)
+    if mask is None or mask.size(0) < key_length:
+        size = max(key_length, 2 * mask.size(0) if mask is not None else 0)
+        mask = torch.ones((size, size), dtype=torch.bool, device=device).tril().to(dtype)
+        _causal_masks[cache_key] = mask
+    return mask[memory_length:key_length, :key_length].view(1, 1, query_length, key_length)
+
+
+def sep_mask(sep, query_length, memory_length=0, dtype=torch.bool, device=None, start=0, end=None):
+    """GLM attention mask [b, 1, end - start, m + q] of the queries start:end: every query sees
+    the memory, the first `sep` tokens and the previous tokens. `sep` is an int or a [b] tensor.
+    Without a prefix the cached causal view is returned as is."""
+    end = query_length if end is None else end
+    mask = causal_mask(query_length, memory_length, dtype=dtype, device=device)[:, :, start:end]
+    if isinstance(sep, int):
+        if sep == 0:
+            return mask
+        ids = torch.arange(memory_length + query_length, device=device)
+        prefix = (ids < memory_length + sep).view(1, 1, 1, -1)
+    else:
+        ids = torch.arange(memory_length + query_length, device=sep.device)
+        prefix = (ids < memory_length + sep.view(-1, 1)).view(sep.numel(), 1, 1, -1)
+    if dtype == torch.bool:
+        return mask | prefix
+    return torch.max(mask, prefix.to(dtype))
+
+
+def chunked_attention(query_layer, key_layer, value_layer, attention_mask, attention_dropout=None,
+                      attention_scale=1.0, chunk_size=256):
+    """Softmax attention computed for blocks of `chunk_size` queries, so that only one
+    [b, np, chunk_size, k] score matrix is alive at a time.
+        query_layer: [b, np, q, hn], key_layer and value_layer: [b, np, k, hn]
+        attention_mask: [b, 1, q, k] (or broadcastable), True or 1 for the visible keys,
+                        or the separation position (scalar or [b]), see sep_mask.
+    """
+    query_length, head_size = query_layer.size(2), query_layer.size(3)
+    memory_length = key_layer.size(2) - query_length
+    key_layer = key_layer.transpose(-1, -2)
+    if attention_scale > 1.0:
+        query_layer = query_layer / math.sqrt(attention_scale)
+        key_layer = key_layer / math.sqrt(head_size * attention_scale)
+    else:
+        key_layer = key_layer / math.sqrt(head_size)
+    sep = None
+    if attention_mask.dim() < 4:
+        sep = attention_mask.item() if torch.numel(attention_mask) == 1 else attention_mask
+    elif attention_mask.dtype != torch.bool:
+        attention_mask = attention_mask > 0
+    outputs = []
+    for start in range(0, query_length, chunk_size):
+        end = min(start + chunk_size, query_length)
+        attention_scores = torch.matmul(query_layer[:, :, start:end], key_layer)
+        if sep is not None:
+            mask = sep_mask(sep, query_length, memory_length, device=query_layer.device, start=start, end=end)
+        else:
+            mask = attention_mask[:, :, start:end] if attention_mask.size(2) > 1 else attention_mask
+        if attention_scale > 1.0:
+            attention_scores = attention_scores.masked_fill_(~mask, 0.0)
+            attention_scores -= attention_scores.max(dim=-1, keepdim=True)[0]
+            attention_scores *= attention_scale
+        attention_scores = attention_scores.masked_fill_(~mask, -65504.0)
+        attention_probs = torch.softmax(attention_scores, dim=-1)
+        if attention_dropout is not None:
+            with get_cuda_rng_tracker().fork():
+                attention_probs = attention_dropout(attention_probs)
+        outputs.append(torch.matmul(attention_probs, value_layer))
+    return torch.cat(outputs, dim=2)
+
+
+def sdpa_attention(query_layer, key_layer, value_layer, attention_mask, dropout_p=0.0):
+    """Attention with torch.nn.functional.scaled_dot_product_attention, which picks a fused
+    kernel when one is available for the inputs. The arguments are as in chunked_attention.
+    `attention_scale` only guards the fp16 range of the naive scores and is not needed here."""
+    if attention_mask.dtype != torch.bool:
+        attention_mask = attention_mask > 0
+    if dropout_p > 0.0:
+        with get_cuda_rng_tracker().fork():
+            return torch.nn.functional.scaled_dot_product_attention(query_layer, key_layer, value_layer,
+                                                                    attn_mask=attention_mask, dropout_p=dropout_p)
+    return torch.nn.functional.scaled_dot_product_attention(query_layer, key_layer, value_layer,
+                                                            attn_mask=attention_mask)
+
+
+def gather_positions(hidden_states, positions):
+    """Rows [b, k, h] of `hidden_states` [b, s, h] at `positions` [b, k]."""
+    return hidden_states.gather(1, positions.unsqueeze(-1).expand(-1, -1, hidden_states.size(-1)))
+
+
+def select_attention_backend(attention_backend='auto'):
+    """Resolve 'auto' to 'sdpa' if torch provides scaled_dot_product_attention, else to 'chunked'."""
+    if attention_backend == 'auto':
+        if hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+            return 'sdpa'
+        return 'chunked'
+    assert attention_backend in ('sdpa', 'chunked', 'naive'), f'Unknown attention backend {attention_backend}'
+    return attention_backend
+
+
 class ParallelSelfAttention(torch.nn.Module):
     """Parallel self-attention layer for GPT2.
 
@@ -167,6 +426,10 @@ class ParallelSelfAttention(torch.nn.Module):
         init_method: weight initialization.
         output_layer_init_method: output layer initialization. If None, use
                                   `init_method`.
+        performer: use the FAVOR+ linear attention with `performer_num_features`
+                   random features instead of the softmax attention.
+        attention_backend: 'sdpa', 'chunked' or 'naive' implementation of the
+                           softmax attention, 'auto' picks the best available.
     We use the following notation:
         h: hidden_size
         n: num_attention_heads
@@ -181,9 +444,10 @@ class ParallelSelfAttention(torch.nn.Module):
     def __init__(self, hidden_size, num_attention_heads,
                  attention_dropout_prob, output_dropout_prob,
                  init_method, output_layer_init_method=None, relative_encoding=False,
-                 performer=False, attention_scale=1.0):
+                 performer=False, attention_scale=1.0, performer_num_features=256, attention_backend='auto'):
         super(ParallelSelfAttention, self).__init__()
         self.performer = performer
+        self.attention_backend = select_attention_backend(attention_backend)
         # Set output layer initialization if not provided.
         if output_layer_init_method is None:
             output_layer_init_method = init_method
@@ -196,6 +460,11 @@ class ParallelSelfAttention(torch.nn.Module):
                                                         world_size)
         self.relative_encoding = relative_encoding
         self.attention_scale = attention_scale
+        if performer:
+            # Every partition holds whole heads, so the features of a head do not depend on the partitioning.
+            # The projection is random, it is drawn again instead of being saved in the checkpoints.
+            self.register_buffer('projection_matrix', orthogonal_random_features(
+                performer_num_features, self.hidden_size_per_attention_head), persistent=False)
         # Strided linear layer.
         self.query_key_value = ColumnParallelLinear(hidden_size, 3 * hidden_size,
                                                     stride=3,
@@ -249,9 +518,24 @@ class ParallelSelfAttention(torch.nn.Module):
 
         return x
 
-    def forward(self, hidden_states, ltor_mask, position_embeddings=None, r_w_bias=None, r_r_bias=None, mem=None):
+    def _output(self, context_layer):
+        # [b, s, np, hn]
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        new_context_layer_shape = context_layer.size()[:-2] + \
+                                  (self.hidden_size_per_partition,)
+        # [b, s, hp]
+        context_layer = context_layer.view(*new_context_layer_shape)
+
+        # Output. [b, s, h]
+        output = self.dense(context_layer)
+        output = self.output_dropout(output)
+
+        return output
+
+    def forward(self, hidden_states, ltor_mask, position_embeddings=None, r_w_bias=None, r_r_bias=None, mem=None,
+                kv_cache=None, layer_id=None, query_positions=None):
         # hidden_states: [b, s, h]
-        # ltor_mask: [1, 1, s, s]
+        # ltor_mask: [1, 1, s, s], or [b, 1, k, s] for the k query_positions [b, k]
 
         # Attention heads. [b, s, hp]
         query_length = hidden_states.size(1)
@@ -268,11 +552,34 @@ class ParallelSelfAttention(torch.nn.Module):
              mixed_key_layer,
              mixed_value_layer) = split_tensor_along_last_dim(mixed_x_layer, 3)
             mixed_query_layer = mixed_query_layer[:, -query_length:]
+        if query_positions is not None:
+            # Keys and values are needed for every position, queries only for the selected ones.
+            mixed_query_layer = gather_positions(mixed_query_layer, query_positions)
 
         # Reshape and transpose [b, np, s, hn]
         query_layer = self._transpose_for_scores(mixed_query_layer)
         key_layer = self._transpose_for_scores(mixed_key_layer)
         value_layer = self._transpose_for_scores(mixed_value_layer)
+        if kv_cache is not None:
+            # Keys and values of the previous positions come from the cache.
+            key_layer, value_layer = kv_cache.update(layer_id, key_layer, value_layer)
+        if self.performer:
+            # ltor_mask is the separation position, there is no score matrix to drop out.
+            sep = ltor_mask.item() if torch.numel(ltor_mask) == 1 else ltor_mask.view(-1)
+            query_features = favor_features(query_layer, self.projection_matrix, is_query=True)
+            key_features = favor_features(key_layer, self.projection_matrix, is_query=False)
+            context_layer = favor_attention(query_features, key_features, value_layer, sep)
+            context_layer = context_layer.type_as(query_layer)
+            return self._output(context_layer)
+        if not self.relative_encoding and self.attention_backend != 'naive':
+            if self.attention_backend == 'sdpa':
+                dropout_p = self.attention_dropout.p if self.training else 0.0
+                context_layer = sdpa_attention(query_layer, key_layer, value_layer, ltor_mask, dropout_p=dropout_p)
+            else:
+                context_layer = chunked_attention(query_layer, key_layer, value_layer, ltor_mask,
+                                                  attention_dropout=self.attention_dropout if self.training else None,
+                                                  attention_scale=self.attention_scale)
+            return self._output(context_layer)
         if self.relative_encoding:
             relative_layer = self.relative(position_embeddings)
             relative_layer = self._transpose_for_scores(relative_layer)  # 1 (bsz) x n_head x klen x d_head
@@ -315,18 +622,7 @@ class ParallelSelfAttention(torch.nn.Module):
         # Context layer.
         # [b, np, s, hn]
         context_layer = torch.matmul(attention_probs, value_layer)
-        # [b, s, np, hn]
-        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-        new_context_layer_shape = context_layer.size()[:-2] + \
-                                  (self.hidden_size_per_partition,)
-        # [b, s, hp]
-        context_layer = context_layer.view(*new_context_layer_shape)
-
-        # Output. [b, s, h]
-        output = self.dense(context_layer)
-        output = self.output_dropout(output)
-
-        return output
+        return self._output(context_layer)
 
 
 @torch.jit.script
@@ -424,7 +720,8 @@ class ParallelDecoderLayer(torch.nn.Module):
                  output_dropout_prob,
                  layernorm_epsilon,
                  init_method,
-                 output_layer_init_method=None):
+                 output_layer_init_method=None,
+                 attention_backend='auto'):
         super(ParallelDecoderLayer, self).__init__()
         # Set output layer initialization if not provided.
         if output_layer_init_method is None:
@@ -440,7 +737,8 @@ class ParallelDecoderLayer(torch.nn.Module):
             attention_dropout_prob,
             output_dropout_prob,
             init_method,
-            output_layer_init_method=output_layer_init_method)
+            output_layer_init_method=output_layer_init_method,
+            attention_backend=attention_backend)
 
         # Layernorm after the self attention.
         self.post_self_layernorm = LayerNorm(hidden_size, eps=layernorm_epsilon)
@@ -464,20 +762,24 @@ class ParallelDecoderLayer(torch.nn.Module):
             init_method,
             output_layer_init_method=output_layer_init_method)
 
-    def forward(self, hidden_states, encoder_states, ltor_mask, cross_mask=None):
+    def forward(self, hidden_states, encoder_states, ltor_mask, cross_mask=None, mem=None, kv_cache=None,
+                layer_id=None):
         # hidden_states: [b, s, h]
         # ltor_mask: [1, 1, s, s]
 
         # Layer norm at the begining of the transformer layer.
         layernorm_output = self.input_layernorm(hidden_states)
+        mem = self.input_layernorm(mem) if mem is not None else None
         # Self attention.
-        self_attention_output = self.self_attention(layernorm_output, ltor_mask)
+        self_attention_output = self.self_attention(layernorm_output, ltor_mask, mem=mem, kv_cache=kv_cache,
+                                                    layer_id=layer_id)
         # Residual connection.
         self_layernorm_input = hidden_states + self_attention_output
         # Layer norm post the self attention.
         self_layernorm_output = self.post_self_layernorm(self_layernorm_input)
         # Cross attention
-        attention_output = self.cross_attention(self_layernorm_output, encoder_states, cross_mask)
+        attention_output = self.cross_attention(self_layernorm_output, encoder_states, cross_mask, kv_cache=kv_cache,
+                                                layer_id=layer_id)
         # Residual connection
         layernorm_input = self_layernorm_input + attention_output
         # Layer norm post the cross attention
@@ -528,7 +830,9 @@ class ParallelTransformerLayer(torch.nn.Module):
                  output_layer_init_method=None,
                  relative_encoding=False,
                  performer=False,
-                 attention_scale=1.0):
+                 attention_scale=1.0,
+                 performer_num_features=256,
+                 attention_backend='auto'):
         super(ParallelTransformerLayer, self).__init__()
         # Set output layer initialization if not provided.
         if output_layer_init_method is None:
@@ -547,7 +851,9 @@ class ParallelTransformerLayer(torch.nn.Module):
             output_layer_init_method=output_layer_init_method,
             relative_encoding=relative_encoding,
             performer=performer,
-            attention_scale=attention_scale)
+            attention_scale=attention_scale,
+            performer_num_features=performer_num_features,
+            attention_backend=attention_backend)
 
         # Layernorm on the input data.
         self.post_attention_layernorm = LayerNorm(hidden_size,
@@ -560,15 +866,20 @@ class ParallelTransformerLayer(torch.nn.Module):
             init_method,
             output_layer_init_method=output_layer_init_method)
 
-    def forward(self, hidden_states, ltor_mask, position_embeddings=None, r_w_bias=None, r_r_bias=None, mem=None):
+    def forward(self, hidden_states, ltor_mask, position_embeddings=None, r_w_bias=None, r_r_bias=None, mem=None,
+                kv_cache=None, layer_id=None, query_positions=None):
         # hidden_states: [b, s, h]
         # ltor_mask: [1, 1, s, s]
+        # query_positions: [b, k], only these rows are computed after the attention
 
         # Layer norm at the begining of the transformer layer.
         layernorm_output = self.input_layernorm(hidden_states)
         mem = self.input_layernorm(mem) if mem is not None else None
         # Self attention.
-        attention_output = self.attention(layernorm_output, ltor_mask, position_embeddings, r_w_bias, r_r_bias, mem)
+        attention_output = self.attention(layernorm_output, ltor_mask, position_embeddings, r_w_bias, r_r_bias, mem,
+                                          kv_cache=kv_cache, layer_id=layer_id, query_positions=query_positions)
+        if query_positions is not None:
+            hidden_states = gather_positions(hidden_states, query_positions)
         # Residual connection.
         layernorm_input = hidden_states + attention_output
         # Layer norm post the self attention.
@@ -654,6 +965,9 @@ class GPT2ParallelTransformer(torch.nn.Module):
                  performer=False,
                  use_decoder_layer=False,
                  attention_scale=1.0,
+                 performer_num_features=256,
+                 attention_backend='auto',
+                 prune_queries=False,
                  ):
         super(GPT2ParallelTransformer, self).__init__()
         self.hidden_size = hidden_size
@@ -663,6 +977,8 @@ class GPT2ParallelTransformer(torch.nn.Module):
         self.max_memory_length = max_memory_length
         self.performer = performer
         self.use_decoder_layer = use_decoder_layer
+        self.attention_backend = select_attention_backend(attention_backend)
+        self.prune_queries = prune_queries
         assert not (performer and relative_encoding)
 
         output_layer_init_method = None
@@ -712,7 +1028,8 @@ class GPT2ParallelTransformer(torch.nn.Module):
                     output_dropout_prob,
                     layernorm_epsilon,
                     unscaled_init_method(init_method_std),
-                    output_layer_init_method=output_layer_init_method
+                    output_layer_init_method=output_layer_init_method,
+                    attention_backend=attention_backend
                 )
             else:
                 return ParallelTransformerLayer(
@@ -725,7 +1042,9 @@ class GPT2ParallelTransformer(torch.nn.Module):
                     output_layer_init_method=output_layer_init_method,
                     relative_encoding=relative_encoding,
                     performer=performer,
-                    attention_scale=attention_scale)
+                    attention_scale=attention_scale,
+                    performer_num_features=performer_num_features,
+                    attention_backend=attention_backend)
 
         # Transformer layers.
         self.layers = torch.nn.ModuleList(
@@ -740,40 +1059,35 @@ class GPT2ParallelTransformer(torch.nn.Module):
             checkpoint = deepspeed.checkpointing.checkpoint
 
     def forward(self, hidden_states, position_ids, attention_mask, memory_states=None, encoder_states=None,
-                return_memory=False, detach_memory=True):
+                return_memory=False, detach_memory=True, kv_cache=None, output_positions=None):
+        """If `output_positions` [b, k] is given, only the outputs at these positions are returned.
+        With `prune_queries`, the last layer then computes its queries, MLP and layer norms for
+        these positions only, unless the memories of the layers are kept."""
         batch_size, query_length = hidden_states.size()[:2]
-        memory_length = memory_states[0].size(1) if memory_states else 0
+        if kv_cache is not None:
+            # The cached keys and values replace the hidden-state memory.
+            assert not memory_states, 'Can not use memory states together with the key/value cache.'
+            memory_length = kv_cache.length
+        else:
+            memory_length = memory_states[0].size(1) if memory_states else 0
         key_length = query_length + memory_length
         # attention mask is the beginning postion of B region, \in [0, query_len)
         is_scalar = torch.numel(attention_mask) == 1
         is_sep = is_scalar or torch.numel(attention_mask) == batch_size
         if self.performer:
-            assert is_scalar, 'attention_mask should be a scalar to indicate the seperation position.'
+            assert is_sep, 'attention_mask should be the seperation position.'
             assert memory_length == 0, 'Do not support transformer-xl.'
+        # the softmax attention except transformer-xl takes boolean masks
+        bool_mask = not self.relative_encoding and self.attention_backend != 'naive'
         if is_sep:
-            sep = attention_mask.item() if is_scalar else attention_mask
-
-            # conventional transformer
-            def build_mask_matrix(seq_length, sep, memory_length=0):
-                m = hidden_states.new_ones((1, seq_length, seq_length))
-                m = torch.tril(m)
-                if is_scalar:
-                    m[0, :, :sep] = 1
-                else:
-                    m = m.expand(batch_size, -1, -1)
-                    ids = torch.arange(seq_length, device=sep.device, dtype=sep.dtype).view(1, -1)
-                    mask = ids < sep.view(-1, 1)
-                    m = m.masked_fill(mask.unsqueeze(1).expand_as(m), 1)
-                if memory_length > 0:
-                    m = m.expand(batch_size, -1, -1)
-                    m = torch.cat((hidden_states.new_ones((batch_size, seq_length, memory_length)), m), dim=2)
-                m = m.unsqueeze(1)
-                return m
-
-            if not self.performer:
-                attention_mask = build_mask_matrix(query_length, sep, memory_length=memory_length)
+            # the performer and the chunked attention build their masks from the separation position
+            if not (self.performer or (bool_mask and self.attention_backend == 'chunked')):
+                sep = attention_mask.item() if is_scalar else attention_mask.view(-1)
+                attention_mask = sep_mask(sep, query_length, memory_length,
+                                          dtype=torch.bool if bool_mask else hidden_states.dtype,
+                                          device=hidden_states.device)
         else:
-            attention_mask = attention_mask.type_as(hidden_states)
+            attention_mask = attention_mask > 0 if bool_mask else attention_mask.type_as(hidden_states)
             attention_mask = attention_mask[:, :, :, -query_length - memory_length:]
 
         if self.relative_encoding:
@@ -797,10 +1111,15 @@ class GPT2ParallelTransformer(torch.nn.Module):
                 return _hidden_states.detach()
             return _hidden_states
 
-        if self.max_memory_length > 0 or return_memory:
+        keep_memory = (self.max_memory_length > 0 or return_memory) and kv_cache is None
+        if keep_memory:
             mem_layers = [check_detach(hidden_states)]
         else:
             mem_layers = []
+        # The output of the last layer is only read at output_positions, so its other rows are skipped.
+        prune = (self.prune_queries and output_positions is not None and not keep_memory
+                 and not (self.relative_encoding or self.performer or self.use_decoder_layer))
+        num_layers = len(self.layers) - 1 if prune else len(self.layers)
 
         def custom(start, end):
             def custom_forward(*inputs):
@@ -808,20 +1127,21 @@ class GPT2ParallelTransformer(torch.nn.Module):
                 x_, inputs = inputs[0], inputs[1:]
                 if self.relative_encoding:
                     inputs, mems_ = inputs[:4], inputs[4:]
+                elif self.use_decoder_layer:
+                    inputs, mems_ = inputs[:2], inputs[2:]
                 else:
                     inputs, mems_ = inputs[:1], inputs[1:]
                 for i, layer in enumerate(layers_):
                     mem_i_ = mems_[i] if mems_ else None
                     x_ = layer(x_, *inputs, mem=mem_i_)
-                    if self.max_memory_length > 0 or return_memory:
+                    if keep_memory:
                         mem_layers.append(check_detach(x_))
                 return x_
 
             return custom_forward
 
-        if self.checkpoint_activations:
+        if self.checkpoint_activations and kv_cache is None:
             l = 0
-            num_layers = len(self.layers)
             chunk_length = self.checkpoint_num_layers
             while l < num_layers:
                 args = [hidden_states, attention_mask] if not self.use_decoder_layer else [hidden_states,
@@ -831,23 +1151,40 @@ class GPT2ParallelTransformer(torch.nn.Module):
                     args += [position_embeddings, self.r_w_bias, self.r_r_bias]
                 if memory_states:
                     args += memory_states[l: l + chunk_length]
-                hidden_states = checkpoint(custom(l, l + chunk_length), *args)
+                hidden_states = checkpoint(custom(l, min(l + chunk_length, num_layers)), *args)
                 l += chunk_length
         else:
-            for i, layer in enumerate(self.layers):
+            for i, layer in enumerate(self.layers[:num_layers]):
                 args = [hidden_states, attention_mask] if not self.use_decoder_layer else [hidden_states,
                                                                                            encoder_states,
                                                                                            attention_mask]
                 if self.relative_encoding:
                     args += [position_embeddings, self.r_w_bias, self.r_r_bias]
                 mem_i = memory_states[i] if memory_states else None
-                hidden_states = layer(*args, mem=mem_i)
-                if self.max_memory_length > 0 or return_memory:
+                if kv_cache is not None:
+                    hidden_states = layer(*args, kv_cache=kv_cache, layer_id=i)
+                else:
+                    hidden_states = layer(*args, mem=mem_i)
+                if keep_memory:
                     mem_layers.append(check_detach(hidden_states))
+        if prune:
+            if attention_mask.dim() < 4:
+                sep = attention_mask.item() if torch.numel(attention_mask) == 1 else attention_mask.view(-1)
+                attention_mask = sep_mask(sep, query_length, memory_length, device=hidden_states.device)
+            # The mask rows of the selected queries. [b, 1, k, m + q]
+            query_mask = attention_mask.expand(batch_size, -1, -1, -1).gather(
+                2, output_positions[:, None, :, None].expand(-1, attention_mask.size(1), -1, attention_mask.size(3)))
+            hidden_states = self.layers[-1](hidden_states, query_mask,
+                                            mem=memory_states[num_layers] if memory_states else None,
+                                            kv_cache=kv_cache, layer_id=num_layers, query_positions=output_positions)
+        elif output_positions is not None:
+            hidden_states = gather_positions(hidden_states, output_positions)
 
         # Final layer norm.
         output = self.final_layernorm(hidden_states)
-        if self.max_memory_length > 0 or return_memory:
+        if kv_cache is not None:
+            kv_cache.advance(query_length)
+        if keep_memory:
             mem_layers = self.update_mems(mem_layers, memory_states, return_memory=return_memory)
 
         return (output, mem_layers)
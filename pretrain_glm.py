@@ -32,10 +32,11 @@ from arguments import get_args
 from configure_data import configure_data, prepare_tokenizer, build_multi_task_dataset
 import mpu
 import pathlib
+from model import select_output_positions
 
 from train_utils import setup_model_and_optimizer, train_step
 from utils import Timers
-from utils import save_checkpoint
+from utils import save_checkpoint, wait_checkpoints
 from utils import load_checkpoint
 from utils import report_memory
 from utils import print_and_save_args
@@ -259,13 +260,20 @@ def forward_step(data_iterator, model, args, timers, mems):
     else:
         mode = 'bert'
 
-    logits, *mems = model(tokens, position_ids, attention_mask, *mems)
+    if args.block_lm:
+        # only the logits of the part-B tokens with loss are computed
+        output_positions = select_output_positions(loss_mask)
+        labels, loss_mask = labels.gather(1, output_positions), loss_mask.gather(1, output_positions)
+        logits, *mems = model(tokens, position_ids, attention_mask, *mems, output_positions=output_positions)
+    else:
+        logits, *mems = model(tokens, position_ids, attention_mask, *mems)
     losses = mpu.vocab_parallel_cross_entropy(logits.contiguous().float(),
                                               labels)
-    loss_mask = loss_mask.view(-1)
+    loss_mask = loss_mask.reshape(-1)
     loss = torch.sum(losses.view(-1) * loss_mask)
-    if loss_mask.sum().item() > 0:
-        loss = loss / loss_mask.sum()
+    # normalize on the device, a batch without loss tokens keeps its zero loss
+    num_tokens = loss_mask.sum()
+    loss = loss / torch.where(num_tokens > 0, num_tokens, torch.ones_like(num_tokens))
 
     return loss, mems, mode
 
@@ -658,6 +666,7 @@ def main():
 
     if args.save and iteration != 0:
         save_checkpoint(iteration, model, optimizer, lr_scheduler, args)
+    wait_checkpoints(args)
 
     if test_data is not None:
         test_data_iterator = iter(test_data)
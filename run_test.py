@@ -1,8 +1,42 @@
 import sys
 
-if sys.argv[1] == 'block':
-    from test.test_block import main
-    main()
-elif sys.argv[1] == 'rel_shift':
-    from test.test_rel_shift import main
-    main()
\ No newline at end of file
+if __name__ == '__main__':
+    if sys.argv[1] == 'block':
+        from test.test_block import main
+        main()
+    elif sys.argv[1] == 'rel_shift':
+        from test.test_rel_shift import main
+        main()
+    elif sys.argv[1] == 'beam_search':
+        from test.test_beam_search import main
+        main()
+    elif sys.argv[1] == 'attention':
+        from test.test_attention import main
+        main()
+    elif sys.argv[1] == 'quantization':
+        from test.test_quantization import main
+        main()
+    elif sys.argv[1] == 'prune_queries':
+        from test.test_prune_queries import main
+        main()
+    elif sys.argv[1] == 'train_step':
+        from test.test_train_step import main
+        main()
+    elif sys.argv[1] == 'distributed':
+        from test.test_distributed import main
+        main()
+    elif sys.argv[1] == 'fp16_optimizer':
+        from test.test_fp16_optimizer import main
+        main()
+    elif sys.argv[1] == 'async_checkpoint':
+        from test.test_async_checkpoint import main
+        main()
+    elif sys.argv[1] == 'mmap_checkpoint':
+        from test.test_mmap_checkpoint import main
+        main()
+    elif sys.argv[1] == 'speculative_decoding':
+        from test.test_speculative_decoding import main
+        main()
+    elif sys.argv[1] == 'encoder_decoder':
+        from test.test_encoder_decoder import main
+        main()
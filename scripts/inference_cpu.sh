@@ -0,0 +1,31 @@
+#!/bin/bash
+# Generate (or score with --score) the lines of INPUT_FILE in one CPU process.
+# The checkpoint must be merged to model parallel size 1 with change_mp.py.
+CHECKPOINT_PATH=/zhangpai21/checkpoints
+
+source $1
+INPUT_FILE=$2
+
+MAXSEQLEN=512
+NUM_THREADS=$(nproc)
+
+#SAMPLING ARGS
+TEMP=0.9
+#If TOPK/TOPP are 0 it defaults to greedy sampling, top-k will also override top-p
+TOPK=40
+TOPP=0
+
+python cpu_inference.py \
+       --model-parallel-size 1 \
+       $MODEL_ARGS \
+       --cache-dir cache \
+       --input-source $INPUT_FILE \
+       --num-threads $NUM_THREADS \
+       --batch-size 8 \
+       --kv-cache \
+       --out-seq-length $MAXSEQLEN \
+       --seq-length 512 \
+       --temperature $TEMP \
+       --top-k $TOPK \
+       --top-p $TOPP \
+       "${@:3}"
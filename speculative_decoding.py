@@ -0,0 +1,201 @@
+"""Speculative decoding of GLM with a smaller draft model."""
+
+import copy
+
+import torch
+import torch.nn.functional as F
+
+from generation_utils import top_k_logits
+from train_utils import get_model
+from utils import load_checkpoint, print_rank_0
+
+
+def setup_draft_model(args):
+    """Build the draft model described by the --draft-* arguments and load
+    its checkpoint. The draft model shares the tokenizer of the target
+    model, so only the size of the transformer is overridden."""
+    draft_args = copy.copy(args)
+    for name in ['num_layers', 'hidden_size', 'num_attention_heads']:
+        value = getattr(args, 'draft_' + name)
+        if value is not None:
+            setattr(draft_args, name, value)
+    # the draft model is only used for inference
+    draft_args.train_iters, draft_args.epochs = 0, 0
+    draft_args.load, draft_args.no_load_optim = args.draft_load, True
+    print_rank_0(f'building draft model with {draft_args.num_layers} layers, hidden size '
+                 f'{draft_args.hidden_size} ...')
+    draft_model = get_model(draft_args, model_type="generation")
+    load_checkpoint(draft_model, None, None, draft_args, no_deepspeed=True, no_load_rng=True)
+    draft_model.eval()
+    return draft_model
+
+
+class SpeculativeSampler(object):
+    """Speculative sampling with a draft model (Leviathan et al., 2023; Chen et al., 2023).
+
+    At every step the draft model proposes `num_draft_tokens` tokens one by
+    one and the target model scores all of them in a single forward pass
+    over its memory. Each draft token is accepted with probability
+    min(1, p / q), where p and q are the target and draft probabilities, and
+    the first rejected token is resampled from max(0, p - q), so the
+    generated tokens follow the distribution of the target model exactly.
+    With `greedy`, a draft token is accepted if it is the argmax of the
+    target model and the output is the greedy output of the target model.
+
+    Both models keep their own memories (or key/value caches); the
+    positions of the rejected draft tokens are cut from them after every
+    step. All the rows of a batch keep the shortest accepted prefix, the
+    other rows fall back to their next accepted draft token, which is an
+    exact sample too.
+
+    Arguments:
+        model: the target GLMModel.
+        draft_model: the draft GLMModel, with the same vocabulary.
+        num_draft_tokens: number of tokens proposed by the draft model per step.
+        temperature, top_k, top_p: sampling configuration of both models.
+        greedy: accept the draft tokens only if they are the argmax of the target model.
+        processors: optional LogitsProcessorList applied to the target log-probabilities. The
+                    processors are called on every draft prefix and truncated to the accepted one.
+    """
+
+    def __init__(self, model, draft_model, num_draft_tokens, temperature=1.0, top_k=0, top_p=0.0, greedy=False,
+                 processors=None):
+        self.model = model
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.greedy = greedy
+        self.processors = processors
+        self.mems, self.draft_mems = [], []
+        self.kv_cache, self.draft_kv_cache = None, None
+        # number of tokens returned by the last step that both models have seen
+        self.num_fed = 0
+
+    def start(self, mems=None, draft_mems=None, kv_cache=None, draft_kv_cache=None):
+        """Set the memories (or key/value caches) of both models after the context."""
+        self.mems = mems if mems is not None else []
+        self.draft_mems = draft_mems if draft_mems is not None else []
+        self.kv_cache, self.draft_kv_cache = kv_cache, draft_kv_cache
+        self.num_fed = 0
+
+    def _filter(self, logits):
+        if self.temperature != 1.0:
+            logits = logits / self.temperature
+        return top_k_logits(logits, top_k=self.top_k, top_p=self.top_p)
+
+    @staticmethod
+    def _forward(model, tokens, position_ids, attention_mask, mems, kv_cache):
+        if kv_cache is not None:
+            logits, *_ = model(tokens, position_ids, attention_mask, kv_cache=kv_cache)
+            return logits, []
+        logits, *mems = model(tokens, position_ids, attention_mask, *mems, return_memory=True)
+        return logits, mems
+
+    @staticmethod
+    def _truncate(mems, kv_cache, num_dropped):
+        if num_dropped > 0:
+            if kv_cache is not None:
+                kv_cache.truncate(kv_cache.length - num_dropped)
+            mems = [mem[:, :mem.size(1) - num_dropped] for mem in mems]
+        return mems
+
+    def _draft(self, tokens, get_inputs):
+        """Propose num_draft_tokens tokens and return them with their draft probabilities.
+        The last draft token is fed to the draft model as well, so that both
+        models have seen the same tokens after the step."""
+        start = tokens.size(1) - 1
+        inputs = tokens[:, start:]
+        draft_tokens, draft_probs = [], []
+        for i in range(self.num_draft_tokens + 1):
+            position_ids, attention_mask = get_inputs(start + i, 1)
+            logits, self.draft_mems = self._forward(self.draft_model, inputs, position_ids, attention_mask,
+                                                    self.draft_mems, self.draft_kv_cache)
+            if i == self.num_draft_tokens:
+                break
+            logits = self._filter(logits[:, -1].float())
+            if self.greedy:
+                token = logits.argmax(dim=-1)
+            else:
+                probs = F.softmax(logits, dim=-1)
+                token = torch.multinomial(probs, num_samples=1).squeeze(1)
+                draft_probs.append(probs)
+            draft_tokens.append(token)
+            inputs = token.unsqueeze(1)
+        draft_tokens = torch.stack(draft_tokens, dim=1)
+        draft_probs = torch.stack(draft_probs, dim=1) if draft_probs else None
+        return draft_tokens, draft_probs
+
+    def _score(self, tokens, draft_tokens, get_inputs):
+        """Run the target model on the last token and the draft tokens and return
+        its (processed) log-probabilities of the num_draft_tokens + 1 next tokens."""
+        inputs = torch.cat((tokens[:, -1:], draft_tokens), dim=1)
+        position_ids, attention_mask = get_inputs(tokens.size(1) - 1, inputs.size(1))
+        logits, self.mems = self._forward(self.model, inputs, position_ids, attention_mask, self.mems,
+                                          self.kv_cache)
+        batch_size, length, vocab_size = logits.size()
+        logits = self._filter(logits.float().view(-1, vocab_size))
+        scores = F.log_softmax(logits, dim=-1).view(batch_size, length, vocab_size)
+        if self.processors:
+            for i in range(length):
+                prefix = torch.cat((tokens, draft_tokens[:, :i]), dim=1)
+                scores[:, i] = self.processors(prefix, scores[:, i])
+            # the processors only mask tokens, the remaining probabilities have to sum to one again
+            scores = F.log_softmax(scores, dim=-1)
+        return scores
+
+    def step(self, tokens, get_inputs):
+        """Generate at least one new token for every row.
+
+        Arguments:
+            tokens: [b, t] tokens generated so far. The last one has not been
+                    fed to the target model yet.
+            get_inputs: function that takes the index in `tokens` of the first
+                        fed token and the number of fed tokens, and returns the
+                        position ids and the attention mask of these tokens.
+        Returns:
+            [b, n] new tokens, 1 <= n <= num_draft_tokens + 1.
+        """
+        k = self.num_draft_tokens
+        draft_tokens, draft_probs = self._draft(tokens, get_inputs)
+        scores = self._score(tokens, draft_tokens, get_inputs)
+        if self.greedy:
+            target_tokens = scores.argmax(dim=-1)
+            accepted = draft_tokens == target_tokens[:, :k]
+        else:
+            probs = scores.exp()
+            target_probs = probs[:, :k].gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+            proposal_probs = draft_probs.gather(-1, draft_tokens.unsqueeze(-1)).squeeze(-1)
+            accepted = torch.rand_like(target_probs) * proposal_probs <= target_probs
+        num_accepted = accepted.long().cumprod(dim=1).sum(dim=1)
+        n = num_accepted.min().item()
+        if self.greedy:
+            next_tokens = target_tokens[:, n]
+        elif n == k:
+            next_tokens = torch.multinomial(probs[:, k], num_samples=1).squeeze(1)
+        else:
+            residual = (probs[:, n] - draft_probs[:, n]).clamp(min=0)
+            # the residual is zero only if p == q, then p itself is used
+            residual_sum = residual.sum(dim=-1, keepdim=True)
+            residual = torch.where(residual_sum > 0, residual, probs[:, n])
+            next_tokens = torch.multinomial(residual, num_samples=1).squeeze(1)
+        if n < k:
+            # rows that accepted more draft tokens continue with their next accepted one
+            next_tokens = torch.where(num_accepted > n, draft_tokens[:, n], next_tokens)
+        # both models have seen the last token and all the draft tokens
+        self.mems = self._truncate(self.mems, self.kv_cache, k - n)
+        self.draft_mems = self._truncate(self.draft_mems, self.draft_kv_cache, k - n)
+        self.num_fed = n
+        if self.processors:
+            # the processors have seen all the draft tokens, only the accepted ones are kept
+            self.processors.truncate(tokens.size(1) + n)
+        return torch.cat((draft_tokens[:, :n], next_tokens.unsqueeze(1)), dim=1)
+
+    def rewind(self, num_tokens):
+        """Keep only the first `num_tokens` tokens returned by the last step in
+        the memories, e.g. when the sequence ends in the middle of them."""
+        num_dropped = max(self.num_fed - num_tokens, 0)
+        self.mems = self._truncate(self.mems, self.kv_cache, num_dropped)
+        self.draft_mems = self._truncate(self.draft_mems, self.draft_kv_cache, num_dropped)
+        self.num_fed -= num_dropped
@@ -114,6 +114,23 @@ def accuracy_func_provider(single_dataset_provider, metric_dict, args, is_test=F
     return metrics_func
 
 
+def gather_results(results, example_dict):
+    """Collect the per-uid results of all the data parallel ranks and return
+    them, together with the examples, in the order of `example_dict`.
+
+    Every rank packs its results into a single list, the lists are exchanged
+    with one all_gather_object over the data parallel group and merged in a
+    single pass."""
+    packed = list(results.items())
+    if torch.distributed.is_initialized():
+        gathered = [None for _ in range(mpu.get_data_parallel_world_size())]
+        torch.distributed.all_gather_object(gathered, packed, group=mpu.get_data_parallel_group())
+    else:
+        gathered = [packed]
+    results = {uid: result for packed in gathered for uid, result in packed}
+    return [results[uid] for uid in example_dict], list(example_dict.values())
+
+
 segment_length = 10
 
 
@@ -191,17 +208,7 @@ def multichoice_evaluate(model, dataloader, example_dict, args):
             for uid, prediction, label in zip(uid_list, predicted, labels):
                 results[uid] = (prediction, label)
     model.train()
-    torch.distributed.barrier()
-    results_gathered = [None for _ in range(mpu.get_data_parallel_world_size())]
-    torch.distributed.all_gather_object(results_gathered, results, group=mpu.get_data_parallel_group())
-    results = {}
-    for result in results_gathered:
-        results.update(result)
-    predictions, labels, examples = [], [], []
-    for uid, example in example_dict.items():
-        prediction, label = results[uid]
-        predictions.append(prediction)
-        labels.append(label)
-        examples.append(example)
-    torch.distributed.barrier()
+    results, examples = gather_results(results, example_dict)
+    predictions = [prediction for prediction, _ in results]
+    labels = [label for _, label in results]
     return predictions, labels, examples
@@ -1,13 +1,13 @@
 import string
-import datetime
-import random
 import re
 import torch
 import torch.nn.functional as F
 import mpu
 from utils import print_rank_0
-from generation_utils import BeamSearchScorer, LogitsProcessorList, MinLengthLogitsProcessor, \
-    NoRepeatNGramLogitsProcessor, top_k_logits
+from tasks.eval_utils import gather_results
+from speculative_decoding import SpeculativeSampler, setup_draft_model
+from generation_utils import TensorBeamSearchScorer, LogitsProcessorList, MinLengthLogitsProcessor, \
+    IncrementalNoRepeatNGramLogitsProcessor, top_k_logits
 from rouge_score import rouge_scorer
 
 
@@ -177,7 +177,7 @@ def rouge_metric(predictions, labels, examples, metric="rouge-1", duplicate_rate
             buf = remove_duplicate(buf, duplicate_rate)
         line = "\n".join(buf)
         pred_list.append(line)
-    if torch.distributed.get_rank() == 0:
+    if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
         import json
         with open("./results.json", "w") as output:
             for ref, pred in zip(ref_list, pred_list):
@@ -237,9 +237,10 @@ def process_batch(batch, args):
         # finetune SQuAD
         batch['attention_mask'] = batch.pop('mask')
         batch['position_id'] = batch.pop('position')
-    tokens = batch['text'].long().cuda()
-    attention_mask = batch['attention_mask'].long().cuda()
-    position_ids = batch['position_id'].long().cuda()
+    device = torch.cuda.current_device() if args.cuda else torch.device('cpu')
+    tokens = batch['text'].long().to(device)
+    attention_mask = batch['attention_mask'].long().to(device)
+    position_ids = batch['position_id'].long().to(device)
     if tokens.dim() == 3:
         tokens = tokens.squeeze(1)
         attention_mask = attention_mask.squeeze(1)
@@ -247,6 +248,11 @@ def process_batch(batch, args):
     return tokens, attention_mask, position_ids
 
 
+def last_position(tokens):
+    """Output positions [b, 1] of the last token, the only logits needed from the context."""
+    return tokens.new_full((tokens.size(0), 1), tokens.size(1) - 1)
+
+
 class DecoderEvaluater:
     def __init__(self, args, tokenizer):
         self.tokenizer = tokenizer
@@ -261,103 +267,197 @@ class DecoderEvaluater:
             processor = MinLengthLogitsProcessor(args.min_tgt_length, self.end_token)
             self.processors.append(processor)
         if args.no_repeat_ngram_size > 0:
-            processor = NoRepeatNGramLogitsProcessor(args.no_repeat_ngram_size)
+            processor = IncrementalNoRepeatNGramLogitsProcessor(args.no_repeat_ngram_size)
             self.processors.append(processor)
+        # built on the first evaluation if --draft-load is given
+        self.draft_model = None
+
+    def select_beams(self, next_token_logits, tokens, beam_scores, args):
+        """Return the scores, tokens and beam indices of the 2 * num_beams best
+        candidates of every batch item, sorted by score."""
+        next_token_logits = top_k_logits(next_token_logits, top_k=args.top_k, top_p=args.top_p)
+        next_token_scores = F.log_softmax(next_token_logits, dim=-1)
+        next_token_scores = self.processors(tokens, next_token_scores)
+        next_token_scores = next_token_scores + beam_scores[:, None].expand_as(next_token_scores)
+        vocab_size = next_token_scores.shape[-1]
+        next_token_scores = next_token_scores.view(-1, args.num_beams * vocab_size)
+
+        probs = F.softmax(next_token_scores, dim=-1)
+        if args.select_topk:
+            _, next_tokens = torch.topk(probs, k=2 * args.num_beams, dim=-1, largest=True)
+        else:
+            next_tokens = torch.multinomial(probs, num_samples=2 * args.num_beams)
+        next_token_scores = torch.gather(next_token_scores, -1, next_tokens)
+        next_token_scores, _indices = torch.sort(next_token_scores, descending=True, dim=1)
+        next_tokens = torch.gather(next_tokens, -1, _indices)
+
+        next_indices = next_tokens // vocab_size
+        next_tokens = next_tokens % vocab_size
+        return next_token_scores, next_tokens, next_indices
+
+    def beam_search(self, model, tokens, attention_mask, position_ids, args):
+        """Decode a batch with beam search and return the best hypothesis of every sample."""
+        batch_size = tokens.size(0)
+        beam_scorer = TensorBeamSearchScorer(
+            batch_size=batch_size,
+            max_length=args.out_seq_length,
+            num_beams=args.num_beams,
+            device=tokens.device,
+            length_penalty=args.length_penalty,
+            do_early_stopping=False,
+        )
+        beam_scores = torch.zeros((batch_size, args.num_beams), dtype=torch.float, device=tokens.device)
+        beam_scores[:, 1:] = -1e9
+        beam_scores = beam_scores.view((batch_size * args.num_beams,))
+        # Run the model forward.
+        counter = 0
+        context_length = tokens.size(1)
+        kv_cache = None
+        if args.kv_cache:
+            kv_cache = mpu.KeyValueCache(args.num_layers, context_length + args.tgt_seq_length)
+        while counter < args.tgt_seq_length:
+            if counter == 0:
+                # only the logits of the last context token are computed
+                next_token_logits, *mems = model(tokens, position_ids, attention_mask, return_memory=True,
+                                                 kv_cache=kv_cache, output_positions=last_position(tokens))
+                seq_length = tokens.size(1)
+                next_token_logits = next_token_logits[:, -1]
+                next_token_logits = next_token_logits.unsqueeze(1).repeat(1, args.num_beams, 1).view(
+                    batch_size * args.num_beams, -1)
+                mems = [mem.unsqueeze(1).repeat(1, args.num_beams, 1, 1).view(batch_size * args.num_beams,
+                                                                              seq_length, -1) for mem in mems]
+                if kv_cache is not None:
+                    kv_cache.reorder(torch.arange(batch_size, device=tokens.device).repeat_interleave(
+                        args.num_beams))
+                position_ids = tokens.new_ones(batch_size, args.num_beams, 2, 1)
+                for i, text in enumerate(tokens.tolist()):
+                    mask_pos = text.index(self.mask_token)
+                    position_ids[i, :, 0] = mask_pos
+                position_ids = position_ids.reshape(batch_size * args.num_beams, 2, 1)
+                tokens = tokens.new_zeros(batch_size * args.num_beams, 0)
+                # rows of the unfinished batch items, the memories only hold these rows
+                active_rows = torch.arange(batch_size * args.num_beams, device=tokens.device)
+                row_map = active_rows.clone()
+            else:
+                if not args.no_block_position:
+                    position_ids[:, 1] = counter + 1
+                last_token = tokens[:, -1:]
+                if self.mask_pad_token:
+                    cur_attention_mask = attention_mask[:, :, -1:, :].unsqueeze(1).expand(-1, args.num_beams, -1,
+                                                                                          -1, -1).reshape(
+                        batch_size * args.num_beams, 1, 1, context_length)
+                    cur_attention_mask = torch.cat(
+                        (cur_attention_mask, attention_mask.new_ones((batch_size * args.num_beams, 1, 1, counter))),
+                        dim=-1)
+                else:
+                    cur_attention_mask = tokens.new_zeros([batch_size * args.num_beams])
+                next_token_logits, *mems = model(last_token[active_rows], position_ids[active_rows],
+                                                 cur_attention_mask[active_rows], *mems,
+                                                 return_memory=True, kv_cache=kv_cache)
+                next_token_logits = next_token_logits[:, -1]
+                if active_rows.size(0) < batch_size * args.num_beams:
+                    # the scores of the finished batch items are ignored by the beam scorer
+                    full_logits = next_token_logits.new_zeros(
+                        (batch_size * args.num_beams, next_token_logits.size(-1)))
+                    full_logits[active_rows] = next_token_logits
+                    next_token_logits = full_logits
+            next_token_scores, next_tokens, next_indices = self.select_beams(next_token_logits, tokens,
+                                                                             beam_scores, args)
+            # stateless
+            beam_outputs = beam_scorer.process(
+                tokens,
+                next_token_scores,
+                next_tokens,
+                next_indices,
+                eos_token_id=self.end_token,
+                pad_token_id=self.pad_token
+            )
+            beam_scores = beam_outputs["next_beam_scores"]
+            beam_next_tokens = beam_outputs["next_beam_tokens"]
+            beam_idx = beam_outputs["next_beam_indices"]
+            beam_next_tokens = beam_next_tokens.unsqueeze(-1)
+            tokens = torch.cat([tokens[beam_idx, :], beam_next_tokens], dim=-1)
+            self.processors.reorder(beam_idx)
+            if beam_scorer.is_done:
+                break
+            # drop the rows of the finished batch items from the memories
+            active_rows = (~beam_scorer.done).repeat_interleave(args.num_beams).nonzero(as_tuple=True)[0]
+            mem_index = row_map[beam_idx[active_rows]]
+            mems = [mem[mem_index] for mem in mems] if mems else []
+            if kv_cache is not None:
+                kv_cache.reorder(mem_index)
+            row_map[active_rows] = torch.arange(active_rows.size(0), device=tokens.device)
+            counter += 1
+        tokens, _, _ = beam_scorer.finalize(tokens, beam_scores, next_tokens, next_indices,
+                                            eos_token_id=self.end_token, pad_token_id=self.pad_token)
+        return tokens
+
+    def speculative_decode(self, model, tokens, attention_mask, position_ids, args):
+        """Decode a batch with speculative sampling from the draft model. The
+        tokens after the end of every sample are replaced with padding."""
+        batch_size, context_length = tokens.size()
+        kv_cache, draft_kv_cache = None, None
+        if args.kv_cache:
+            max_length = context_length + args.tgt_seq_length + args.num_draft_tokens + 1
+            kv_cache = mpu.KeyValueCache(args.num_layers, max_length)
+            draft_kv_cache = mpu.KeyValueCache(args.draft_num_layers or args.num_layers, max_length)
+        next_token_logits, *mems = model(tokens, position_ids, attention_mask, return_memory=True,
+                                         kv_cache=kv_cache, output_positions=last_position(tokens))
+        _, *draft_mems = self.draft_model(tokens, position_ids, attention_mask, return_memory=True,
+                                          kv_cache=draft_kv_cache, output_positions=last_position(tokens))
+        mask_positions = (tokens == self.mask_token).long().argmax(dim=1)
+
+        def get_inputs(start, length):
+            # the i-th generated token has the block position i + 2
+            block_position_ids = torch.arange(start + 2, start + 2 + length, device=tokens.device)
+            if args.no_block_position:
+                block_position_ids = torch.ones_like(block_position_ids)
+            step_position_ids = torch.stack((mask_positions.unsqueeze(1).expand(-1, length),
+                                             block_position_ids.unsqueeze(0).expand(batch_size, -1)), dim=1)
+            if self.mask_pad_token:
+                step_attention_mask = torch.cat((
+                    attention_mask[:, :, -1:, :].expand(-1, -1, length, -1),
+                    attention_mask.new_ones((batch_size, 1, length, start)),
+                    torch.tril(attention_mask.new_ones((length, length))).expand(batch_size, 1, -1, -1)), dim=-1)
+            else:
+                step_attention_mask = tokens.new_zeros([batch_size])
+            return step_position_ids, step_attention_mask
+
+        next_token_scores = F.log_softmax(top_k_logits(next_token_logits[:, -1].float(), top_k=args.top_k,
+                                                       top_p=args.top_p), dim=-1)
+        next_token_scores = self.processors(tokens.new_zeros(batch_size, 0), next_token_scores)
+        if args.select_topk:
+            output_tokens = next_token_scores.argmax(dim=-1, keepdim=True)
+        else:
+            output_tokens = torch.multinomial(next_token_scores.exp(), num_samples=1)
+        sampler = SpeculativeSampler(model, self.draft_model, args.num_draft_tokens, top_k=args.top_k,
+                                     top_p=args.top_p, greedy=args.select_topk, processors=self.processors)
+        sampler.start(mems, draft_mems, kv_cache=kv_cache, draft_kv_cache=draft_kv_cache)
+        done = output_tokens[:, 0] == self.end_token
+        while output_tokens.size(1) < args.tgt_seq_length and not done.all():
+            new_tokens = sampler.step(output_tokens, get_inputs)
+            output_tokens = torch.cat((output_tokens, new_tokens), dim=1)
+            done = done | (new_tokens == self.end_token).any(dim=1)
+        output_tokens = output_tokens[:, :args.tgt_seq_length]
+        after_end = (output_tokens == self.end_token).long().cumsum(dim=1) > 0
+        return output_tokens.masked_fill(after_end, self.pad_token)
 
     def evaluate(self, model, dataloader, example_dict, args):
         """Calculate correct over total answers and return prediction if the
         `output_predictions` is true."""
         model.eval()
+        if args.draft_load is not None and self.draft_model is None:
+            assert args.num_beams == 1, 'Speculative decoding does not support beam search.'
+            self.draft_model = setup_draft_model(args)
         local_predictions = {}
-        print_rank_0("Distributed store created")
         with torch.no_grad():
             # For all the batches in the dataset.
             for idx, data in enumerate(dataloader):
                 tokens, attention_mask, position_ids = process_batch(data, args)
-                batch_size = tokens.size(0)
-                beam_scorer = BeamSearchScorer(
-                    batch_size=batch_size,
-                    max_length=args.out_seq_length,
-                    num_beams=args.num_beams,
-                    device=tokens.device,
-                    length_penalty=args.length_penalty,
-                    do_early_stopping=False,
-                )
-                beam_scores = torch.zeros((batch_size, args.num_beams), dtype=torch.float, device=tokens.device)
-                beam_scores[:, 1:] = -1e9
-                beam_scores = beam_scores.view((batch_size * args.num_beams,))
-                # Run the model forward.
-                counter = 0
-                context_length = tokens.size(1)
-                while counter < args.tgt_seq_length:
-                    if counter == 0:
-                        next_token_logits, *mems = model(tokens, position_ids, attention_mask, return_memory=True)
-                        seq_length = next_token_logits.size(1)
-                        next_token_logits = next_token_logits[:, -1]
-                        next_token_logits = next_token_logits.unsqueeze(1).repeat(1, args.num_beams, 1).view(
-                            batch_size * args.num_beams, -1)
-                        mems = [mem.unsqueeze(1).repeat(1, args.num_beams, 1, 1).view(batch_size * args.num_beams,
-                                                                                      seq_length, -1) for mem in mems]
-                        position_ids = tokens.new_ones(batch_size, args.num_beams, 2, 1)
-                        for i, text in enumerate(tokens.tolist()):
-                            mask_pos = text.index(self.mask_token)
-                            position_ids[i, :, 0] = mask_pos
-                        position_ids = position_ids.reshape(batch_size * args.num_beams, 2, 1)
-                        tokens = tokens.new_zeros(batch_size * args.num_beams, 0)
-                    else:
-                        if not args.no_block_position:
-                            position_ids[:, 1] = counter + 1
-                        last_token = tokens[:, -1:]
-                        if self.mask_pad_token:
-                            cur_attention_mask = attention_mask[:, :, -1:, :].unsqueeze(1).expand(-1, args.num_beams, -1,
-                                                                                                  -1, -1).reshape(
-                                batch_size * args.num_beams, 1, 1, context_length)
-                            cur_attention_mask = torch.cat(
-                                (cur_attention_mask, attention_mask.new_ones((batch_size * args.num_beams, 1, 1, counter))),
-                                dim=-1)
-                        else:
-                            cur_attention_mask = tokens.new_zeros([batch_size * args.num_beams])
-                        next_token_logits, *mems = model(last_token, position_ids, cur_attention_mask, *mems,
-                                                         return_memory=True)
-                        next_token_logits = next_token_logits[:, -1]
-                    next_token_logits = top_k_logits(next_token_logits, top_k=args.top_k, top_p=args.top_p)
-                    next_token_scores = F.log_softmax(next_token_logits, dim=-1)
-                    next_token_scores = self.processors(tokens, next_token_scores)
-                    next_token_scores = next_token_scores + beam_scores[:, None].expand_as(next_token_scores)
-                    vocab_size = next_token_scores.shape[-1]
-                    next_token_scores = next_token_scores.view(batch_size, args.num_beams * vocab_size)
-
-                    probs = F.softmax(next_token_scores, dim=-1)
-                    if args.select_topk:
-                        _, next_tokens = torch.topk(probs, k=2 * args.num_beams, dim=-1, largest=True)
-                    else:
-                        next_tokens = torch.multinomial(probs, num_samples=2 * args.num_beams)
-                    next_token_scores = torch.gather(next_token_scores, -1, next_tokens)
-                    next_token_scores, _indices = torch.sort(next_token_scores, descending=True, dim=1)
-                    next_tokens = torch.gather(next_tokens, -1, _indices)
-
-                    next_indices = next_tokens // vocab_size
-                    next_tokens = next_tokens % vocab_size
-                    # stateless
-                    beam_outputs = beam_scorer.process(
-                        tokens,
-                        next_token_scores,
-                        next_tokens,
-                        next_indices,
-                        eos_token_id=self.end_token,
-                        pad_token_id=self.pad_token
-                    )
-                    beam_scores = beam_outputs["next_beam_scores"]
-                    beam_next_tokens = beam_outputs["next_beam_tokens"]
-                    beam_idx = beam_outputs["next_beam_indices"]
-                    beam_next_tokens = beam_next_tokens.unsqueeze(-1)
-                    tokens = torch.cat([tokens[beam_idx, :], beam_next_tokens], dim=-1)
-                    mems = [mem[beam_idx] for mem in mems] if mems else []
-                    if beam_scorer.is_done:
-                        break
-                    counter += 1
-                tokens, _, scores = beam_scorer.finalize(tokens, beam_scores, next_tokens, next_indices,
-                                                         eos_token_id=self.end_token, pad_token_id=self.pad_token)
+                if self.draft_model is not None:
+                    tokens = self.speculative_decode(model, tokens, attention_mask, position_ids, args)
+                else:
+                    tokens = self.beam_search(model, tokens, attention_mask, position_ids, args)
                 uid_list = data['uid']
                 if isinstance(uid_list, torch.Tensor):
                     uid_list = uid_list.cpu().numpy().tolist()
@@ -376,17 +476,8 @@ class DecoderEvaluater:
                 if (idx + 1) % args.log_interval == 0:
                     print_rank_0(f"Iteration {idx + 1} / {len(dataloader)}")
         model.train()
-        torch.distributed.barrier()
         print_rank_0("Evaluation completed")
-        gathered_predictions = [None for i in range(torch.distributed.get_world_size())]
-        torch.distributed.all_gather_object(gathered_predictions, local_predictions)
-        gathered_predictions = {uid: pred for preds in gathered_predictions for uid, pred in preds.items() }
-        predictions, examples, scores = [], [], []
-        for uid, example in example_dict.items():
-            prediction = gathered_predictions[uid]
-            predictions.append(prediction)
-            examples.append(example)
-        torch.distributed.barrier()
+        predictions, examples = gather_results(local_predictions, example_dict)
         return predictions, [], examples
 
 
@@ -408,101 +499,172 @@ def blanklm_fix_tokenization(text):
 
 class BlankLMEvaluater(DecoderEvaluater):
 
+    def blank_positions(self, tokens):
+        """Return the positions of the masks of every sample, moved to the front
+        of a [b, max_masks] table, and the number of masks of every sample."""
+        is_mask = tokens == self.mask_token
+        num_masks = is_mask.sum(dim=1)
+        positions = torch.arange(tokens.size(1), device=tokens.device).expand_as(tokens)
+        mask_table = torch.where(is_mask, positions, positions.new_full((), tokens.size(1))).sort(dim=1)[0]
+        return mask_table[:, :max(num_masks.max().item(), 1)], num_masks
+
+    def fill_blanks(self, model, tokens, attention_mask, position_ids, args):
+        """Generate all the blanks of a batch one after another and return the
+        generated tokens, with the blanks separated by the sop token.
+
+        Every row keeps the index of the blank it is filling and the
+        transition from one blank to the next is applied to all the rows at
+        once: an eop that ends a blank other than the last one is replaced by
+        sop, which moves the block position to the next mask. With beam
+        search the hypotheses run through all the blanks and only an eop
+        after the last blank finishes them."""
+        batch_size, num_beams = tokens.size(0), args.num_beams
+        num_rows = batch_size * num_beams
+        mask_table, num_masks = self.blank_positions(tokens)
+        if num_beams > 1:
+            beam_scorer = TensorBeamSearchScorer(
+                batch_size=batch_size,
+                max_length=args.tgt_seq_length,
+                num_beams=num_beams,
+                device=tokens.device,
+                length_penalty=args.length_penalty,
+                do_early_stopping=False,
+            )
+            beam_scores = torch.zeros((batch_size, num_beams), dtype=torch.float, device=tokens.device)
+            beam_scores[:, 1:] = -1e9
+            beam_scores = beam_scores.view((num_rows,))
+            batch_index = torch.arange(batch_size, device=tokens.device).repeat_interleave(num_beams)
+            mask_table, num_masks = mask_table[batch_index], num_masks[batch_index]
+        current_blank = torch.zeros(num_rows, dtype=torch.long, device=tokens.device)
+        done = torch.zeros(num_rows, dtype=torch.bool, device=tokens.device)
+        kv_cache = None
+        if args.kv_cache:
+            kv_cache = mpu.KeyValueCache(args.num_layers, tokens.size(1) + args.tgt_seq_length)
+        counter = 0
+        while counter < args.tgt_seq_length:
+            if counter == 0:
+                next_token_logits, *mems = model(tokens, position_ids, attention_mask, return_memory=True,
+                                                 kv_cache=kv_cache, output_positions=last_position(tokens))
+                next_token_logits = next_token_logits[:, -1]
+                if num_beams > 1:
+                    next_token_logits = next_token_logits[batch_index]
+                    mems = [mem[batch_index] for mem in mems]
+                    if kv_cache is not None:
+                        kv_cache.reorder(batch_index)
+                position_ids = torch.stack((mask_table[:, 0], torch.ones_like(mask_table[:, 0])), dim=1)
+                position_ids = position_ids.unsqueeze(-1)
+                tokens = tokens.new_zeros(num_rows, 0)
+                attention_mask = tokens.new_zeros(num_rows)
+                # rows that are still decoding, the memories only hold these rows
+                active_rows = torch.arange(num_rows, device=tokens.device)
+                row_map = active_rows.clone()
+            else:
+                position_ids[:, 1] = position_ids[:, 1] + 1
+                last_token = tokens[:, -1:]
+                next_token_logits, *mems = model(last_token[active_rows], position_ids[active_rows],
+                                                 attention_mask[active_rows], *mems, return_memory=True,
+                                                 kv_cache=kv_cache)
+                next_token_logits = next_token_logits[:, -1]
+                if active_rows.size(0) < num_rows:
+                    full_logits = next_token_logits.new_zeros((num_rows, next_token_logits.size(-1)))
+                    full_logits[active_rows] = next_token_logits
+                    next_token_logits = full_logits
+            has_next_blank = current_blank + 1 < num_masks
+            if num_beams > 1:
+                next_token_scores, next_tokens, next_indices = self.select_beams(next_token_logits, tokens,
+                                                                                 beam_scores, args)
+                source_rows = next_indices + torch.arange(0, num_rows, num_beams, device=tokens.device).unsqueeze(1)
+                next_tokens = torch.where((next_tokens == self.end_token) & has_next_blank[source_rows],
+                                          next_tokens.new_full((), self.start_token), next_tokens)
+                beam_outputs = beam_scorer.process(
+                    tokens,
+                    next_token_scores,
+                    next_tokens,
+                    next_indices,
+                    eos_token_id=self.end_token,
+                    pad_token_id=self.pad_token
+                )
+                beam_scores = beam_outputs["next_beam_scores"]
+                beam_idx = beam_outputs["next_beam_indices"]
+                new_tokens = beam_outputs["next_beam_tokens"]
+                tokens = tokens[beam_idx]
+                position_ids, current_blank = position_ids[beam_idx], current_blank[beam_idx]
+                has_next_blank = has_next_blank[beam_idx]
+                self.processors.reorder(beam_idx)
+                done = beam_scorer.done.repeat_interleave(num_beams)
+            else:
+                next_token_scores = F.log_softmax(next_token_logits, dim=-1)
+                next_token_scores = self.processors(tokens, next_token_scores)
+                new_tokens = next_token_scores.max(dim=-1)[1]
+                is_end = new_tokens == self.end_token
+                new_tokens = torch.where(is_end & has_next_blank, new_tokens.new_full((), self.start_token),
+                                         new_tokens)
+                done = done | (is_end & ~has_next_blank)
+                new_tokens = new_tokens.masked_fill(done, self.pad_token)
+                beam_idx = None
+            next_blank = (new_tokens == self.start_token) & has_next_blank
+            current_blank = current_blank + next_blank.long()
+            position_ids[:, 0, 0] = mask_table.gather(1, current_blank.unsqueeze(1)).squeeze(1)
+            position_ids[:, 1, 0] = position_ids[:, 1, 0].masked_fill(next_blank, 0)
+            tokens = torch.cat([tokens, new_tokens.unsqueeze(-1)], dim=-1)
+            num_active = num_rows - done.sum().item()
+            if num_active == 0:
+                break
+            if beam_idx is not None or num_active < active_rows.size(0):
+                # drop the finished rows from the memories and follow the beam reordering
+                new_rows = (~done).nonzero(as_tuple=True)[0]
+                mem_index = row_map[beam_idx[new_rows]] if beam_idx is not None else row_map[new_rows]
+                mems = [mem[mem_index] for mem in mems] if mems else []
+                if kv_cache is not None:
+                    kv_cache.reorder(mem_index)
+                active_rows = new_rows
+                row_map[active_rows] = torch.arange(active_rows.size(0), device=tokens.device)
+            counter += 1
+        if num_beams > 1:
+            tokens, _, _ = beam_scorer.finalize(tokens, beam_scores, next_tokens, next_indices,
+                                                eos_token_id=self.end_token, pad_token_id=self.pad_token)
+        return tokens
+
+    def splice_blanks(self, source, output):
+        """Replace the masks in the source tokens with the generated blanks."""
+        blanks = [[]]
+        for token in output:
+            if token == self.start_token:
+                blanks.append([])
+            elif token not in [self.end_token, self.pad_token]:
+                blanks[-1].append(token)
+        output_tokens = []
+        current_blank = 0
+        for token in source:
+            if token == self.mask_token:
+                if current_blank < len(blanks):
+                    output_tokens += blanks[current_blank]
+                current_blank += 1
+            elif token != self.pad_token:
+                output_tokens.append(token)
+        return output_tokens
+
     def evaluate(self, model, dataloader, example_dict, args):
         model.eval()
-        store = torch.distributed.TCPStore(args.master_ip, 18931 + random.randint(0, 10000),
-                                           mpu.get_data_parallel_world_size(),
-                                           torch.distributed.get_rank() == 0, datetime.timedelta(seconds=30))
-        print_rank_0("Distributed store created")
-
+        local_predictions = {}
         with torch.no_grad():
             for idx, data in enumerate(dataloader):
                 tokens, attention_mask, position_ids = process_batch(data, args)
-                src_tokens = tokens
-                batch_size = tokens.size(0)
-                mask_positions = []
-                current_mask = []
-                for text in tokens.tolist():
-                    mask_positions.append([i for i, x in enumerate(text) if x == self.mask_token])
-                    current_mask.append(0)
-                    # print(self.tokenizer.DecodeIds(text))
-                    # print(mask_positions[-1])
-                counter = 0
-                done = [False] * batch_size
-                while counter < args.tgt_seq_length:
-                    if counter == 0:
-                        # print(tokens)
-                        # print(position_ids)
-                        next_token_logits, *mems = model(tokens, position_ids, attention_mask, return_memory=True)
-                        next_token_logits = next_token_logits[:, -1]
-                        position_ids = tokens.new_ones(batch_size, 2, 1)
-                        for i, text in enumerate(tokens.tolist()):
-                            mask_pos = mask_positions[i][current_mask[i]]
-                            position_ids[i, 0] = mask_pos
-                        tokens = tokens.new_zeros(batch_size, 0)
-                        attention_mask = tokens.new_zeros(batch_size)
-                    else:
-                        position_ids[:, 1] = position_ids[:, 1] + 1
-                        last_token = tokens[:, -1:]
-                        next_token_logits, *mems = model(last_token, position_ids, attention_mask, *mems,
-                                                         return_memory=True)
-                        next_token_logits = next_token_logits[:, -1]
-                    next_token_scores = F.log_softmax(next_token_logits, dim=-1)
-                    next_token_scores = self.processors(tokens, next_token_scores)
-                    next_tokens = next_token_scores.max(dim=-1)[1]
-                    # print(self.tokenizer.DecodeIds(next_tokens.tolist()))
-                    for i, next_token in enumerate(next_tokens.tolist()):
-                        if next_token == self.end_token:
-                            if current_mask[i] + 1 < len(mask_positions[i]):
-                                current_mask[i] += 1
-                                next_tokens[i] = self.start_token
-                                position_ids[i, 0] = mask_positions[i][current_mask[i]]
-                                position_ids[i, 1] = 0
-                            else:
-                                done[i] = True
-                        if done[i]:
-                            next_tokens[i] = self.pad_token
-                    if all(done):
-                        break
-                    tokens = torch.cat([tokens, next_tokens.unsqueeze(-1)], dim=-1)
-                    counter += 1
+                outputs = self.fill_blanks(model, tokens, attention_mask, position_ids, args)
                 predictions = []
-                for i, text in enumerate(tokens.tolist()):
-                    text = [token for token in text if token not in [self.end_token, self.pad_token]]
-                    blanks = [[]]
-                    for token in text:
-                        if token == self.start_token:
-                            blanks.append([])
-                        else:
-                            blanks[-1].append(token)
-                    output_tokens = []
-                    current_blank = 0
-                    for token in src_tokens[i].tolist():
-                        if token == self.mask_token:
-                            if current_blank < len(blanks):
-                                output_tokens += blanks[current_blank]
-                            current_blank += 1
-                        else:
-                            if token not in [self.pad_token]:
-                                output_tokens.append(token)
-                    text = self.tokenizer.DecodeIds(output_tokens[:-1])
+                for source, output in zip(tokens.tolist(), outputs.tolist()):
+                    text = self.tokenizer.DecodeIds(self.splice_blanks(source, output)[:-1])
                     text = blanklm_fix_tokenization(text)
                     predictions.append(text)
-                    # print(text)
                 uid_list = data['uid']
                 if isinstance(uid_list, torch.Tensor):
                     uid_list = uid_list.cpu().numpy().tolist()
                 for uid, prediction in zip(uid_list, predictions):
-                    store.set(uid, prediction)
+                    local_predictions[uid] = prediction
                 if (idx + 1) % args.log_interval == 0:
                     print_rank_0(f"Iteration {idx + 1} / {len(dataloader)}")
 
         model.train()
-        torch.distributed.barrier()
         print_rank_0("Evaluation completed")
-        predictions, examples = [], []
-        for uid, example in example_dict.items():
-            predictions.append(store.get(uid).decode('utf-8'))
-            examples.append(example)
-        torch.distributed.barrier()
+        predictions, examples = gather_results(local_predictions, example_dict)
         return predictions, [], examples
@@ -21,6 +21,7 @@ import functools
 from tasks.eval_utils import accuracy_func_provider
 from finetune_glm import finetune
 from pretrain_glm import get_batch
+from model import select_output_positions
 from collections import OrderedDict
 from tasks.seq2seq.dataset import Seq2SeqDataset, BlankLMDataset, ExtractionDataset, CustomizationDataset
 from tasks.seq2seq.evaluate import rouge_metric, DecoderEvaluater, BlankLMEvaluater
@@ -38,8 +39,10 @@ def seq2seq_forward_step(data, model, args, timers, mems):
     tokens, labels, loss_mask, attention_mask, position_ids = get_batch(data, args)
     if timers is not None:
         timers('batch generator').stop()
-    # Forward model.
-    logits, *mems = model(tokens, position_ids, attention_mask, *mems)
+    # Forward model, only the logits of the target tokens are computed.
+    output_positions = select_output_positions(loss_mask)
+    labels, loss_mask = labels.gather(1, output_positions), loss_mask.gather(1, output_positions)
+    logits, *mems = model(tokens, position_ids, attention_mask, *mems, output_positions=output_positions)
     # logits, loss_mask = logits[:, args.src_seq_length:], loss_mask[:, args.src_seq_length:]
     # target_ids = target_ids[:, args.src_seq_length:]
     losses = mpu.vocab_parallel_cross_entropy(logits.contiguous().float(), labels)
@@ -0,0 +1,41 @@
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+import mpu
+from utils import save_checkpoint, wait_checkpoints, get_checkpoint_name, get_checkpoint_tracker_filename, \
+    get_async_writer
+
+
+def main():
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '6001')
+    torch.distributed.init_process_group(backend='gloo', world_size=1, rank=0)
+    mpu.initialize_model_parallel(1)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = torch.nn.Sequential(*[torch.nn.Linear(1024, 1024) for _ in range(16)]).to(device)
+    with tempfile.TemporaryDirectory() as save:
+        args = argparse.Namespace(save=save, deepspeed=False, no_save_optim=True, no_save_rng=True,
+                                  async_save=True, async_save_max_in_flight=2)
+        start = time.time()
+        for iteration in range(1, 4):
+            save_checkpoint(iteration, model, None, None, args)
+            # the snapshot is taken, changing the parameters does not change the checkpoint
+            with torch.no_grad():
+                for param in model.parameters():
+                    param.add_(1.0)
+        blocking_time = time.time() - start
+        wait_checkpoints(args)
+        total_time = time.time() - start
+        with open(get_checkpoint_tracker_filename(save)) as f:
+            assert f.read() == '3'
+        sd = torch.load(get_checkpoint_name(save, '3'), map_location='cpu')
+        for key, value in model.state_dict().items():
+            assert torch.equal(sd['module'][key] + 1.0, value.cpu()), key
+        assert not any(name.endswith('.tmp') for _, _, names in os.walk(save) for name in names)
+        # the pinned buffers of the first saves are reused by the last one
+        assert len(get_async_writer(args).buffer_pool) == args.async_save_max_in_flight
+    print(f"blocking time {blocking_time:.2f} s, total time {total_time:.2f} s")
@@ -0,0 +1,66 @@
+import math
+import time
+
+import torch
+
+from mpu.transformer import chunked_attention, sdpa_attention, sep_mask
+
+
+def naive_attention(query_layer, key_layer, value_layer, ltor_mask, attention_scale=1.0):
+    """The score-matrix path of ParallelSelfAttention, without dropout."""
+    head_size = query_layer.size(-1)
+    if attention_scale > 1.0:
+        attention_scores = torch.matmul(query_layer / math.sqrt(attention_scale),
+                                        key_layer.transpose(-1, -2) / math.sqrt(head_size * attention_scale))
+    else:
+        attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2) / math.sqrt(head_size))
+    attention_scores = torch.mul(attention_scores, ltor_mask)
+    if attention_scale > 1.0:
+        max_attention_scores = attention_scores.max(dim=-1, keepdim=True)[0]
+        attention_scores -= max_attention_scores
+        attention_scores *= attention_scale
+    attention_scores = attention_scores + (-65504.0) * (1.0 - ltor_mask)
+    attention_probs = torch.nn.Softmax(dim=-1)(attention_scores)
+    return torch.matmul(attention_probs, value_layer)
+
+
+def build_mask(seq_length, sep):
+    m = torch.ones((1, seq_length, seq_length)).tril()
+    m = m.expand(sep.size(0), -1, -1)
+    ids = torch.arange(seq_length).view(1, -1)
+    m = m.masked_fill((ids < sep.view(-1, 1)).unsqueeze(1).expand_as(m), 1)
+    return m.unsqueeze(1)
+
+
+def benchmark(function, *args, repeat=5, **kwargs):
+    output = function(*args, **kwargs)
+    start = time.time()
+    for _ in range(repeat):
+        function(*args, **kwargs)
+    return output, (time.time() - start) / repeat
+
+
+def main():
+    torch.manual_seed(0)
+    backends = [('chunked', chunked_attention)]
+    if hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+        backends.append(('sdpa', sdpa_attention))
+    for batch_size, num_heads, seq_length, head_size in [(4, 16, 512, 64), (1, 16, 2048, 64)]:
+        query, key, value = torch.randn(3, batch_size, num_heads, seq_length, head_size).unbind(0)
+        sep = torch.randint(1, seq_length, (batch_size,))
+        mask = build_mask(seq_length, sep)
+        with torch.no_grad():
+            reference, naive_time = benchmark(naive_attention, query, key, value, mask)
+            print(f"b={batch_size} np={num_heads} s={seq_length}: naive {naive_time * 1000:.1f}ms")
+            for name, function in backends:
+                output, backend_time = benchmark(function, query, key, value, mask)
+                error = (output - reference).abs().max().item()
+                print(f"    {name} {backend_time * 1000:.1f}ms, speedup {naive_time / backend_time:.2f}x, "
+                      f"max error {error:.2e}")
+                assert error < 1e-4
+            assert torch.equal(sep_mask(sep, seq_length), mask.bool())
+            output = chunked_attention(query, key, value, sep)
+            assert (output - reference).abs().max().item() < 1e-4
+            scaled = naive_attention(query, key, value, mask, attention_scale=4.0)
+            output = chunked_attention(query, key, value, mask, attention_scale=4.0)
+            assert (output - scaled).abs().max().item() < 1e-4
@@ -0,0 +1,87 @@
+import torch
+import torch.nn.functional as F
+from generation_utils import BeamSearchScorer, TensorBeamSearchScorer, NoRepeatNGramLogitsProcessor, \
+    IncrementalNoRepeatNGramLogitsProcessor, top_k_logits
+
+
+def run_beam_search(scorer_cls, logits, batch_size, num_beams, eos_token_id, pad_token_id, growing_mems=False):
+    """The memories of a hypothesis are its tokens if `growing_mems`, else a fixed-length summary of them."""
+    beam_scorer = scorer_cls(batch_size=batch_size, max_length=logits.size(0), num_beams=num_beams,
+                             device=logits.device, length_penalty=1.0)
+    beam_scores = torch.zeros((batch_size, num_beams), dtype=torch.float)
+    beam_scores[:, 1:] = -1e9
+    beam_scores = beam_scores.view(-1)
+    tokens = torch.zeros((batch_size * num_beams, 0), dtype=torch.long)
+    mems = [torch.zeros((batch_size * num_beams, 0 if growing_mems else 2, 2))]
+    for step_logits in logits:
+        next_token_scores = F.log_softmax(step_logits, dim=-1)
+        next_token_scores = next_token_scores + beam_scores[:, None]
+        vocab_size = next_token_scores.shape[-1]
+        next_token_scores = next_token_scores.view(batch_size, num_beams * vocab_size)
+        next_token_scores, next_tokens = torch.topk(next_token_scores, 2 * num_beams, dim=1)
+        next_indices = next_tokens // vocab_size
+        next_tokens = next_tokens % vocab_size
+        beam_outputs = beam_scorer.process(tokens, next_token_scores, next_tokens, next_indices,
+                                           eos_token_id=eos_token_id, pad_token_id=pad_token_id, mems=mems)
+        beam_scores = beam_outputs["next_beam_scores"]
+        beam_idx = beam_outputs["next_beam_indices"]
+        tokens = torch.cat([tokens[beam_idx, :], beam_outputs["next_beam_tokens"].unsqueeze(-1)], dim=-1)
+        if growing_mems:
+            mems = [torch.stack((tokens, -tokens), dim=-1).float()]
+        else:
+            mems = [mems[0][beam_idx] * 0.5 + tokens[:, -1:, None].float()]
+        if beam_scorer.is_done:
+            break
+    return beam_scorer.finalize(tokens, beam_scores, None, None, eos_token_id=eos_token_id,
+                                pad_token_id=pad_token_id, mems=mems)
+
+
+def check_no_repeat_ngram(ngram_size=3, num_hypos=6, vocab_size=5, length=30):
+    processor = NoRepeatNGramLogitsProcessor(ngram_size)
+    incremental_processor = IncrementalNoRepeatNGramLogitsProcessor(ngram_size)
+    tokens = torch.zeros((num_hypos, 0), dtype=torch.long)
+    for _ in range(length):
+        scores = torch.randn(num_hypos, vocab_size)
+        expected = processor(tokens, scores.clone())
+        result = incremental_processor(tokens, scores.clone())
+        assert torch.equal(expected, result), (expected, result)
+        beam_idx = torch.randint(num_hypos, (num_hypos,))
+        incremental_processor.reorder(beam_idx)
+        tokens = torch.cat([tokens[beam_idx], torch.randint(vocab_size, (num_hypos, 1))], dim=-1)
+
+
+def check_top_p(top_p=0.9, batch_size=8, vocab_size=1000):
+    logits = torch.randn(batch_size, vocab_size) * 4
+    filtered = top_k_logits(logits.clone(), top_p=top_p, num_candidates=16)
+    for row, filtered_row in zip(logits, filtered):
+        sorted_logits, sorted_indices = torch.sort(row, descending=True)
+        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+        num_kept = int((cumulative_probs <= top_p).sum()) + 1
+        expected = torch.full_like(row, -float('Inf'))
+        expected[sorted_indices[:num_kept]] = row[sorted_indices[:num_kept]]
+        assert torch.equal(expected, filtered_row)
+
+
+def main():
+    torch.manual_seed(1234)
+    check_top_p()
+    print("Batched top-p filtering matches the single row version")
+    check_no_repeat_ngram()
+    print("IncrementalNoRepeatNGramLogitsProcessor matches NoRepeatNGramLogitsProcessor")
+    batch_size, num_beams, vocab_size, max_length = 4, 3, 12, 16
+    eos_token_id, pad_token_id = 0, 1
+    for i in range(40):
+        # the memories of different lengths can only be concatenated for a single batch item
+        growing_mems = i % 2 == 1
+        batch_size_ = 1 if growing_mems else batch_size
+        logits = torch.randn(max_length, batch_size_ * num_beams, vocab_size) * 3
+        logits[:, :, pad_token_id] = -1e4
+        decoded, mems, scores = run_beam_search(BeamSearchScorer, logits, batch_size_, num_beams, eos_token_id,
+                                                pad_token_id, growing_mems=growing_mems)
+        tensor_decoded, tensor_mems, tensor_scores = run_beam_search(TensorBeamSearchScorer, logits, batch_size_,
+                                                                     num_beams, eos_token_id, pad_token_id,
+                                                                     growing_mems=growing_mems)
+        assert torch.equal(decoded, tensor_decoded), (decoded, tensor_decoded)
+        assert torch.allclose(scores, tensor_scores), (scores, tensor_scores)
+        assert torch.equal(mems[0], tensor_mems[0]), (mems, tensor_mems)
+    print("TensorBeamSearchScorer matches BeamSearchScorer")
@@ -0,0 +1,58 @@
+import copy
+import os
+
+import torch
+import torch.multiprocessing as mp
+
+import mpu
+from model import GLMModel, DistributedDataParallel as LocalDDP
+
+WORLD_SIZE = 2
+
+
+def get_batch(rank, batch_size=4, seq_length=64):
+    generator = torch.Generator().manual_seed(rank)
+    tokens = torch.randint(1024, (batch_size, seq_length), generator=generator)
+    position_ids = torch.stack((torch.arange(seq_length).expand(batch_size, -1),
+                                torch.zeros(batch_size, seq_length, dtype=torch.long)), dim=1)
+    sep = torch.randint(1, seq_length, (batch_size,), generator=generator)
+    return tokens, position_ids, sep
+
+
+def backward(model, rank):
+    tokens, position_ids, sep = get_batch(rank)
+    logits = model(tokens, position_ids, sep)[0]
+    loss = torch.nn.functional.cross_entropy(logits.view(-1, logits.size(-1)), tokens.view(-1))
+    loss.backward()
+
+
+def run(rank):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = '6002'
+    torch.distributed.init_process_group(backend='gloo', world_size=WORLD_SIZE, rank=rank)
+    mpu.initialize_model_parallel(1)
+    torch.manual_seed(1234)
+    module = GLMModel(num_layers=2, vocab_size=1024, hidden_size=128, num_attention_heads=4,
+                      embedding_dropout_prob=0.0, attention_dropout_prob=0.0, output_dropout_prob=0.0,
+                      max_sequence_length=128, max_memory_length=0, checkpoint_activations=False,
+                      block_position_encoding=True)
+    # the data parallel average of the gradients computed on a single process
+    reference = copy.deepcopy(module)
+    for i in range(WORLD_SIZE):
+        backward(reference, i)
+    reference = {name: param.grad / WORLD_SIZE for name, param in reference.named_parameters()}
+    for overlap_allreduce in [False, True]:
+        model = LocalDDP(copy.deepcopy(module), overlap_allreduce=overlap_allreduce, bucket_cap_mb=0.1)
+        # two steps, to check that the buckets are reset after a step
+        for _ in range(2):
+            model.zero_grad()
+            backward(model, rank)
+            model.allreduce_params(reduce_after=False)
+        error = max((param.grad - reference[name]).abs().max().item() for name, param in model.named_parameters())
+        if rank == 0:
+            print(f"overlap {overlap_allreduce}: {len(model.buckets)} buckets, max error {error:.2e}")
+        assert error < 1e-5
+
+
+def main():
+    mp.spawn(run, nprocs=WORLD_SIZE)
@@ -0,0 +1,57 @@
+import os
+
+import torch
+
+import mpu
+from model import EncoderDecoder
+
+
+def main():
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '6001')
+    torch.distributed.init_process_group(backend='gloo', world_size=1, rank=0)
+    mpu.initialize_model_parallel(1)
+    torch.manual_seed(1234)
+    vocab_size = 1024
+    model = EncoderDecoder(num_layers=2, vocab_size=vocab_size, hidden_size=128, num_attention_heads=4,
+                           embedding_dropout_prob=0.0, attention_dropout_prob=0.0, output_dropout_prob=0.0,
+                           max_sequence_length=64, max_memory_length=0, checkpoint_activations=False)
+    model.eval()
+    batch_size, num_beams, source_length, prompt_length, num_steps = 3, 4, 24, 3, 8
+    source_ids = torch.randint(vocab_size, (batch_size, source_length))
+    source_position_ids = torch.arange(source_length).expand(batch_size, -1)
+    # the source is bidirectional, the target is causal
+    source_mask, target_mask = torch.tensor(source_length), torch.tensor(0)
+    target_ids = torch.randint(vocab_size, (batch_size, prompt_length))
+
+    def reference(source_ids, target_ids):
+        target_position_ids = torch.arange(target_ids.size(1)).expand(target_ids.size(0), -1)
+        source_position_ids_ = source_position_ids[:1].expand(source_ids.size(0), -1)
+        return model(source_ids, target_ids, source_position_ids_, target_position_ids, source_mask,
+                     target_mask)[0][:, -1]
+
+    max_error = 0.0
+    with torch.no_grad():
+        encoder_output, kv_cache = model.encode(source_ids, source_position_ids, source_mask,
+                                                max_length=prompt_length + num_steps)
+        target_position_ids = torch.arange(prompt_length).expand(batch_size, -1)
+        logits = model.decode_step(target_ids, target_position_ids, target_mask, kv_cache,
+                                   encoder_output=encoder_output)[0][:, -1]
+        expected = reference(source_ids, target_ids)
+        max_error = max(max_error, (logits - expected).abs().max().item())
+        # expand the prompt to the beams, then reshuffle the beams of every source at each step
+        beam_idx = torch.arange(batch_size).repeat_interleave(num_beams)
+        source_ids = source_ids[beam_idx]
+        for step in range(num_steps):
+            kv_cache.reorder(beam_idx)
+            target_ids = target_ids[beam_idx]
+            next_tokens = torch.randint(vocab_size, (batch_size * num_beams, 1))
+            target_ids = torch.cat((target_ids, next_tokens), dim=1)
+            position_ids = torch.full((batch_size * num_beams, 1), target_ids.size(1) - 1, dtype=torch.long)
+            logits = model.decode_step(next_tokens, position_ids, target_mask, kv_cache)[0][:, -1]
+            expected = reference(source_ids, target_ids)
+            max_error = max(max_error, (logits - expected).abs().max().item())
+            beam_idx = torch.arange(batch_size).repeat_interleave(num_beams) * num_beams + \
+                torch.randint(num_beams, (batch_size * num_beams,))
+    print(f"max difference between decode_step and forward logits {max_error:.2e}")
+    assert max_error < 1e-4
@@ -0,0 +1,97 @@
+import copy
+import os
+import time
+
+import torch
+
+import mpu
+from fp16 import FP16_Optimizer
+
+
+def set_model_parallel(model):
+    # the attribute is not kept by copy.deepcopy
+    for param in model.parameters():
+        param.model_parallel = False
+
+
+def build(model, flat_master):
+    set_model_parallel(model)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    return FP16_Optimizer(optimizer, dynamic_loss_scale=True, flat_master=flat_master)
+
+
+def train(model, optimizer, inputs, steps):
+    torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(steps):
+        optimizer.zero_grad()
+        loss = model(inputs).float().pow(2).mean()
+        optimizer.backward(loss)
+        optimizer.clip_master_grads(1.0)
+        optimizer.step()
+    torch.cuda.synchronize()
+    return (time.time() - start) / steps
+
+
+def check_unused_parameters(steps=20):
+    """The flat buffers do not update the parameters without a gradient, on CPU."""
+    torch.manual_seed(1234)
+    model = torch.nn.ModuleDict({'used': torch.nn.Linear(32, 32), 'unused': torch.nn.Linear(32, 32),
+                                 'frozen': torch.nn.Linear(32, 32).requires_grad_(False)}).half()
+    inputs = torch.randn(8, 32, dtype=torch.half)
+    results = {}
+    for flat_master in [False, True]:
+        model_ = copy.deepcopy(model)
+        set_model_parallel(model_)
+        optimizer = FP16_Optimizer(torch.optim.Adam(model_.parameters(), lr=1e-2, weight_decay=0.1),
+                                   dynamic_loss_scale=True, flat_master=flat_master)
+        for _ in range(steps):
+            optimizer.zero_grad()
+            loss = model_['used'](model_['frozen'](inputs)).float().pow(2).mean()
+            optimizer.backward(loss)
+            optimizer.clip_master_grads(1.0)
+            optimizer.step()
+        results[flat_master] = model_
+    for (name, param), flat_param, initial in zip(results[False].named_parameters(), results[True].parameters(),
+                                                  model.parameters()):
+        assert torch.allclose(param, flat_param), name
+        if name.startswith('used'):
+            assert not torch.equal(flat_param, initial), name
+        else:
+            assert torch.equal(flat_param, initial), name
+
+
+def main():
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '6001')
+    # the overflow check and the gradient clipping reduce over the model parallel group
+    torch.distributed.init_process_group(backend='gloo', world_size=1, rank=0)
+    mpu.initialize_model_parallel(1)
+    check_unused_parameters()
+    print("The flat buffers match the per-parameter FP16_Optimizer and skip the unused parameters")
+    if not torch.cuda.is_available():
+        print("The flat buffer benchmark needs CUDA, skip")
+        return
+    torch.manual_seed(1234)
+    layers = []
+    for _ in range(24):
+        layers += [torch.nn.Linear(512, 512), torch.nn.LayerNorm(512)]
+    model = torch.nn.Sequential(*layers).cuda().half()
+    inputs = torch.randn(16, 512, device='cuda', dtype=torch.half)
+    results = {}
+    for flat_master in [False, True]:
+        model_ = copy.deepcopy(model)
+        optimizer = build(model_, flat_master)
+        # the first steps probe the loss scale
+        train(model_, optimizer, inputs, steps=20)
+        results[flat_master] = (model_, optimizer, train(model_, optimizer, inputs, steps=20))
+    (reference, reference_optimizer, step_time), (model_, optimizer, flat_step_time) = results[False], results[True]
+    error = max((p - q).abs().max().item() for p, q in zip(model_.parameters(), reference.parameters()))
+    print(f"step {step_time * 1000:.2f} ms, flat step {flat_step_time * 1000:.2f} ms, max difference {error:.2e}")
+    assert error < 1e-2
+    # the state dicts are interchangeable
+    loaded = build(copy.deepcopy(reference), flat_master=True)
+    loaded.load_state_dict(reference_optimizer.state_dict())
+    for current, saved in zip(loaded.fp32_from_fp16_groups[0], reference_optimizer.fp32_from_fp16_groups[0]):
+        assert torch.equal(current, saved)
+    build(copy.deepcopy(model_), flat_master=False).load_state_dict(optimizer.state_dict())
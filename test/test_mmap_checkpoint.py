@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+import torch
+
+from mmap_checkpoint import MmapCheckpoint, convert_checkpoint, load_checkpoint_file
+
+
+def main():
+    torch.manual_seed(1234)
+    model = torch.nn.Sequential(torch.nn.Linear(64, 32), torch.nn.LayerNorm(32), torch.nn.Linear(32, 3)).half()
+    module = model.state_dict()
+    module['bfloat16'] = torch.randn(7, 5).bfloat16()
+    module['empty'] = torch.zeros(0, 4)
+    module['scalar'] = torch.tensor(3, dtype=torch.long)
+    sd = {'iteration': 100, 'module': module,
+          'optimizer': {'state': {0: {'exp_avg': torch.randn(32, 64)}}, 'loss_scale': 1024.0},
+          'random_rng_state': (3, (1, 2, 3), None)}
+    with tempfile.TemporaryDirectory() as directory:
+        checkpoint_name = os.path.join(directory, 'mp_rank_00_model_states.pt')
+        torch.save(sd, checkpoint_name)
+        convert_checkpoint(checkpoint_name)
+        loaded = load_checkpoint_file(checkpoint_name)
+        assert isinstance(loaded, MmapCheckpoint)
+        assert loaded['iteration'] == 100
+        for key, value in sd['module'].items():
+            assert loaded['module'][key].dtype == value.dtype and torch.equal(loaded['module'][key], value), key
+        # the optimizer section is only read when it is loaded
+        assert 'optimizer' not in loaded.loaded
+        assert torch.equal(loaded['optimizer']['state'][0]['exp_avg'], sd['optimizer']['state'][0]['exp_avg'])
+        assert loaded['random_rng_state'] == sd['random_rng_state']
+        assert set(loaded) == set(sd)
+        try:
+            loaded['lr_scheduler']
+        except KeyError:
+            pass
+        else:
+            raise AssertionError('lr_scheduler is not in the checkpoint')
+        missing_keys, unexpected_keys = model.load_state_dict(loaded['module'], strict=False)
+        assert not missing_keys and sorted(unexpected_keys) == ['bfloat16', 'empty', 'scalar']
+    print("memory-mapped checkpoint matches the pickled checkpoint")
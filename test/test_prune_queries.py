@@ -0,0 +1,42 @@
+import os
+import time
+
+import torch
+
+import mpu
+from model import GLMModel
+
+
+def main():
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '6001')
+    torch.distributed.init_process_group(backend='gloo', world_size=1, rank=0)
+    mpu.initialize_model_parallel(1)
+    torch.manual_seed(1234)
+    batch_size, seq_length = 8, 512
+    tokens = torch.randint(1024, (batch_size, seq_length))
+    position_ids = torch.stack((torch.arange(seq_length).expand(batch_size, -1),
+                                torch.zeros(batch_size, seq_length, dtype=torch.long)), dim=1)
+    sep = torch.randint(1, seq_length, (batch_size,))
+    # the pooled token of classification
+    output_positions = (sep - 1).view(-1, 1)
+    for backend in ['naive', 'chunked', 'sdpa']:
+        if backend == 'sdpa' and not hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
+            continue
+        model = GLMModel(num_layers=2, vocab_size=1024, hidden_size=256, num_attention_heads=4,
+                         embedding_dropout_prob=0.0, attention_dropout_prob=0.0, output_dropout_prob=0.0,
+                         max_sequence_length=seq_length, max_memory_length=0, checkpoint_activations=False,
+                         block_position_encoding=True, output_predict=False, attention_backend=backend)
+        model.eval()
+        results = []
+        for prune_queries in [False, True]:
+            model.transformer.prune_queries = prune_queries
+            with torch.no_grad():
+                start = time.time()
+                output = model(tokens, position_ids, sep, output_positions=output_positions)[0]
+                results.append((output, time.time() - start))
+        (reference, full_time), (output, pruned_time) = results
+        error = (output - reference).abs().max().item()
+        print(f"{backend}: full {full_time * 1000:.1f} ms, pruned {pruned_time * 1000:.1f} ms, max error {error:.2e}")
+        assert output.size() == (batch_size, 1, 256)
+        assert error < 1e-4
@@ -0,0 +1,44 @@
+import os
+
+import torch
+import torch.nn.functional as F
+
+import mpu
+from model import GLMModel
+
+
+def check_quantization(dtype):
+    torch.manual_seed(1234)
+    model = GLMModel(num_layers=4, vocab_size=1024, hidden_size=256, num_attention_heads=4,
+                     embedding_dropout_prob=0.0, attention_dropout_prob=0.0, output_dropout_prob=0.0,
+                     max_sequence_length=256, max_memory_length=0, checkpoint_activations=False,
+                     block_position_encoding=True)
+    model.to(dtype)
+    model.eval()
+    batch_size, seq_length = 8, 128
+    tokens = torch.randint(1024, (batch_size, seq_length))
+    position_ids = torch.stack((torch.arange(seq_length).expand(batch_size, -1),
+                                torch.zeros(batch_size, seq_length, dtype=torch.long)), dim=1)
+    sep = torch.randint(1, seq_length, (batch_size,))
+    with torch.no_grad():
+        reference = model(tokens, position_ids, sep)[0]
+        model.quantize_int8()
+        assert model.word_embeddings(tokens).dtype == dtype
+        output = model(tokens, position_ids, sep)[0]
+    assert output.dtype == dtype
+    output, reference = output.float(), reference.float()
+    relative_error = ((output - reference).norm() / reference.norm()).item()
+    agreement = (output.argmax(dim=-1) == reference.argmax(dim=-1)).float().mean().item()
+    kl = F.kl_div(F.log_softmax(output, dim=-1), F.log_softmax(reference, dim=-1), log_target=True,
+                  reduction='batchmean').item()
+    print(f"{dtype}: relative error {relative_error:.2e}, top-1 agreement {agreement:.4f}, KL {kl:.2e}")
+    assert relative_error < 0.05
+
+
+def main():
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '6001')
+    torch.distributed.init_process_group(backend='gloo', world_size=1, rank=0)
+    mpu.initialize_model_parallel(1)
+    check_quantization(torch.float)
+    check_quantization(torch.half)
@@ -0,0 +1,70 @@
+import torch
+import torch.nn.functional as F
+from generation_utils import LogitsProcessorList, NoRepeatNGramLogitsProcessor, \
+    IncrementalNoRepeatNGramLogitsProcessor
+from speculative_decoding import SpeculativeSampler
+
+
+class BigramModel(object):
+    """Model whose logits only depend on the last token, with the fed tokens as memory."""
+
+    def __init__(self, logits):
+        self.logits = logits
+
+    def __call__(self, tokens, position_ids, attention_mask, *mems, return_memory=False):
+        memory = tokens.unsqueeze(-1).float()
+        if mems:
+            memory = torch.cat((mems[0], memory), dim=1)
+        return self.logits[tokens], memory
+
+
+def get_inputs(start, length):
+    return None, None
+
+
+def check_no_repeat_ngram(ngram_size=2, batch_size=3, vocab_size=16, num_draft_tokens=2, length=40):
+    target_logits = torch.randn(vocab_size, vocab_size) * 3
+    processors = LogitsProcessorList([IncrementalNoRepeatNGramLogitsProcessor(ngram_size)])
+    # the draft model does not apply the processors, so its repeated n-grams are rejected
+    model = BigramModel(target_logits)
+    sampler = SpeculativeSampler(model, model, num_draft_tokens, greedy=True, processors=processors)
+    sampler.start()
+    tokens = torch.randint(vocab_size, (batch_size, 1))
+    processor = NoRepeatNGramLogitsProcessor(ngram_size)
+    num_accepted = []
+    while tokens.size(1) < length:
+        new_tokens = sampler.step(tokens, get_inputs)
+        num_accepted.append(new_tokens.size(1) - 1)
+        tokens = torch.cat((tokens, new_tokens), dim=1)
+        # the state of the processor only holds the n-grams of the accepted tokens
+        scores = torch.randn(batch_size, vocab_size)
+        assert torch.equal(processors(tokens, scores.clone()), processor(tokens, scores.clone()))
+    assert any(0 < n < num_draft_tokens for n in num_accepted), num_accepted
+    # greedy decoding of the target model with the stateless processor
+    expected = tokens[:, :1]
+    while expected.size(1) < tokens.size(1):
+        scores = processor(expected, F.log_softmax(target_logits[expected[:, -1]], dim=-1))
+        expected = torch.cat((expected, scores.argmax(dim=-1, keepdim=True)), dim=1)
+    assert torch.equal(tokens, expected), (tokens, expected)
+
+
+def check_normalized_scores(ngram_size=2, batch_size=3, vocab_size=16, num_draft_tokens=4):
+    target_logits = torch.randn(vocab_size, vocab_size)
+    processors = LogitsProcessorList([NoRepeatNGramLogitsProcessor(ngram_size)])
+    sampler = SpeculativeSampler(BigramModel(target_logits), BigramModel(target_logits), num_draft_tokens,
+                                 processors=processors)
+    sampler.start()
+    tokens = torch.randint(vocab_size // 2, (batch_size, 20))
+    draft_tokens = torch.randint(vocab_size // 2, (batch_size, num_draft_tokens))
+    scores = sampler._score(tokens, draft_tokens, get_inputs)
+    assert torch.isinf(scores).any()
+    assert torch.allclose(scores.exp().sum(dim=-1), torch.ones(batch_size, num_draft_tokens + 1))
+
+
+def main():
+    torch.manual_seed(1234)
+    for _ in range(10):
+        check_no_repeat_ngram()
+    print("Greedy speculative decoding with IncrementalNoRepeatNGramLogitsProcessor matches greedy decoding")
+    check_normalized_scores()
+    print("The processed target scores of speculative decoding are normalized")
@@ -0,0 +1,85 @@
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+import mpu
+from fp16 import DynamicLossScaler
+from model import GLMModel
+
+
+def legacy_step(loss, loss_mask, parameters, max_norm):
+    """The loss normalization, overflow check and clipping with one host read per parameter."""
+    if loss_mask.sum().item() > 0:
+        loss = loss / loss_mask.sum()
+    loss.backward()
+    for p in parameters:
+        if DynamicLossScaler._has_inf_or_nan(p.grad.data):
+            return
+    total_norm = 0
+    for p in parameters:
+        total_norm += p.grad.data.norm(2).item() ** 2
+    clip_coef = max_norm / (total_norm ** 0.5 + 1e-6)
+    if clip_coef < 1:
+        for p in parameters:
+            p.grad.data.mul_(clip_coef)
+
+
+def sync_free_step(loss, loss_mask, parameters, max_norm):
+    """The same step with on-device reductions and a single host read of the overflow flag."""
+    num_tokens = loss_mask.sum()
+    loss = loss / torch.where(num_tokens > 0, num_tokens, torch.ones_like(num_tokens))
+    loss.backward()
+    if DynamicLossScaler._overflow_flag(parameters).item():
+        return
+    mpu.clip_grad_norm(parameters, max_norm)
+
+
+def main():
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '6001')
+    torch.distributed.init_process_group(backend='gloo', world_size=1, rank=0)
+    mpu.initialize_model_parallel(1)
+    torch.manual_seed(1234)
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+    model = GLMModel(num_layers=4, vocab_size=1024, hidden_size=256, num_attention_heads=4,
+                     embedding_dropout_prob=0.0, attention_dropout_prob=0.0, output_dropout_prob=0.0,
+                     max_sequence_length=256, max_memory_length=0, checkpoint_activations=False,
+                     block_position_encoding=True).to(device)
+    parameters = list(model.parameters())
+    # Add model parallel attribute if it is not set, as get_optimizer_param_groups does.
+    for param in parameters:
+        if not hasattr(param, 'model_parallel'):
+            param.model_parallel = False
+    batch_size, seq_length = 8, 128
+    tokens = torch.randint(1024, (batch_size, seq_length), device=device)
+    position_ids = torch.stack((torch.arange(seq_length, device=device).expand(batch_size, -1),
+                                torch.zeros(batch_size, seq_length, dtype=torch.long, device=device)), dim=1)
+    sep = torch.randint(1, seq_length, (batch_size,), device=device)
+    loss_mask = (torch.arange(seq_length, device=device) >= sep.view(-1, 1)).float()
+
+    def run(step, repeat=10):
+        for i in range(repeat + 1):
+            if i == 1:
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.time()
+            model.zero_grad()
+            logits = model(tokens, position_ids, sep)[0]
+            losses = F.cross_entropy(logits.view(-1, logits.size(-1)), tokens.view(-1), reduction='none')
+            step(torch.sum(losses * loss_mask.view(-1)), loss_mask, parameters, max_norm=1.0)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return (time.time() - start) / repeat
+
+    torch.manual_seed(0)
+    run(legacy_step, repeat=1)
+    reference = [p.grad.clone() for p in parameters]
+    torch.manual_seed(0)
+    run(sync_free_step, repeat=1)
+    error = max((p.grad - g).abs().max().item() for p, g in zip(parameters, reference))
+    legacy_time, sync_free_time = run(legacy_step), run(sync_free_step)
+    print(f"{device.type}: {len(parameters)} parameters, legacy step {legacy_time * 1000:.1f} ms, "
+          f"sync-free step {sync_free_time * 1000:.1f} ms, max gradient difference {error:.2e}")
+    assert error < 1e-5
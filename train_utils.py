@@ -11,6 +11,7 @@ from model import GLMForMultiTokenCloze, GLMForMultiTokenClozeFast, GLMForSingle
 from model import PyTorchDistributedDataParallel as TorchDDP, DistributedDataParallel as LocalDDP
 from model.modeling_bert import BertForMultipleChoice, BertForSequenceClassification
 from utils import print_rank_0, get_checkpoint_name, get_checkpoint_iteration
+from mmap_checkpoint import load_checkpoint_file
 
 
 def load_pretrained(model, checkpoint_path, args, task_tokens=None):
@@ -19,8 +20,8 @@ def load_pretrained(model, checkpoint_path, args, task_tokens=None):
     if mpu.get_data_parallel_rank() == 0:
         print('global rank {} is loading pretrained model {}'.format(
             torch.distributed.get_rank(), checkpoint_name))
-    # Load the checkpoint.
-    sd = torch.load(checkpoint_name, map_location='cpu')
+    # Load the checkpoint, only the module section of a converted checkpoint is read.
+    sd = load_checkpoint_file(checkpoint_name)
     if args.deepspeed:
         model = model.module
     if isinstance(model, TorchDDP):
@@ -103,7 +104,11 @@ def get_model(args, model_type=None, multi_token=True, num_labels=None, spell_le
                          output_predict=output_predict,
                          spell_length=spell_length,
                          spell_func=args.prompt_func,
-                         attention_scale=args.attention_scale)
+                         attention_scale=args.attention_scale,
+                         performer=args.performer,
+                         performer_num_features=args.performer_num_features,
+                         attention_backend=args.attention_backend,
+                         prune_queries=args.prune_queries)
         if args.freeze_transformer:
             model.freeze_transformer(tune_prefix_layers=args.tune_prefix_layers)
         if model_type is not None:
@@ -113,7 +118,8 @@ def get_model(args, model_type=None, multi_token=True, num_labels=None, spell_le
                         if args.fast_decode:
                             model = GLMForMultiTokenClozeFast(model, length_penalty=args.length_penalty)
                         else:
-                            model = GLMForMultiTokenCloze(model, length_penalty=args.length_penalty)
+                            model = GLMForMultiTokenCloze(model, length_penalty=args.length_penalty,
+                                                          share_context=args.share_context)
                     else:
                         model = GLMForSingleTokenCloze(model, take_softmax=args.adapet)
                 else:
@@ -137,7 +143,8 @@ def get_model(args, model_type=None, multi_token=True, num_labels=None, spell_le
         model.half()
 
     # GPU allocation.
-    model.cuda(torch.cuda.current_device())
+    if args.cuda:
+        model.cuda(torch.cuda.current_device())
 
     # Fp16 conversion.
     if args.fp16:
@@ -150,12 +157,20 @@ def get_model(args, model_type=None, multi_token=True, num_labels=None, spell_le
             model = TorchDDP(model, device_ids=[i], output_device=i,
                              process_group=mpu.get_data_parallel_group())
         elif args.DDP_impl == 'local':
-            model = LocalDDP(model)
+            model = LocalDDP(model, overlap_allreduce=args.overlap_allreduce, bucket_cap_mb=args.bucket_cap_mb,
+                             fp32_allreduce=args.fp32_allreduce)
         else:
             print_rank_0("Skip DDP model")
     return model
 
 
+def quantize_model(model):
+    """Quantize the weights of the GLM model inside the wrappers to int8 for inference."""
+    for module in model.modules():
+        if isinstance(module, GLMModel):
+            module.quantize_int8()
+
+
 def get_optimizer_param_groups(model):
     # Build parameter groups (weight decay and non-decay).
     while isinstance(model, (LocalDDP, TorchDDP, FP16_Module)):
@@ -211,7 +226,8 @@ def get_optimizer(param_groups, args):
                                    dynamic_loss_args={
                                        'scale_window': args.loss_scale_window,
                                        'min_scale': args.min_scale,
-                                       'delayed_shift': args.hysteresis})
+                                       'delayed_shift': args.hysteresis},
+                                   flat_master=args.flat_master)
 
     return optimizer
 
@@ -342,7 +358,9 @@ def train_step(data_iterator, model, optimizer, lr_scheduler, args, timers, forw
         torch.distributed.all_reduce(reduced_loss.data, group=mpu.get_data_parallel_group())
         reduced_loss.data = reduced_loss.data / (args.world_size / args.model_parallel_size)
 
-        if not DynamicLossScaler._has_inf_or_nan(reduced_loss):
+        # The sync-free step (fp16 only) does not read the loss on the host, a nan loss is caught by the overflow
+        # check of the loss scaler.
+        if args.sync_free or not DynamicLossScaler._has_inf_or_nan(reduced_loss):
             lm_loss_total += reduced_loss
             count += 1
 
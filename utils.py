@@ -15,6 +15,9 @@
 
 """Utilities for logging and serialization"""
 
+import collections
+import concurrent.futures
+import copy
 import os
 import random
 import time
@@ -25,6 +28,7 @@ import subprocess
 
 from fp16 import FP16_Optimizer
 import mpu
+from mmap_checkpoint import load_checkpoint_file
 from tensorboardX import SummaryWriter
 
 SUMMARY_WRITER_DIR_NAME = 'runs'
@@ -221,11 +225,138 @@ def save_zero_checkpoint(args, iteration, optimizer):
     print('  successfully saved {}'.format(zero_checkpoint_name))
 
 
+def _snapshot_to_cpu(obj, free_buffers, buffers, path=()):
+    """Copy the tensors of a (nested) state dict to CPU memory, pinned for the CUDA tensors,
+    and the other objects, which may change during training, e.g. the loss scaler.
+    The pinned buffers are keyed by their path in the state dict, the ones of an earlier
+    snapshot in `free_buffers` are reused if the shape and dtype match, and the buffers
+    of this snapshot are added to `buffers`."""
+    if torch.is_tensor(obj):
+        if obj.is_cuda:
+            buffer = free_buffers.get(path)
+            if buffer is None or buffer.size() != obj.size() or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.size(), dtype=obj.dtype, pin_memory=True)
+            buffers[path] = buffer
+            return buffer.copy_(obj, non_blocking=True)
+        return obj.clone()
+    if isinstance(obj, dict):
+        snapshot = obj.__class__((key, _snapshot_to_cpu(value, free_buffers, buffers, path + (key,)))
+                                 for key, value in obj.items())
+        if hasattr(obj, '_metadata'):
+            # the versions of the module state dicts
+            snapshot._metadata = copy.deepcopy(obj._metadata)
+        return snapshot
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_snapshot_to_cpu(value, free_buffers, buffers, path + (i,))
+                             for i, value in enumerate(obj))
+    return copy.deepcopy(obj)
+
+
+def _write_checkpoint(state_dict, checkpoint_name):
+    """Write to a temporary file and rename it, so that a checkpoint file is always complete."""
+    temp_name = checkpoint_name + '.tmp'
+    with open(temp_name, 'wb') as f:
+        torch.save(state_dict, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_name, checkpoint_name)
+    print('  successfully saved {}'.format(checkpoint_name))
+
+
+class AsyncCheckpointWriter(object):
+    """Save checkpoints in a background thread.
+
+    The state dict is snapshotted to CPU memory before `submit` returns, then it is
+    serialized, synced and renamed to the checkpoint name by the writer thread while
+    training goes on. At most `max_in_flight` checkpoints are pending, `submit` waits
+    for the oldest one otherwise. Every rank numbers its saves, whether it writes or
+    not, so that the ranks can agree on the last save that all of them finished.
+    The pinned buffers of the snapshots are reused by the next saves, so at most
+    `max_in_flight` sets of them are allocated.
+    """
+
+    def __init__(self, max_in_flight=1):
+        self.max_in_flight = max_in_flight
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        # (save number, future, pinned buffers) of the checkpoints being written by this rank
+        self.pending = collections.deque()
+        # the pinned buffers of the written checkpoints
+        self.buffer_pool = []
+        self.tags = {}
+        self.num_saves = 0
+        self.num_tracked = 0
+
+    def _finish_oldest(self):
+        _, future, buffers = self.pending.popleft()
+        self.buffer_pool.append(buffers)
+        future.result()
+
+    def new_save(self, tag):
+        self.num_saves += 1
+        self.tags[self.num_saves] = tag
+
+    def submit(self, state_dict, checkpoint_name):
+        while len(self.pending) >= self.max_in_flight:
+            self._finish_oldest()
+        free_buffers, buffers = self.buffer_pool.pop() if self.buffer_pool else {}, {}
+        snapshot = _snapshot_to_cpu(state_dict, free_buffers, buffers)
+        if torch.cuda.is_available():
+            # the non-blocking copies to the pinned memory
+            torch.cuda.synchronize()
+        future = self.executor.submit(_write_checkpoint, snapshot, checkpoint_name)
+        self.pending.append((self.num_saves, future, buffers))
+
+    def num_completed(self, wait=False):
+        """Number of saves of which this rank has written its files. The errors of the
+        writer thread are raised here."""
+        while self.pending and (wait or self.pending[0][1].done()):
+            self._finish_oldest()
+        return self.pending[0][0] - 1 if self.pending else self.num_saves
+
+
+_ASYNC_WRITER = None
+
+
+def get_async_writer(args):
+    global _ASYNC_WRITER
+    if _ASYNC_WRITER is None:
+        _ASYNC_WRITER = AsyncCheckpointWriter(max_in_flight=args.async_save_max_in_flight)
+    return _ASYNC_WRITER
+
+
+def update_checkpoint_tracker(args, wait=False):
+    """Point the tracker file to the last asynchronous save that all ranks finished.
+    This is a collective call, with `wait` all the pending saves are finished first."""
+    if _ASYNC_WRITER is None:
+        return
+    device = torch.cuda.current_device() if torch.cuda.is_available() else 'cpu'
+    num_completed = torch.tensor([_ASYNC_WRITER.num_completed(wait=wait)], dtype=torch.long, device=device)
+    torch.distributed.all_reduce(num_completed, op=torch.distributed.ReduceOp.MIN)
+    num_completed = num_completed.item()
+    if num_completed > _ASYNC_WRITER.num_tracked:
+        _ASYNC_WRITER.num_tracked = num_completed
+        if torch.distributed.get_rank() == 0:
+            tracker_filename = get_checkpoint_tracker_filename(args.save)
+            with open(tracker_filename + '.tmp', 'w') as f:
+                f.write(_ASYNC_WRITER.tags[num_completed])
+            os.replace(tracker_filename + '.tmp', tracker_filename)
+
+
+def wait_checkpoints(args):
+    """Finish the pending asynchronous saves and update the tracker file."""
+    if args.async_save:
+        update_checkpoint_tracker(args, wait=True)
+
+
 def save_checkpoint(iteration, model, optimizer, lr_scheduler, args, tag=None, barrier=True,
                     only_changed_parameters=False, no_deepspeed=False, no_save_optim=False):
-    """Save a model checkpoint."""
+    """Save a model checkpoint. With --async-save, the checkpoint is written in the background
+    and the tracker file is updated by a later call with barrier, or by wait_checkpoints."""
     if tag is None:
         tag = str(iteration)
+    async_save = args.async_save and not (args.deepspeed and not no_deepspeed)
+    if async_save:
+        get_async_writer(args).new_save(tag)
     if args.deepspeed and not no_deepspeed:
         save_ds_checkpoint(iteration, model, lr_scheduler, args, tag=tag)
     else:
@@ -262,9 +393,16 @@ def save_checkpoint(iteration, model, optimizer, lr_scheduler, args, tag=None, b
                 sd['rng_tracker_states'] = mpu.get_cuda_rng_tracker().get_states()
 
             ensure_directory_exists(checkpoint_name)
-            torch.save(sd, checkpoint_name)
-            print('  successfully saved {}'.format(checkpoint_name))
-
+            if async_save:
+                get_async_writer(args).submit(sd, checkpoint_name)
+            else:
+                torch.save(sd, checkpoint_name)
+                print('  successfully saved {}'.format(checkpoint_name))
+
+    if async_save:
+        if barrier:
+            update_checkpoint_tracker(args)
+        return
     # Wait so everyone is done (necessary)
     if barrier:
         torch.distributed.barrier()
@@ -352,10 +490,11 @@ def load_checkpoint(model, optimizer, lr_scheduler, args, no_deepspeed=False, no
 
         if mpu.get_data_parallel_rank() == 0:
             print('global rank {} is loading checkpoint {}'.format(
-                torch.distributed.get_rank(), checkpoint_name))
+                torch.distributed.get_rank() if torch.distributed.is_initialized() else 0, checkpoint_name))
 
-        # Load the checkpoint.
-        sd = torch.load(checkpoint_name, map_location='cpu')
+        # Load the checkpoint. A converted checkpoint is mapped and its optimizer and rng
+        # sections are only read if they are loaded below.
+        sd = load_checkpoint_file(checkpoint_name)
 
         # Model.
         if args.deepspeed: